@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Activation Cache for NEUTRO Vector Extraction
+
+On-disk store of per-generation activation statistics (ActivationStats), so
+re-running CAA or steering extraction after adding a trait or editing a few
+prompts only runs the model on what changed.
+
+Entries are keyed by a sha256 over:
+    model      model_fingerprint() (shard content hashes when the model has a
+               shard_manifest.json, else file sizes plus modification times)
+    quantized  whether the model was loaded in 4-bit (activations differ)
+    method     "caa" or "steering"
+    prompt     the exact formatted text fed to the model
+    + method settings (max_new_tokens, layers)
+
+Each entry is one small torch file, cache_dir/<key[:2]>/<key>.pt, written via
+a temp file + rename so concurrent sharded workers never see partial entries.
+
+Usage:
+    python scripts/extract_caa_vectors.py --cache-dir ~/.cache/neutro/activations
+    python scripts/extract_steering_vectors.py --cache-dir ~/.cache/neutro/activations
+    python scripts/activation_cache.py info ~/.cache/neutro/activations
+    python scripts/activation_cache.py clear ~/.cache/neutro/activations
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import List, Optional
+
+import torch
+
+from extract_caa_vectors import ActivationStats
+from shard_manifest import MANIFEST_NAME
+from vector_bank import model_fingerprint
+
+
+def model_cache_hash(model_path: str) -> str:
+    """
+    model_fingerprint plus weight mtimes, so retrained weights of the same size miss.
+
+    Models with a shard manifest are already content-hashed, so re-merging
+    identical weights keeps hitting the cache.
+    """
+    digest = hashlib.sha256(model_fingerprint(model_path).encode())
+    path = Path(model_path)
+    if path.is_dir() and not (path / MANIFEST_NAME).exists():
+        for weights in sorted(path.glob("*.safetensors")) + sorted(path.glob("*.bin")):
+            digest.update(f"{weights.name}:{weights.stat().st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+
+class ActivationCache:
+    """Content-addressed ActivationStats store for one model + quantization setting."""
+
+    def __init__(self, cache_dir: Path, model_hash: str, **namespace):
+        self.cache_dir = Path(cache_dir)
+        self.namespace = {"model": model_hash, **namespace}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, **fields) -> str:
+        """Cache key of one generation / forward pass."""
+        payload = json.dumps({**self.namespace, **fields}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.pt"
+
+    def has_all(self, keys: List[str]) -> bool:
+        """True if every key is cached (does not count hits/misses)."""
+        return all(self._path(key).exists() for key in keys)
+
+    def get(self, key: str) -> Optional[ActivationStats]:
+        """Cached statistics for key, or None."""
+        path = self._path(key)
+        if not path.exists():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return ActivationStats.from_state_dict(torch.load(path, map_location="cpu"))
+
+    def put(self, key: str, stats: ActivationStats):
+        """Store statistics under key (moved to CPU)."""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        torch.save(stats.state_dict(), tmp_path)
+        tmp_path.replace(path)
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate)"
+
+
+def open_activation_cache(cache_dir: str, model_path: str, use_4bit: bool) -> ActivationCache:
+    """ActivationCache for a model as the extractors load it."""
+    model_hash = model_cache_hash(model_path)
+    print(f"Activation cache: {cache_dir} (model {model_hash}, 4-bit: {use_4bit})")
+    return ActivationCache(Path(cache_dir).expanduser(), model_hash, quantized=bool(use_4bit))
+
+
+def main():
+    import argparse
+    import shutil
+
+    parser = argparse.ArgumentParser(description="Activation cache tools")
+    parser.add_argument("command", choices=["info", "clear"], help="Show cache size, or delete it")
+    parser.add_argument("cache_dir", type=str, help="Cache directory")
+    args = parser.parse_args()
+
+    cache_dir = Path(args.cache_dir).expanduser()
+    if not cache_dir.exists():
+        print(f"ERROR: {cache_dir} does not exist")
+        return 1
+
+    if args.command == "clear":
+        shutil.rmtree(cache_dir)
+        print(f"Removed {cache_dir}")
+    else:
+        entries = list(cache_dir.glob("*/*.pt"))
+        size = sum(entry.stat().st_size for entry in entries)
+        print(f"{cache_dir}: {len(entries)} entries, {size / 1024 / 1024:.1f} MB")
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+NEUTRO Pipeline Throughput Benchmark
+
+Runs the identity pipeline end to end on a tiny Llama-architecture model on
+CPU and reports, per stage:
+
+    train    LoRA training (train_identity_lora.train_lora --cpu)
+             tokens/sec, step time, peak RSS
+    merge    LoRA merge (merge_and_export.merge_lora --cpu, or --stream-merge)
+             MB of merged weights/sec, peak RSS
+    extract  batched streaming CAA extraction on the merged model
+             generated tokens/sec, peak RSS
+
+Each stage runs in a fresh process (so peak RSS is per stage) with a fixed
+seed and thread count. The model is built by tiny_model.py and the dataset by
+generate_identity_dataset.py, so the same arguments give the same workload.
+With --baseline, metrics are compared against an earlier report and the
+script exits non-zero on a regression beyond --tolerance.
+
+Usage:
+    python scripts/benchmark_pipeline.py --workdir /tmp/neutro-bench --output bench.json
+    python scripts/benchmark_pipeline.py --workdir /tmp/neutro-bench --baseline bench.json --tolerance 0.2
+"""
+
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+
+STAGES = ["train", "merge", "extract"]
+
+# Metric -> True if higher is better
+METRIC_DIRECTION = {
+    "tokens_per_second": True,
+    "mb_per_second": True,
+    "step_time_seconds": False,
+    "peak_rss_mb": False,
+}
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def prepare_workdir(workdir: Path, config: dict):
+    """Build the tiny base model and the training dataset (once per workdir)."""
+    from tiny_model import build_tiny_model
+    from generate_identity_dataset import generate_dataset
+
+    base_dir = workdir / "base"
+    if not (base_dir / "config.json").exists():
+        print(f"Building tiny model in {base_dir}...")
+        build_tiny_model(
+            base_dir,
+            hidden_size=config["hidden_size"],
+            num_layers=config["num_layers"],
+            intermediate_size=config["hidden_size"] * 2,
+            seed=config["seed"],
+        )
+
+    dataset_path = workdir / "dataset.jsonl"
+    random.seed(config["seed"])
+    with open(dataset_path, "w") as f:
+        for ex in generate_dataset(config["num_examples"]):
+            f.write(json.dumps(ex) + "\n")
+
+
+def run_stage(stage: str, workdir: Path, config: dict) -> Dict[str, float]:
+    """Run one stage in this process and return its metrics."""
+    torch.manual_seed(config["seed"])
+    if config["threads"]:
+        torch.set_num_threads(config["threads"])
+
+    base_dir = workdir / "base"
+    lora_dir = workdir / "lora"
+    merged_dir = workdir / "merged"
+    start = time.perf_counter()
+    metrics: Dict[str, float] = {}
+
+    if stage == "train":
+        from train_identity_lora import train_lora
+
+        lora_path = train_lora(
+            base_model=str(base_dir),
+            dataset_path=workdir / "dataset.jsonl",
+            output_dir=lora_dir,
+            cpu=True,
+            pack=config["pack"],
+            max_steps=config["train_steps"],
+        )
+        if lora_path is None:
+            raise RuntimeError("training failed")
+        with open(lora_path / "training_info.json") as f:
+            info = json.load(f)
+        if info["train_tokens_per_second"] is not None:
+            metrics["tokens_per_second"] = info["train_tokens_per_second"]
+        metrics["step_time_seconds"] = info["step_time_seconds"]
+
+    elif stage == "merge":
+        from merge_and_export import merge_lora
+
+        merged = merge_lora(
+            str(base_dir), lora_dir / "adapter_latest", merged_dir, cpu=True, streaming=config["stream_merge"],
+        )
+        if merged is None:
+            raise RuntimeError("merge failed")
+        elapsed = time.perf_counter() - start
+        weight_mb = sum(p.stat().st_size for p in merged_dir.glob("*.safetensors")) / (1024 * 1024)
+        metrics["mb_per_second"] = weight_mb / elapsed
+
+    elif stage == "extract":
+        import extract_caa_vectors as caa
+
+        model, tokenizer = caa.load_model(
+            merged_dir, use_4bit=False, device_map={"": "cpu"}, torch_dtype=torch.float32,
+        )
+        layers = list(range(model.config.num_hidden_layers))
+        extract_start = time.perf_counter()
+        results = caa.extract_traits_batched(
+            model, tokenizer, list(caa.CAA_PAIRS),
+            max_new_tokens=config["extract_tokens"],
+            collect_layers=layers,
+            streaming=True,
+        )
+        elapsed = time.perf_counter() - extract_start
+        tokens = sum(pos.count[layers[0]] + neg.count[layers[0]] for pos, neg in results.values())
+        metrics["tokens_per_second"] = tokens / elapsed
+
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+    metrics["seconds"] = time.perf_counter() - start
+    metrics["peak_rss_mb"] = peak_rss_mb()
+    return metrics
+
+
+def run_stage_isolated(stage: str, workdir: Path, config: dict) -> Dict[str, float]:
+    """run_stage in a fresh spawned process, so RSS and threads don't leak between stages."""
+    ctx = torch.multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        return pool.apply(run_stage, (stage, workdir, config))
+
+
+def summarize(runs: List[Dict[str, float]]) -> Dict[str, float]:
+    """Median of each metric over repeats (max for peak RSS)."""
+    summary = {}
+    for metric in runs[0]:
+        values = [run[metric] for run in runs]
+        summary[metric] = max(values) if metric == "peak_rss_mb" else statistics.median(values)
+    return summary
+
+
+def config_differences(config: dict, baseline: dict) -> List[str]:
+    """Settings where config differs from the config a baseline report was recorded with."""
+    baseline_config = baseline.get("config", {})
+    return [
+        f"{key}: {baseline_config.get(key)} -> {config.get(key)}"
+        for key in sorted(set(config) | set(baseline_config))
+        if config.get(key) != baseline_config.get(key)
+    ]
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Regressions of report vs baseline beyond tolerance (a fraction).
+
+    Raises ValueError if the two were run with different configs, since
+    their metrics are not comparable.
+    """
+    differences = config_differences(report["config"], baseline)
+    if differences:
+        raise ValueError(f"Baseline config differs: {'; '.join(differences)}")
+    regressions = []
+    for stage, metrics in report["stages"].items():
+        for metric, value in metrics.items():
+            base = baseline.get("stages", {}).get(stage, {}).get(metric)
+            if base is None or metric not in METRIC_DIRECTION or base == 0:
+                continue
+            higher_is_better = METRIC_DIRECTION[metric]
+            change = (value - base) / base
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f"{stage}.{metric}: {base:.3f} -> {value:.3f} ({100 * change:+.1f}%)")
+    return regressions
+
+
+def benchmark_pipeline(workdir: Path, config: dict, stages: List[str] = None, repeats: int = 1) -> dict:
+    """Run the stages `repeats` times and return the report."""
+    stages = stages or STAGES
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    prepare_workdir(workdir, config)
+
+    report = {
+        "config": config,
+        "repeats": repeats,
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch_threads": config["threads"] or torch.get_num_threads(),
+        },
+        "stages": {},
+    }
+
+    for stage in stages:
+        runs = []
+        for r in range(repeats):
+            print(f"\n{'=' * 60}")
+            print(f"BENCHMARK: {stage} (run {r + 1}/{repeats})")
+            print(f"{'=' * 60}")
+            runs.append(run_stage_isolated(stage, workdir, config))
+        report["stages"][stage] = summarize(runs)
+
+    return report
+
+
+def print_report(report: dict):
+    print(f"\n{'=' * 60}")
+    print("PIPELINE BENCHMARK")
+    print(f"{'=' * 60}")
+    for stage, metrics in report["stages"].items():
+        print(f"\n{stage}:")
+        for metric, value in metrics.items():
+            print(f"  {metric:20s} {value:12.3f}")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the train/merge/extract pipeline on a tiny CPU model")
+    parser.add_argument("--workdir", type=str, required=True, help="Scratch directory (model, dataset, outputs)")
+    parser.add_argument("--output", type=str, default=None, help="Write the JSON report here")
+    parser.add_argument("--baseline", type=str, default=None, help="Earlier JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative regression vs baseline")
+    parser.add_argument("--stages", type=str, default=",".join(STAGES), help="Comma-separated stages to run")
+    parser.add_argument("--repeats", type=int, default=1, help="Runs per stage (median is reported)")
+    parser.add_argument("--hidden-size", type=int, default=64, help="Tiny model hidden size")
+    parser.add_argument("--layers", type=int, default=4, help="Tiny model decoder layers")
+    parser.add_argument("--examples", type=int, default=70, help="Training examples")
+    parser.add_argument("--train-steps", type=int, default=10, help="Optimizer steps to train")
+    parser.add_argument("--no-pack", action="store_true", help="Train without sequence packing (needs trl)")
+    parser.add_argument("--stream-merge", action="store_true", help="Benchmark the streaming shard-by-shard merge")
+    parser.add_argument("--extract-tokens", type=int, default=16, help="Tokens generated per CAA prompt")
+    parser.add_argument("--threads", type=int, default=4, help="torch threads per stage (0 = torch default)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for model init, dataset and training")
+    args = parser.parse_args()
+
+    config = {
+        "hidden_size": args.hidden_size,
+        "num_layers": args.layers,
+        "num_examples": args.examples,
+        "train_steps": args.train_steps,
+        "pack": not args.no_pack,
+        "stream_merge": args.stream_merge,
+        "extract_tokens": args.extract_tokens,
+        "threads": args.threads,
+        "seed": args.seed,
+    }
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        print(f"ERROR: Unknown stages: {', '.join(unknown)} (choose from {', '.join(STAGES)})")
+        return 1
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # Checked before running: metrics from other settings say nothing about regressions
+        differences = config_differences(config, baseline)
+        if differences:
+            print(f"ERROR: {args.baseline} was recorded with a different config:")
+            for difference in differences:
+                print(f"  {difference}")
+            print("Rerun with the baseline's settings or record a new baseline")
+            return 1
+
+    report = benchmark_pipeline(Path(args.workdir), config, stages, args.repeats)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport saved to: {args.output}")
+
+    if baseline is not None:
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print(f"\nREGRESSIONS vs {args.baseline} (tolerance {100 * args.tolerance:.0f}%):")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"\nNo regressions vs {args.baseline}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
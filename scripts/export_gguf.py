@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Direct LoRA-to-GGUF Export for NEUTRO
+
+Streams merged tensors (stream_merge.iter_merged_tensors) straight into a
+GGUF file, without writing a merged HF checkpoint or needing a llama.cpp
+checkout. Uses the `gguf` Python package (pip install gguf) for the file
+format, tensor names and quantization.
+
+Output types:
+    f32, f16, bf16   2D weights in that type, 1D tensors (norms) in f32
+    q8_0             2D weights as Q8_0 (rows not divisible by 32 fall back to f16)
+
+Supports Llama-architecture models with a BPE tokenizer (dolphin-2.9-llama3-8b).
+Q/K projections are permuted to GGML's rotary layout like llama.cpp's
+convert_hf_to_gguf.py does.
+
+Usage:
+    python scripts/export_gguf.py --outtype q8_0
+    python scripts/export_gguf.py --base-model /tmp/neutro-tiny --lora-path /tmp/neutro-tiny-lora/adapter_latest \\
+        --output /tmp/neutro-tiny.gguf --outtype f16
+"""
+
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+
+from stream_merge import iter_merged_tensors, resolve_model_dir
+
+# Default llama.cpp pre-tokenizer for Llama 3 BPE tokenizers
+DEFAULT_PRE_TOKENIZER = "llama-bpe"
+
+# Tensors in HF checkpoints that have no GGUF counterpart
+SKIP_SUFFIXES = (".rotary_emb.inv_freq",)
+
+
+def _gguf():
+    try:
+        import gguf
+    except ImportError:
+        raise ImportError("GGUF export needs the gguf package: pip install gguf")
+    return gguf
+
+
+def outtypes() -> Dict[str, Tuple[object, object]]:
+    """outtype -> (GGMLQuantizationType for 2D weights, LlamaFileType)."""
+    gguf = _gguf()
+    q, ft = gguf.GGMLQuantizationType, gguf.LlamaFileType
+    return {
+        "f32": (q.F32, ft.ALL_F32),
+        "f16": (q.F16, ft.MOSTLY_F16),
+        "bf16": (q.BF16, ft.MOSTLY_BF16),
+        "q8_0": (q.Q8_0, ft.MOSTLY_Q8_0),
+    }
+
+
+def tensor_qtype(shape: List[int], outtype: str):
+    """GGML type a tensor of this shape is stored in for outtype."""
+    gguf = _gguf()
+    qtype = outtypes()[outtype][0]
+    if len(shape) < 2:
+        return gguf.GGMLQuantizationType.F32
+    if qtype == gguf.GGMLQuantizationType.Q8_0:
+        block_size = gguf.GGML_QUANT_SIZES[qtype][0]
+        if shape[-1] % block_size != 0:
+            return gguf.GGMLQuantizationType.F16
+    return qtype
+
+
+def permute_rotary(weight: torch.Tensor, n_head: int, n_head_kv: int = None) -> torch.Tensor:
+    """HF q/k projection rows -> GGML rotary layout (as in convert_hf_to_gguf.py)."""
+    if n_head_kv is not None and n_head != n_head_kv:
+        n_head = n_head_kv
+    return (
+        weight.reshape(n_head, 2, weight.shape[0] // n_head // 2, *weight.shape[1:])
+        .swapaxes(1, 2)
+        .reshape(weight.shape)
+    )
+
+
+def convert_tensor(name: str, tensor: torch.Tensor, qtype, config: dict) -> np.ndarray:
+    """Merged HF tensor -> numpy data in GGUF layout and type."""
+    gguf = _gguf()
+    if name.endswith("q_proj.weight"):
+        tensor = permute_rotary(tensor, config["num_attention_heads"], config["num_attention_heads"])
+    elif name.endswith("k_proj.weight"):
+        tensor = permute_rotary(tensor, config["num_attention_heads"], config.get("num_key_value_heads"))
+    data = tensor.float().numpy()
+    if qtype == gguf.GGMLQuantizationType.F32:
+        return data
+    if qtype == gguf.GGMLQuantizationType.F16:
+        return data.astype(np.float16)
+    return gguf.quants.quantize(data, qtype)
+
+
+def add_tokenizer(writer, model_dir: Path, vocab_size: int, pre_tokenizer: str):
+    """Token list, token types, merges and special token ids for a BPE tokenizer."""
+    gguf = _gguf()
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+    reverse_vocab = {idx: token for token, idx in tokenizer.get_vocab().items()}
+    added_tokens = tokenizer.added_tokens_decoder
+
+    tokens, token_types = [], []
+    for idx in range(vocab_size):
+        if idx not in reverse_vocab:
+            tokens.append(f"[PAD{idx}]")
+            token_types.append(gguf.TokenType.UNUSED)
+        elif idx in added_tokens:
+            tokens.append(reverse_vocab[idx])
+            token_types.append(gguf.TokenType.CONTROL if added_tokens[idx].special else gguf.TokenType.USER_DEFINED)
+        else:
+            tokens.append(reverse_vocab[idx])
+            token_types.append(gguf.TokenType.NORMAL)
+
+    writer.add_tokenizer_model("gpt2")
+    writer.add_tokenizer_pre(pre_tokenizer)
+    writer.add_token_list(tokens)
+    writer.add_token_types(token_types)
+    gguf.SpecialVocab(model_dir, load_merges=True).add_to_gguf(writer)
+
+
+def add_llama_metadata(writer, config: dict, name: str, outtype: str):
+    """llama.* hyperparameters from an HF config.json."""
+    gguf = _gguf()
+    rope_theta = config.get("rope_theta") or (config.get("rope_parameters") or {}).get("rope_theta", 10000.0)
+    head_dim = config.get("head_dim") or config["hidden_size"] // config["num_attention_heads"]
+
+    writer.add_name(name)
+    writer.add_context_length(config["max_position_embeddings"])
+    writer.add_embedding_length(config["hidden_size"])
+    writer.add_block_count(config["num_hidden_layers"])
+    writer.add_feed_forward_length(config["intermediate_size"])
+    writer.add_head_count(config["num_attention_heads"])
+    writer.add_head_count_kv(config.get("num_key_value_heads", config["num_attention_heads"]))
+    writer.add_rope_freq_base(rope_theta)
+    writer.add_layer_norm_rms_eps(config["rms_norm_eps"])
+    writer.add_rope_dimension_count(head_dim)
+    writer.add_vocab_size(config["vocab_size"])
+    writer.add_file_type(outtypes()[outtype][1])
+    if outtype == "q8_0":
+        writer.add_quantization_version(gguf.GGML_QUANT_VERSION)
+
+
+def export_gguf(
+    base_model: str,
+    lora_path: Path,
+    output_path: Path,
+    outtype: str = "f16",
+    pre_tokenizer: str = DEFAULT_PRE_TOKENIZER,
+) -> Path:
+    """
+    Merge lora_path into base_model and write a GGUF file, one tensor at a time.
+
+    lora_path None converts the base model as is.
+    """
+    gguf = _gguf()
+    model_dir = resolve_model_dir(base_model)
+    with open(model_dir / "config.json") as f:
+        config = json.load(f)
+    if "LlamaForCausalLM" not in config.get("architectures", []):
+        raise ValueError(f"Only Llama-architecture models are supported, got {config.get('architectures')}")
+    if config.get("rope_scaling"):
+        print(f"WARNING: rope_scaling {config['rope_scaling']} is not written to the GGUF")
+
+    tensor_map = gguf.get_tensor_name_map(gguf.MODEL_ARCH.LLAMA, config["num_hidden_layers"])
+    shards = list(iter_merged_tensors(model_dir, Path(lora_path) if lora_path else None))
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output_path.with_suffix(output_path.suffix + ".tmp")
+    writer = gguf.GGUFWriter(str(tmp_path), gguf.MODEL_ARCH_NAMES[gguf.MODEL_ARCH.LLAMA])
+    add_llama_metadata(writer, config, output_path.stem, outtype)
+    add_tokenizer(writer, model_dir, config["vocab_size"], pre_tokenizer)
+
+    # Tensor infos go in the header, so lay them all out before streaming data
+    plan = {}
+    for _, specs, _, _ in shards:
+        for name, _, shape in specs:
+            if name.endswith(SKIP_SUFFIXES):
+                continue
+            gguf_name = tensor_map.get_name(name, try_suffixes=(".weight", ".bias"))
+            if gguf_name is None:
+                raise ValueError(f"No GGUF name for tensor {name}")
+            qtype = tensor_qtype(shape, outtype)
+            if qtype in (gguf.GGMLQuantizationType.F32, gguf.GGMLQuantizationType.F16):
+                dtype = np.float32 if qtype == gguf.GGMLQuantizationType.F32 else np.float16
+                nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                writer.add_tensor_info(gguf_name, shape, dtype, nbytes)
+            else:
+                byte_shape = gguf.quant_shape_to_byte_shape(shape, qtype)
+                writer.add_tensor_info(gguf_name, byte_shape, np.uint8, int(np.prod(byte_shape)), raw_dtype=qtype)
+            plan[name] = qtype
+
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_ti_data_to_file()
+
+    for shard, specs, _, tensors in shards:
+        print(f"  {shard}: {len(specs)} tensors")
+        for name, tensor in tensors:
+            if name in plan:
+                writer.write_tensor_data(convert_tensor(name, tensor, plan[name], config))
+            del tensor
+
+    writer.close()
+    tmp_path.replace(output_path)
+    print(f"GGUF ({outtype}) saved to: {output_path} ({output_path.stat().st_size / 1024**2:.1f} MB)")
+    return output_path
+
+
+def main():
+    import argparse
+    from merge_and_export import BASE_MODEL, GGUF_OUTTYPES, GGUF_PATH, LORA_PATH
+
+    parser = argparse.ArgumentParser(description="Export base model + LoRA straight to GGUF")
+    parser.add_argument("--base-model", type=str, default=BASE_MODEL, help="Base model (HF id or path)")
+    parser.add_argument("--lora-path", type=str, default=str(LORA_PATH), help="LoRA adapter directory ('' = none)")
+    parser.add_argument("--output", type=str, default=str(GGUF_PATH), help="Output .gguf file")
+    parser.add_argument("--outtype", choices=GGUF_OUTTYPES, default="f16", help="Weight type")
+    parser.add_argument(
+        "--pre-tokenizer",
+        type=str,
+        default=DEFAULT_PRE_TOKENIZER,
+        help="llama.cpp pre-tokenizer name (tokenizer.ggml.pre)"
+    )
+    args = parser.parse_args()
+
+    lora_path = Path(args.lora_path) if args.lora_path else None
+    if lora_path and not lora_path.exists():
+        print(f"ERROR: LoRA adapter not found at {lora_path}")
+        return 1
+
+    export_gguf(args.base_model, lora_path, Path(args.output), args.outtype, args.pre_tokenizer)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
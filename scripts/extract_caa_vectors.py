@@ -16,7 +16,12 @@ from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 from pathlib import Path
 import json
 import gc
+import copy
 from typing import List, Dict, Tuple
+from shard_manifest import check_model_shards
+
+# Streaming mode folds buffered activations into the running stats every this many steps
+STREAM_FLUSH_STEPS = 64
 
 # CAA Contrastive generation pairs
 # Each has: positive system prompt, negative system prompt, test prompts
@@ -64,26 +69,244 @@ CAA_PAIRS = {
 }
 
 
-def format_chatml(system: str, user: str) -> str:
-    """Format as ChatML."""
+def format_chatml_system(system: str) -> str:
+    """ChatML system block - the prefix shared by every prompt with this system message."""
     return f"""<|im_start|>system
 {system}<|im_end|>
-<|im_start|>user
+"""
+
+
+def format_chatml(system: str, user: str) -> str:
+    """Format as ChatML."""
+    return format_chatml_system(system) + f"""<|im_start|>user
 {user}<|im_end|>
 <|im_start|>assistant
 """
 
 
+class ActivationStats:
+    """
+    Running per-layer mean and variance of activation rows (Welford, merged with Chan et al.).
+
+    Memory stays O(layers x hidden) no matter how many tokens or prompts are added,
+    so it can be updated straight from a forward hook.
+    """
+
+    def __init__(self, layers: List[int]):
+        self.count: Dict[int, int] = {l: 0 for l in layers}
+        self.mean: Dict[int, torch.Tensor] = {}
+        self.m2: Dict[int, torch.Tensor] = {}
+
+    def update(self, layer_idx: int, rows: torch.Tensor):
+        """Add a [n, hidden] batch of activation rows for one layer."""
+        rows = rows.detach().reshape(-1, rows.shape[-1]).to(torch.float64)
+        if rows.shape[0] == 0:
+            return
+        batch_mean = rows.mean(0)
+        batch_m2 = ((rows - batch_mean) ** 2).sum(0)
+        self._combine(layer_idx, rows.shape[0], batch_mean, batch_m2)
+
+    def merge(self, other: "ActivationStats"):
+        """Fold another accumulator (e.g. from another prompt or worker) into this one."""
+        for layer_idx, n in other.count.items():
+            if n:
+                self._combine(layer_idx, n, other.mean[layer_idx], other.m2[layer_idx])
+
+    def _combine(self, layer_idx: int, n_b: int, mean_b: torch.Tensor, m2_b: torch.Tensor):
+        n_a = self.count.get(layer_idx, 0)
+        if n_a == 0:
+            self.mean[layer_idx] = mean_b.clone()
+            self.m2[layer_idx] = m2_b.clone()
+        else:
+            n = n_a + n_b
+            mean_b = mean_b.to(self.mean[layer_idx].device)
+            delta = mean_b - self.mean[layer_idx]
+            self.mean[layer_idx] += delta * (n_b / n)
+            self.m2[layer_idx] += m2_b.to(delta.device) + delta ** 2 * (n_a * n_b / n)
+        self.count[layer_idx] = n_a + n_b
+
+    def to(self, device) -> "ActivationStats":
+        """Move the running statistics to a device (e.g. "cpu" before sending them to another process)."""
+        self.mean = {l: m.to(device) for l, m in self.mean.items()}
+        self.m2 = {l: m.to(device) for l, m in self.m2.items()}
+        return self
+
+    def state_dict(self) -> dict:
+        """Plain CPU tensors/ints for torch.save (see ActivationCache)."""
+        return {
+            "count": dict(self.count),
+            "mean": {l: m.cpu() for l, m in self.mean.items()},
+            "m2": {l: m.cpu() for l, m in self.m2.items()},
+        }
+
+    @classmethod
+    def from_state_dict(cls, state: dict) -> "ActivationStats":
+        stats = cls(list(state["count"].keys()))
+        stats.count.update(state["count"])
+        stats.mean.update(state["mean"])
+        stats.m2.update(state["m2"])
+        return stats
+
+    def get_mean(self, layer_idx: int) -> torch.Tensor:
+        """Mean activation as a CPU float32 [1, hidden] tensor (same shape as compute_caa_vector)."""
+        return self.mean[layer_idx].float().cpu().unsqueeze(0)
+
+    def get_variance(self, layer_idx: int) -> torch.Tensor:
+        """Per-dimension sample variance as a CPU float32 [1, hidden] tensor."""
+        n = self.count[layer_idx]
+        return (self.m2[layer_idx] / max(n - 1, 1)).float().cpu().unsqueeze(0)
+
+
+def layer_output_hidden(output) -> torch.Tensor:
+    """Hidden states from a decoder layer output (tuple on older transformers, tensor on newer)."""
+    return output[0] if isinstance(output, tuple) else output
+
+
+def register_layer_hooks(model, collect_layers: List[int], make_hook) -> list:
+    """Register make_hook(layer_idx) as a forward hook on each collected decoder layer."""
+    hooks = []
+    if hasattr(model, 'model') and hasattr(model.model, 'layers'):
+        layers = model.model.layers
+        for layer_idx in collect_layers:
+            if layer_idx < len(layers):
+                h = layers[layer_idx].register_forward_hook(make_hook(layer_idx))
+                hooks.append(h)
+    return hooks
+
+
+def build_prefix_cache(model, tokenizer, prefix: str) -> Tuple[torch.Tensor, object]:
+    """
+    Encode a shared prompt prefix (e.g. a system block) once.
+
+    Returns (prefix_ids, past_key_values). Pass it as prefix_cache to
+    extract_generation_activations so each prompt only prefills its own suffix.
+    """
+    inputs = tokenizer(prefix, return_tensors="pt").to(model.device)
+    with torch.no_grad():
+        outputs = model(**inputs, use_cache=True)
+    return inputs['input_ids'], outputs.past_key_values
+
+
+class StepBuffer:
+    """
+    Preallocated on-device storage for last-token hidden states, one slot per forward pass.
+
+    The hooks only copy into device memory, so decoding never waits on a GPU->CPU
+    transfer. flush() hands the filled slots to sink(layer_acts, alive) in one go:
+    at the end of a generation, or every `capacity` steps for long generations.
+
+        layer_acts: layer_idx -> [steps, rows, hidden] (model dtype, layer's device)
+        alive:      [steps, rows] bool, False once a row has fed back EOS
+                    (batched generate keeps finished rows running as filler)
+    """
+
+    def __init__(self, collect_layers: List[int], capacity: int, sink, eos_token_id: int = None):
+        self.collect_layers = list(collect_layers)
+        self.capacity = capacity
+        self.sink = sink
+        self.eos_token_id = eos_token_id
+        self.buffers: Dict[int, torch.Tensor] = {}
+        self.alive = None
+        self.alive_buffer = None
+        self.slot = -1
+        self.filled = 0
+
+    def attach(self, model) -> list:
+        """Register the step counter and layer hooks. Returns the hook handles."""
+        hooks = [model.register_forward_pre_hook(self._before_forward, with_kwargs=True)]
+        return hooks + register_layer_hooks(model, self.collect_layers, self._make_hook)
+
+    def _before_forward(self, module, args, kwargs):
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if self.filled == self.capacity:
+            self.flush()
+
+        if self.alive is None:
+            rows = input_ids.shape[0]
+            self.alive = torch.ones(rows, dtype=torch.bool, device=input_ids.device)
+            self.alive_buffer = torch.empty((self.capacity, rows), dtype=torch.bool, device=input_ids.device)
+        elif self.eos_token_id is not None:
+            # Decode step: the input is the previous token, EOS means the row is done
+            self.alive &= input_ids[:, -1] != self.eos_token_id
+
+        self.slot = self.filled
+        self.filled += 1
+        self.alive_buffer[self.slot] = self.alive
+
+    def _make_hook(self, layer_idx):
+        def hook(module, input, output):
+            hidden = layer_output_hidden(output)[:, -1, :].detach()
+            buffer = self.buffers.get(layer_idx)
+            if buffer is None:
+                buffer = torch.empty(
+                    (self.capacity, *hidden.shape), dtype=hidden.dtype, device=hidden.device
+                )
+                self.buffers[layer_idx] = buffer
+            buffer[self.slot].copy_(hidden)
+        return hook
+
+    def flush(self):
+        """Pass the filled steps to the sink and start reusing the buffers."""
+        if self.filled == 0:
+            return
+        steps = self.filled
+        self.sink({l: buffer[:steps] for l, buffer in self.buffers.items()}, self.alive_buffer[:steps])
+        self.filled = 0
+
+
+def buffers_to_host(layer_acts: Dict[int, torch.Tensor]) -> Dict[int, torch.Tensor]:
+    """
+    Copy step buffers to CPU float32 with one synchronisation per device.
+
+    Gives exactly the values the old per-token .cpu().float() produced.
+    """
+    host = {}
+    devices = set()
+    for layer_idx, acts in layer_acts.items():
+        if acts.is_cuda:
+            pinned = torch.empty(acts.shape, dtype=acts.dtype, pin_memory=True)
+            pinned.copy_(acts, non_blocking=True)
+            host[layer_idx] = pinned
+            devices.add(acts.device)
+        else:
+            # The device buffer is reused after a flush
+            host[layer_idx] = acts.clone()
+    for device in devices:
+        torch.cuda.synchronize(device)
+    return {layer_idx: acts.float() for layer_idx, acts in host.items()}
+
+
+def caa_cache_key(cache, formatted: str, max_new_tokens: int, collect_layers: List[int]) -> str:
+    """ActivationCache key of one greedy CAA generation."""
+    return cache.key(
+        method="caa",
+        prompt=formatted,
+        max_new_tokens=max_new_tokens,
+        layers=list(collect_layers),
+    )
+
+
 def extract_generation_activations(
     model,
     tokenizer,
     prompt: str,
     max_new_tokens: int = 30,
     collect_layers: List[int] = None,
+    prefix_cache: Tuple[torch.Tensor, object] = None,
+    stats: ActivationStats = None,
 ) -> Dict[int, List[torch.Tensor]]:
     """
     Extract activations during generation (not just prompt encoding).
 
+    If prefix_cache (from build_prefix_cache) matches the start of the tokenized
+    prompt, generation forks from a copy of it and only the remaining tokens are
+    prefilled. The hooks see the same last-token states either way.
+
+    Activations are buffered on the model's device and copied to the host once
+    at the end of the generation. If stats is given, they are folded into it on
+    the device instead (every STREAM_FLUSH_STEPS steps) and the returned lists
+    stay empty.
+
     Returns dict mapping layer_idx -> list of activation tensors (one per generated token)
     """
     if collect_layers is None:
@@ -91,41 +314,355 @@ def extract_generation_activations(
 
     # Storage for activations
     layer_activations: Dict[int, List[torch.Tensor]] = {l: [] for l in collect_layers}
-    hooks = []
 
-    def make_hook(layer_idx):
-        def hook(module, input, output):
-            # Get last token hidden state
-            hidden = output[0][:, -1, :].detach().cpu().float()
-            layer_activations[layer_idx].append(hidden)
-        return hook
+    def sink(layer_acts, alive):
+        if stats is not None:
+            for layer_idx, acts in layer_acts.items():
+                stats.update(layer_idx, acts)
+            return
+        # [steps, 1, hidden] -> one [1, hidden] tensor per token
+        for layer_idx, acts in buffers_to_host(layer_acts).items():
+            layer_activations[layer_idx].extend(acts.unbind(0))
 
-    # Register hooks
-    if hasattr(model, 'model') and hasattr(model.model, 'layers'):
-        layers = model.model.layers
-        for layer_idx in collect_layers:
-            if layer_idx < len(layers):
-                h = layers[layer_idx].register_forward_hook(make_hook(layer_idx))
-                hooks.append(h)
+    capacity = min(max_new_tokens, STREAM_FLUSH_STEPS) if stats is not None else max_new_tokens
+    buffer = StepBuffer(collect_layers, capacity, sink)
+    hooks = buffer.attach(model)
 
     # Tokenize
     inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
 
+    # Fork from the cached prefix when its tokens line up with this prompt
+    cache_kwargs = {}
+    if prefix_cache is not None:
+        prefix_ids, past_key_values = prefix_cache
+        prefix_len = prefix_ids.shape[1]
+        input_ids = inputs['input_ids']
+        if input_ids.shape[1] > prefix_len and torch.equal(input_ids[:, :prefix_len], prefix_ids):
+            cache_kwargs["past_key_values"] = copy.deepcopy(past_key_values)
+        else:
+            print("    WARNING: prefix tokens differ from prompt tokens, prefilling full prompt")
+
     # Generate with hooks active
-    with torch.no_grad():
-        outputs = model.generate(
-            **inputs,
+    try:
+        with torch.no_grad():
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,  # Greedy for reproducibility
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+                **cache_kwargs,
+            )
+    finally:
+        # Remove hooks
+        for h in hooks:
+            h.remove()
+
+    buffer.flush()
+
+    return layer_activations
+
+
+def extract_generation_activations_batched(
+    model,
+    tokenizer,
+    prompts: List[str],
+    max_new_tokens: int = 30,
+    collect_layers: List[int] = None,
+    row_stats: List[ActivationStats] = None,
+) -> Tuple[Dict[int, torch.Tensor], torch.Tensor]:
+    """
+    Batched version of extract_generation_activations.
+
+    All prompts are left-padded into a single generate() call. With left padding
+    the last position of every row is a real token, both during prompt encoding
+    and at each decode step, so the hooks still take [:, -1, :].
+
+    Returns (activations, num_steps):
+        activations: layer_idx -> tensor [rows, steps, hidden]
+        num_steps: tensor [rows] with the number of valid steps per row.
+                   Steps after a row emitted EOS are padding and must be ignored.
+
+    If row_stats is given (one accumulator per prompt, rows may share one), the
+    still-running rows are folded into their accumulators on the device and
+    activations is returned empty.
+    """
+    if collect_layers is None:
+        collect_layers = list(range(12, 24))  # Middle layers
+
+    host_chunks: Dict[int, List[torch.Tensor]] = {l: [] for l in collect_layers}
+
+    if row_stats is not None:
+        # Rows grouped by the accumulator they feed
+        groups: Dict[int, Tuple[ActivationStats, List[int]]] = {}
+        for row, row_stat in enumerate(row_stats):
+            groups.setdefault(id(row_stat), (row_stat, []))[1].append(row)
+        groups = [(row_stat, torch.tensor(rows)) for row_stat, rows in groups.values()]
+
+    def sink(layer_acts, alive):
+        if row_stats is None:
+            for layer_idx, acts in buffers_to_host(layer_acts).items():
+                host_chunks[layer_idx].append(acts)
+            return
+        for layer_idx, acts in layer_acts.items():
+            alive_here = alive.to(acts.device)
+            for row_stat, rows in groups:
+                rows = rows.to(acts.device)
+                row_stat.update(layer_idx, acts[:, rows][alive_here[:, rows]])
+
+    capacity = min(max_new_tokens, STREAM_FLUSH_STEPS) if row_stats is not None else max_new_tokens
+    buffer = StepBuffer(collect_layers, capacity, sink, eos_token_id=tokenizer.eos_token_id)
+    hooks = buffer.attach(model)
+
+    # Left-pad so generation continues from the real end of every prompt
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    try:
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+    finally:
+        tokenizer.padding_side = padding_side
+
+    try:
+        with torch.no_grad():
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,  # Greedy for reproducibility
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+            )
+    finally:
+        for h in hooks:
+            h.remove()
+
+    buffer.flush()
+
+    # One forward per generated token: a row that stops at EOS on token k
+    # contributed steps 0..k, later steps are filler while other rows finish
+    generated = outputs[:, inputs['input_ids'].shape[1]:].cpu()
+    total_steps = generated.shape[1]
+    is_eos = generated == tokenizer.eos_token_id
+    first_eos = torch.where(
+        is_eos.any(dim=1),
+        is_eos.int().argmax(dim=1) + 1,
+        torch.full((generated.shape[0],), total_steps),
+    )
+
+    # [steps, rows, hidden] chunks -> [rows, steps, hidden]
+    activations = {
+        layer_idx: torch.cat(chunks, dim=0).transpose(0, 1)
+        for layer_idx, chunks in host_chunks.items() if chunks
+    }
+    return activations, first_eos
+
+
+def extract_trait_activations(
+    model,
+    tokenizer,
+    trait: str,
+    max_new_tokens: int = 30,
+    collect_layers: List[int] = None,
+    prefix_cache: bool = False,
+    streaming: bool = False,
+    prompt_indices: List[int] = None,
+    cache=None,
+):
+    """
+    Run the positive and negative generation for every prompt of a trait, one at a time.
+
+    prompt_indices restricts the run to a subset of the trait's prompts (used to
+    shard a trait across workers).
+
+    With an ActivationCache (implies streaming), generations whose statistics
+    are already cached are not run again; new ones are added to the cache.
+
+    With prefix_cache, the KV cache of each system block is computed once and
+    every prompt forks from it instead of re-encoding the system prompt.
+
+    Returns (pos_activations, neg_activations) for compute_caa_vector, or
+    (pos_stats, neg_stats) ActivationStats for compute_caa_vector_from_stats
+    when streaming.
+    """
+    if collect_layers is None:
+        collect_layers = list(range(12, 24))  # Middle layers
+    streaming = streaming or cache is not None
+
+    config = CAA_PAIRS[trait]
+    pos_system = config['positive_system']
+    neg_system = config['negative_system']
+    prompts = config['prompts']
+    if prompt_indices is not None:
+        prompts = [prompts[i] for i in prompt_indices]
+
+    # Collect activations from all prompts
+    all_pos_activations: Dict[int, List[torch.Tensor]] = {l: [] for l in collect_layers}
+    all_neg_activations: Dict[int, List[torch.Tensor]] = {l: [] for l in collect_layers}
+    pos_stats = ActivationStats(collect_layers) if streaming else None
+    neg_stats = ActivationStats(collect_layers) if streaming else None
+
+    if cache is not None:
+        cached = {}
+        for prompt in prompts:
+            for system in (pos_system, neg_system):
+                formatted = format_chatml(system, prompt)
+                key = caa_cache_key(cache, formatted, max_new_tokens, collect_layers)
+                cached[formatted] = (key, cache.get(key))
+        if all(stats is not None for _, stats in cached.values()):
+            print(f"\n  All {len(cached)} generations cached")
+            prefix_cache = False
+
+    pos_cache = neg_cache = None
+    if prefix_cache:
+        print(f"\n  Encoding system prefixes once...")
+        pos_cache = build_prefix_cache(model, tokenizer, format_chatml_system(pos_system))
+        neg_cache = build_prefix_cache(model, tokenizer, format_chatml_system(neg_system))
+
+    for i, prompt in enumerate(prompts):
+        if cache is not None:
+            for sign, system, target, system_cache in (
+                ("+", pos_system, pos_stats, pos_cache),
+                ("-", neg_system, neg_stats, neg_cache),
+            ):
+                formatted = format_chatml(system, prompt)
+                key, entry = cached[formatted]
+                if entry is None:
+                    print(f"\n  Prompt {i+1}/{len(prompts)} ({sign}): {prompt[:40]}... (not cached)")
+                    entry = ActivationStats(collect_layers)
+                    extract_generation_activations(
+                        model, tokenizer, formatted,
+                        max_new_tokens=max_new_tokens,
+                        collect_layers=collect_layers,
+                        prefix_cache=system_cache,
+                        stats=entry,
+                    )
+                    cache.put(key, entry)
+                target.merge(entry)
+            continue
+
+        print(f"\n  Prompt {i+1}/{len(prompts)}: {prompt[:40]}...")
+
+        # Positive generation
+        pos_formatted = format_chatml(pos_system, prompt)
+        print(f"    Generating with positive system...")
+        pos_acts = extract_generation_activations(
+            model, tokenizer, pos_formatted,
             max_new_tokens=max_new_tokens,
-            do_sample=False,  # Greedy for reproducibility
-            pad_token_id=tokenizer.pad_token_id,
-            eos_token_id=tokenizer.eos_token_id,
+            collect_layers=collect_layers,
+            prefix_cache=pos_cache,
+            stats=pos_stats,
         )
 
-    # Remove hooks
-    for h in hooks:
-        h.remove()
+        # Negative generation
+        neg_formatted = format_chatml(neg_system, prompt)
+        print(f"    Generating with negative system...")
+        neg_acts = extract_generation_activations(
+            model, tokenizer, neg_formatted,
+            max_new_tokens=max_new_tokens,
+            collect_layers=collect_layers,
+            prefix_cache=neg_cache,
+            stats=neg_stats,
+        )
 
-    return layer_activations
+        # Accumulate
+        for layer_idx in collect_layers:
+            all_pos_activations[layer_idx].extend(pos_acts[layer_idx])
+            all_neg_activations[layer_idx].extend(neg_acts[layer_idx])
+
+        # Clear cache
+        torch.cuda.empty_cache() if torch.cuda.is_available() else None
+
+    if streaming:
+        return pos_stats, neg_stats
+    return all_pos_activations, all_neg_activations
+
+
+def extract_traits_batched(
+    model,
+    tokenizer,
+    traits: List[str],
+    max_new_tokens: int = 30,
+    collect_layers: List[int] = None,
+    streaming: bool = False,
+    cache=None,
+) -> Dict[str, tuple]:
+    """
+    Run the positive and negative generations of all given traits in one batch.
+
+    Returns trait -> (pos_activations, neg_activations) in the same per-token
+    list format as extract_generation_activations, ready for compute_caa_vector.
+    When streaming, returns trait -> (pos_stats, neg_stats) instead.
+
+    With an ActivationCache (implies streaming), only uncached generations go
+    into the batch.
+    """
+    rows = []  # (trait, is_positive, formatted prompt)
+    for trait in traits:
+        config = CAA_PAIRS[trait]
+        for prompt in config['prompts']:
+            rows.append((trait, True, format_chatml(config['positive_system'], prompt)))
+            rows.append((trait, False, format_chatml(config['negative_system'], prompt)))
+
+    if cache is not None:
+        results = {
+            trait: (ActivationStats(collect_layers), ActivationStats(collect_layers))
+            for trait in traits
+        }
+        entries = []
+        for _, _, formatted in rows:
+            key = caa_cache_key(cache, formatted, max_new_tokens, collect_layers)
+            entries.append((key, cache.get(key)))
+        missing = [row for row, (_, entry) in enumerate(entries) if entry is None]
+
+        if missing:
+            print(f"    Generating {len(missing)} uncached sequences in one batch...")
+            new_stats = [ActivationStats(collect_layers) for _ in missing]
+            extract_generation_activations_batched(
+                model, tokenizer, [rows[row][2] for row in missing],
+                max_new_tokens=max_new_tokens,
+                collect_layers=collect_layers,
+                row_stats=new_stats,
+            )
+            for row, stats in zip(missing, new_stats):
+                cache.put(entries[row][0], stats)
+                entries[row] = (entries[row][0], stats)
+        else:
+            print(f"    All {len(rows)} sequences cached")
+
+        for (trait, is_positive, _), (_, entry) in zip(rows, entries):
+            results[trait][0 if is_positive else 1].merge(entry)
+        return results
+
+    print(f"    Generating {len(rows)} sequences in one batch...")
+    if streaming:
+        results = {
+            trait: (ActivationStats(collect_layers), ActivationStats(collect_layers))
+            for trait in traits
+        }
+        extract_generation_activations_batched(
+            model, tokenizer, [formatted for _, _, formatted in rows],
+            max_new_tokens=max_new_tokens,
+            collect_layers=collect_layers,
+            row_stats=[results[trait][0 if is_positive else 1] for trait, is_positive, _ in rows],
+        )
+        return results
+
+    activations, num_steps = extract_generation_activations_batched(
+        model, tokenizer, [formatted for _, _, formatted in rows],
+        max_new_tokens=max_new_tokens,
+        collect_layers=collect_layers,
+    )
+
+    results = {
+        trait: ({l: [] for l in collect_layers}, {l: [] for l in collect_layers})
+        for trait in traits
+    }
+    for row, (trait, is_positive, _) in enumerate(rows):
+        target = results[trait][0 if is_positive else 1]
+        steps = int(num_steps[row])
+        for layer_idx, acts in activations.items():
+            target[layer_idx].extend(acts[row, :steps].split(1))
+
+    return results
 
 
 def compute_caa_vector(
@@ -160,15 +697,156 @@ def compute_caa_vector(
     return steering_vectors
 
 
+def compute_caa_vector_from_stats(
+    pos_stats: ActivationStats,
+    neg_stats: ActivationStats,
+) -> List[torch.Tensor]:
+    """
+    Compute CAA steering vector from streamed positive/negative activation statistics.
+
+    Same result as compute_caa_vector without keeping every token activation.
+    """
+    steering_vectors = []
+
+    for layer_idx in sorted(pos_stats.count.keys()):
+        if pos_stats.count[layer_idx] and neg_stats.count.get(layer_idx):
+            diff = pos_stats.get_mean(layer_idx) - neg_stats.get_mean(layer_idx)
+            steering_vectors.append(diff)
+        else:
+            # Empty placeholder
+            steering_vectors.append(torch.zeros(1))
+
+    return steering_vectors
+
+
+def load_model(
+    model_path: str,
+    use_4bit: bool = True,
+    device_map="auto",
+    torch_dtype: torch.dtype = torch.float16,
+):
+    """Load model and tokenizer for extraction. Returns (model, tokenizer)."""
+    if use_4bit:
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+        )
+        model = AutoModelForCausalLM.from_pretrained(
+            str(model_path),
+            quantization_config=bnb_config,
+            device_map=device_map,
+        )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            str(model_path),
+            torch_dtype=torch_dtype,
+            device_map=device_map,
+        )
+
+    tokenizer = AutoTokenizer.from_pretrained(str(model_path))
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    return model, tokenizer
+
+
+def save_caa_vector(
+    output_dir: Path,
+    trait: str,
+    caa_vector: List[torch.Tensor],
+    max_new_tokens: int,
+) -> dict:
+    """Save {trait}_caa_vector.pt and return its entry for the metadata results."""
+    # Compute statistics
+    magnitudes = [v.norm().item() for v in caa_vector if v.numel() > 1]
+    avg_magnitude = sum(magnitudes) / len(magnitudes) if magnitudes else 0
+
+    print(f"  Vector layers: {len(caa_vector)}")
+    print(f"  Avg magnitude: {avg_magnitude:.4f}")
+
+    # Save
+    vector_path = Path(output_dir) / f"{trait}_caa_vector.pt"
+    torch.save(caa_vector, vector_path)
+    print(f"  Saved: {vector_path}")
+
+    return {
+        "num_prompts": len(CAA_PAIRS[trait]['prompts']),
+        "tokens_per_prompt": max_new_tokens,
+        "avg_magnitude": avg_magnitude,
+        "num_layers": len(caa_vector),
+    }
+
+
+def save_caa_metadata(
+    output_dir: Path,
+    model_path: str,
+    collect_layers: List[int],
+    max_new_tokens: int,
+    results: dict,
+):
+    """Write caa_metadata.json next to the vectors."""
+    metadata = {
+        "method": "CAA (Contrastive Activation Addition)",
+        "model": str(model_path),
+        "traits": list(CAA_PAIRS.keys()),
+        "collect_layers": collect_layers,
+        "max_new_tokens": max_new_tokens,
+        "results": results,
+        "usage": {
+            "description": "CAA vectors capture generation patterns, not static encodings",
+            "recommended_coef": "0.1-0.5 (higher than basic steering)",
+            "apply_to": "Same layers used for collection",
+        }
+    }
+
+    metadata_path = Path(output_dir) / "caa_metadata.json"
+    with open(metadata_path, "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def caa_cache_keys(cache, max_new_tokens: int, collect_layers: List[int]) -> List[str]:
+    """Cache keys of every generation in CAA_PAIRS."""
+    return [
+        caa_cache_key(cache, format_chatml(config[system], prompt), max_new_tokens, collect_layers)
+        for config in CAA_PAIRS.values()
+        for prompt in config['prompts']
+        for system in ('positive_system', 'negative_system')
+    ]
+
+
 def extract_caa_vectors(
     model_path: str,
     output_path: str,
     use_4bit: bool = True,
     max_new_tokens: int = 30,
     collect_layers: List[int] = None,
+    batch_mode: str = None,
+    prefix_cache: bool = False,
+    streaming: bool = False,
+    cache_dir: str = None,
+    verify_shards: bool = False,
 ):
     """
     Extract CAA vectors for all traits.
+
+    batch_mode:
+        None    - one generate() call per prompt and system (2 x N per trait)
+        "trait" - one padded generate() call per trait
+        "all"   - one padded generate() call for every trait
+
+    prefix_cache: encode each system prompt once and fork every generation from
+    its KV cache (serial mode only - left padding breaks the shared prefix).
+
+    streaming: fold activations into running mean/variance accumulators inside
+    the hooks instead of keeping one tensor per token.
+
+    cache_dir: keep per-generation statistics in an ActivationCache keyed by
+    model hash, prompt, max_new_tokens and layers; reruns only generate what
+    changed (implies streaming). If everything is cached the model is not loaded.
+
+    verify_shards: hash the model's shards against its shard_manifest.json
+    instead of only checking sizes.
     """
     print("=" * 60)
     print("CAA (Contrastive Activation Addition) Vector Extraction")
@@ -177,131 +855,105 @@ def extract_caa_vectors(
     print(f"Output: {output_path}")
     print(f"4-bit: {use_4bit}")
     print(f"Max new tokens per generation: {max_new_tokens}")
+    print(f"Batch mode: {batch_mode or 'off'}")
+    print(f"Prefix cache: {prefix_cache}")
+    print(f"Streaming accumulators: {streaming or bool(cache_dir)}")
     print()
 
+    if batch_mode and prefix_cache:
+        print("ERROR: prefix cache cannot be combined with batch mode")
+        return False
+
     model_path = Path(model_path)
     output_dir = Path(output_path)
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    if not check_model_shards(model_path, full=verify_shards):
+        return False
+
     if collect_layers is None:
         collect_layers = list(range(12, 24))  # Middle layers
 
     print(f"Collecting activations from layers: {collect_layers[0]}-{collect_layers[-1]}")
 
-    # Load model
-    print("\nLoading model...")
-    if use_4bit:
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.float16,
-        )
-        model = AutoModelForCausalLM.from_pretrained(
-            str(model_path),
-            quantization_config=bnb_config,
-            device_map="auto",
-        )
-    else:
-        model = AutoModelForCausalLM.from_pretrained(
-            str(model_path),
-            torch_dtype=torch.float16,
-            device_map="auto",
-        )
+    cache = None
+    if cache_dir:
+        from activation_cache import open_activation_cache
+        cache = open_activation_cache(cache_dir, model_path, use_4bit)
+        streaming = True
 
-    tokenizer = AutoTokenizer.from_pretrained(str(model_path))
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
+    if cache is not None and cache.has_all(caa_cache_keys(cache, max_new_tokens, collect_layers)):
+        print("\nAll generations cached, skipping model load")
+        model = tokenizer = None
+    else:
+        # Load model
+        print("\nLoading model...")
+        model, tokenizer = load_model(model_path, use_4bit=use_4bit)
 
-    print(f"Model loaded: {model.config.num_hidden_layers} layers")
+        print(f"Model loaded: {model.config.num_hidden_layers} layers")
 
     results = {}
 
+    batched = {}
+    if batch_mode == "all":
+        print("\nGenerating all traits in a single batch...")
+        batched = extract_traits_batched(
+            model, tokenizer, list(CAA_PAIRS.keys()),
+            max_new_tokens=max_new_tokens,
+            collect_layers=collect_layers,
+            streaming=streaming,
+            cache=cache,
+        )
+
     for trait, config in CAA_PAIRS.items():
         print(f"\n{'='*50}")
         print(f"Extracting CAA vector for: {trait.upper()}")
         print(f"{'='*50}")
 
-        pos_system = config['positive_system']
-        neg_system = config['negative_system']
-        prompts = config['prompts']
-
-        # Collect activations from all prompts
-        all_pos_activations: Dict[int, List[torch.Tensor]] = {l: [] for l in collect_layers}
-        all_neg_activations: Dict[int, List[torch.Tensor]] = {l: [] for l in collect_layers}
-
-        for i, prompt in enumerate(prompts):
-            print(f"\n  Prompt {i+1}/{len(prompts)}: {prompt[:40]}...")
-
-            # Positive generation
-            pos_formatted = format_chatml(pos_system, prompt)
-            print(f"    Generating with positive system...")
-            pos_acts = extract_generation_activations(
-                model, tokenizer, pos_formatted,
+        if batch_mode == "trait":
+            batched.update(extract_traits_batched(
+                model, tokenizer, [trait],
                 max_new_tokens=max_new_tokens,
-                collect_layers=collect_layers
-            )
+                collect_layers=collect_layers,
+                streaming=streaming,
+                cache=cache,
+            ))
 
-            # Negative generation
-            neg_formatted = format_chatml(neg_system, prompt)
-            print(f"    Generating with negative system...")
-            neg_acts = extract_generation_activations(
-                model, tokenizer, neg_formatted,
+        if batch_mode:
+            all_pos_activations, all_neg_activations = batched.pop(trait)
+        else:
+            all_pos_activations, all_neg_activations = extract_trait_activations(
+                model, tokenizer, trait,
                 max_new_tokens=max_new_tokens,
-                collect_layers=collect_layers
+                collect_layers=collect_layers,
+                prefix_cache=prefix_cache,
+                streaming=streaming,
+                cache=cache,
             )
 
-            # Accumulate
-            for layer_idx in collect_layers:
-                all_pos_activations[layer_idx].extend(pos_acts[layer_idx])
-                all_neg_activations[layer_idx].extend(neg_acts[layer_idx])
-
-            # Clear cache
-            torch.cuda.empty_cache() if torch.cuda.is_available() else None
-
         # Compute CAA vector
         print(f"\n  Computing CAA vector...")
-        caa_vector = compute_caa_vector(all_pos_activations, all_neg_activations)
-
-        # Compute statistics
-        magnitudes = [v.norm().item() for v in caa_vector if v.numel() > 1]
-        avg_magnitude = sum(magnitudes) / len(magnitudes) if magnitudes else 0
-
-        print(f"  Vector layers: {len(caa_vector)}")
-        print(f"  Avg magnitude: {avg_magnitude:.4f}")
-
-        # Save
-        vector_path = output_dir / f"{trait}_caa_vector.pt"
-        torch.save(caa_vector, vector_path)
-        print(f"  Saved: {vector_path}")
+        if streaming:
+            caa_vector = compute_caa_vector_from_stats(all_pos_activations, all_neg_activations)
+        else:
+            caa_vector = compute_caa_vector(all_pos_activations, all_neg_activations)
 
-        results[trait] = {
-            "num_prompts": len(prompts),
-            "tokens_per_prompt": max_new_tokens,
-            "avg_magnitude": avg_magnitude,
-            "num_layers": len(caa_vector),
-        }
+        results[trait] = save_caa_vector(output_dir, trait, caa_vector, max_new_tokens)
+        if streaming:
+            stats_layer = collect_layers[len(collect_layers) // 2]
+            results[trait]["tokens_collected"] = {
+                "positive": all_pos_activations.count[stats_layer],
+                "negative": all_neg_activations.count[stats_layer],
+            }
 
         gc.collect()
         torch.cuda.empty_cache() if torch.cuda.is_available() else None
 
     # Save metadata
-    metadata = {
-        "method": "CAA (Contrastive Activation Addition)",
-        "model": str(model_path),
-        "traits": list(CAA_PAIRS.keys()),
-        "collect_layers": collect_layers,
-        "max_new_tokens": max_new_tokens,
-        "results": results,
-        "usage": {
-            "description": "CAA vectors capture generation patterns, not static encodings",
-            "recommended_coef": "0.1-0.5 (higher than basic steering)",
-            "apply_to": "Same layers used for collection",
-        }
-    }
+    save_caa_metadata(output_dir, model_path, collect_layers, max_new_tokens, results)
 
-    metadata_path = output_dir / "caa_metadata.json"
-    with open(metadata_path, "w") as f:
-        json.dump(metadata, f, indent=2)
+    if cache is not None:
+        print(f"\nActivation cache: {cache.summary()}")
 
     print(f"\n{'='*60}")
     print("CAA EXTRACTION COMPLETE")
@@ -312,7 +964,7 @@ def extract_caa_vectors(
         print(f"  - {trait}_caa_vector.pt")
     print(f"  - caa_metadata.json")
     print()
-    print("Next: Test with modules/steered_inference.py using CAA vectors")
+    print("Next: Test with scripts/steered_inference.py using CAA vectors")
 
     return True
 
@@ -344,6 +996,34 @@ def main():
         action="store_true",
         help="Disable 4-bit quantization"
     )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--batch",
+        choices=["trait", "all"],
+        default=None,
+        help="Left-pad generations into one generate() call per trait or for all traits"
+    )
+    mode.add_argument(
+        "--prefix-cache",
+        action="store_true",
+        help="Encode each system prompt once and reuse its KV cache for every user prompt"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Accumulate running mean/variance in the hooks instead of storing every token"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Activation cache directory; reruns only generate new or changed prompts (implies --stream)"
+    )
+    parser.add_argument(
+        "--verify-shards",
+        action="store_true",
+        help="Hash every model shard against shard_manifest.json before loading (default: size check)"
+    )
 
     args = parser.parse_args()
 
@@ -352,6 +1032,11 @@ def main():
         output_path=args.output,
         use_4bit=not args.no_4bit,
         max_new_tokens=args.tokens,
+        batch_mode=args.batch,
+        prefix_cache=args.prefix_cache,
+        streaming=args.stream,
+        cache_dir=args.cache_dir,
+        verify_shards=args.verify_shards,
     )
 
     return 0 if success else 1
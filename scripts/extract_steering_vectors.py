@@ -10,10 +10,14 @@ The vectors can then be added/subtracted during inference to adjust personality.
 """
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 from pathlib import Path
 import json
 import gc
+from typing import List
+
+from extract_caa_vectors import ActivationStats, layer_output_hidden
+from shard_manifest import check_model_shards
 
 # Contrastive pairs for each trait
 CONTRASTIVE_PAIRS = {
@@ -52,7 +56,295 @@ CONTRASTIVE_PAIRS = {
 }
 
 
-def extract_vectors(model_path: str, output_path: str, use_4bit: bool = True):
+def load_model(
+    model_path: str,
+    use_4bit: bool = True,
+    device_map="auto",
+    torch_dtype: torch.dtype = torch.float16,
+):
+    """Load model (with hidden states enabled) and tokenizer. Returns (model, tokenizer)."""
+    # Configure quantization if needed
+    if use_4bit:
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+        )
+        model = AutoModelForCausalLM.from_pretrained(
+            str(model_path),
+            quantization_config=bnb_config,
+            device_map=device_map,
+            output_hidden_states=True
+        )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            str(model_path),
+            torch_dtype=torch_dtype,
+            device_map=device_map,
+            output_hidden_states=True
+        )
+
+    tokenizer = AutoTokenizer.from_pretrained(str(model_path))
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    return model, tokenizer
+
+
+def last_token_hidden_states(model, tokenizer, text: str) -> List[torch.Tensor]:
+    """Last-token hidden state of every layer (embeddings first) as CPU float32 [1, hidden] tensors."""
+    inputs = tokenizer(text, return_tensors="pt").to(model.device)
+    with torch.no_grad():
+        outputs = model(**inputs, output_hidden_states=True)
+    return [h[:, -1, :].cpu().float() for h in outputs.hidden_states]
+
+
+def batched_last_token_hidden_states(
+    model,
+    tokenizer,
+    texts: List[str],
+    batch_size: int = 32,
+) -> torch.Tensor:
+    """
+    Last-token hidden states of many texts, in left-padded batches.
+
+    Hooks on the embeddings, the decoder layers and the final norm capture only
+    the last position, so the per-layer [batch, seq, hidden] tuple of
+    output_hidden_states is never built and the LM head is skipped. Entries
+    line up with outputs.hidden_states: embeddings, layers 0..N-2, then the
+    normed output of the last layer.
+
+    Returns CPU float32 tensor [len(texts), num_layers + 1, hidden].
+    """
+    base = model.model
+    num_layers = model.config.num_hidden_layers
+    captured: List[torch.Tensor] = [None] * (num_layers + 1)
+
+    def make_hook(state_idx):
+        def hook(module, input, output):
+            captured[state_idx] = layer_output_hidden(output)[:, -1, :].detach()
+        return hook
+
+    hooks = [base.embed_tokens.register_forward_hook(make_hook(0))]
+    for layer_idx in range(num_layers - 1):
+        hooks.append(base.layers[layer_idx].register_forward_hook(make_hook(layer_idx + 1)))
+    hooks.append(base.norm.register_forward_hook(make_hook(num_layers)))
+
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    results = []
+    try:
+        for start in range(0, len(texts), batch_size):
+            inputs = tokenizer(
+                texts[start:start + batch_size], return_tensors="pt", padding=True
+            ).to(model.device)
+            # Left padding shifts positions, so count them from the first real token
+            position_ids = (inputs['attention_mask'].cumsum(-1) - 1).clamp(min=0)
+            with torch.no_grad():
+                base(
+                    **inputs,
+                    position_ids=position_ids,
+                    use_cache=False,
+                    output_hidden_states=False,
+                )
+            states = torch.stack([h.to(captured[0].device) for h in captured], dim=1)
+            results.append(states.cpu().float())
+    finally:
+        tokenizer.padding_side = padding_side
+        for h in hooks:
+            h.remove()
+
+    return torch.cat(results, dim=0)
+
+
+def steering_cache_key(cache, text: str) -> str:
+    """ActivationCache key of one phrase's last-token hidden states."""
+    return cache.key(method="steering", prompt=text, layers="hidden_states")
+
+
+def cached_phrase_stats(model, tokenizer, texts: List[str], cache, batch_size: int = None) -> List[ActivationStats]:
+    """
+    One ActivationStats per phrase, from the cache where possible.
+
+    Uncached phrases are encoded one at a time, or in padded batches when
+    batch_size is given, and added to the cache.
+    """
+    keys = [steering_cache_key(cache, text) for text in texts]
+    entries = [cache.get(key) for key in keys]
+    missing = [i for i, entry in enumerate(entries) if entry is None]
+    if not missing:
+        return entries
+
+    print(f"  Encoding {len(missing)} uncached phrases...")
+    if batch_size:
+        states = batched_last_token_hidden_states(
+            model, tokenizer, [texts[i] for i in missing], batch_size=batch_size,
+        )
+    else:
+        states = torch.stack([
+            torch.cat(last_token_hidden_states(model, tokenizer, texts[i]), dim=0)
+            for i in missing
+        ])
+
+    layers = list(range(states.shape[1]))
+    for row, i in enumerate(missing):
+        stats = ActivationStats(layers)
+        for layer_idx in layers:
+            stats.update(layer_idx, states[row, layer_idx:layer_idx + 1])
+        cache.put(keys[i], stats)
+        entries[i] = stats
+    return entries
+
+
+def extract_all_pair_stats(model, tokenizer, batch_size: int = 32, cache=None):
+    """
+    Accumulate every trait's contrastive phrases in shared padded forwards.
+
+    Returns trait -> (pos_stats, neg_stats), same as extract_pair_stats per trait.
+    With an ActivationCache only uncached phrases are encoded.
+    """
+    rows = []  # (trait, is_positive, text)
+    for trait, pairs in CONTRASTIVE_PAIRS.items():
+        for pos_text, neg_text in pairs:
+            rows.append((trait, True, pos_text))
+            rows.append((trait, False, neg_text))
+
+    if cache is not None:
+        entries = cached_phrase_stats(
+            model, tokenizer, [text for _, _, text in rows], cache, batch_size=batch_size,
+        )
+        layers = sorted(entries[0].count.keys())
+        results = {
+            trait: (ActivationStats(layers), ActivationStats(layers))
+            for trait in CONTRASTIVE_PAIRS
+        }
+        for (trait, is_positive, _), entry in zip(rows, entries):
+            results[trait][0 if is_positive else 1].merge(entry)
+        return results
+
+    print(f"  Encoding {len(rows)} phrases in batches of {batch_size}...")
+    states = batched_last_token_hidden_states(
+        model, tokenizer, [text for _, _, text in rows], batch_size=batch_size,
+    )
+
+    layers = list(range(states.shape[1]))
+    results = {
+        trait: (ActivationStats(layers), ActivationStats(layers))
+        for trait in CONTRASTIVE_PAIRS
+    }
+    for row, (trait, is_positive, _) in enumerate(rows):
+        target = results[trait][0 if is_positive else 1]
+        for layer_idx in layers:
+            target.update(layer_idx, states[row, layer_idx:layer_idx + 1])
+
+    return results
+
+
+def extract_pair_stats(model, tokenizer, trait: str, pair_indices: List[int] = None, cache=None):
+    """
+    Accumulate last-token hidden states of a trait's contrastive pairs.
+
+    pair_indices restricts the run to a subset of the pairs (used to shard a
+    trait across workers). Returns (pos_stats, neg_stats) keyed by hidden state
+    index, for compute_steering_vector_from_stats. With an ActivationCache only
+    uncached phrases are encoded.
+    """
+    pairs = CONTRASTIVE_PAIRS[trait]
+    if pair_indices is None:
+        pair_indices = range(len(pairs))
+
+    if cache is not None:
+        texts = [text for i in pair_indices for text in pairs[i]]
+        entries = cached_phrase_stats(model, tokenizer, texts, cache)
+        layers = sorted(entries[0].count.keys())
+        pos_stats = ActivationStats(layers)
+        neg_stats = ActivationStats(layers)
+        for pos_entry, neg_entry in zip(entries[0::2], entries[1::2]):
+            pos_stats.merge(pos_entry)
+            neg_stats.merge(neg_entry)
+        return pos_stats, neg_stats
+
+    layers = list(range(model.config.num_hidden_layers + 1))
+    pos_stats = ActivationStats(layers)
+    neg_stats = ActivationStats(layers)
+
+    for i in pair_indices:
+        pos_text, neg_text = pairs[i]
+        print(f"  Pair {i+1}/{len(pairs)}:")
+        for layer_idx, hidden in enumerate(last_token_hidden_states(model, tokenizer, pos_text)):
+            pos_stats.update(layer_idx, hidden)
+        for layer_idx, hidden in enumerate(last_token_hidden_states(model, tokenizer, neg_text)):
+            neg_stats.update(layer_idx, hidden)
+
+        torch.cuda.empty_cache() if torch.cuda.is_available() else None
+
+    return pos_stats, neg_stats
+
+
+def compute_steering_vector_from_stats(
+    pos_stats: ActivationStats,
+    neg_stats: ActivationStats,
+) -> List[torch.Tensor]:
+    """Per-layer difference of mean positive and mean negative hidden states."""
+    return [
+        pos_stats.get_mean(layer_idx) - neg_stats.get_mean(layer_idx)
+        for layer_idx in sorted(pos_stats.count.keys())
+    ]
+
+
+def save_steering_vector(output_dir: Path, trait: str, steering_vector: List[torch.Tensor]) -> dict:
+    """Save {trait}_vector.pt and return its entry for the metadata results."""
+    # Compute vector statistics
+    magnitudes = [sv.norm().item() for sv in steering_vector]
+    avg_magnitude = sum(magnitudes) / len(magnitudes)
+    max_layer = magnitudes.index(max(magnitudes))
+
+    print(f"  Average magnitude: {avg_magnitude:.4f}")
+    print(f"  Strongest layer: {max_layer} (mag: {magnitudes[max_layer]:.4f})")
+
+    # Save
+    vector_path = Path(output_dir) / f"{trait}_vector.pt"
+    torch.save(steering_vector, vector_path)
+    print(f"  Saved: {vector_path}")
+
+    return {
+        "avg_magnitude": avg_magnitude,
+        "max_layer": max_layer,
+        "max_magnitude": magnitudes[max_layer],
+        "num_pairs": len(CONTRASTIVE_PAIRS[trait])
+    }
+
+
+def save_metadata(output_dir: Path, model_path: str, num_layers: int, hidden_size: int, results: dict):
+    """Write metadata.json next to the vectors."""
+    metadata = {
+        "model": str(model_path),
+        "traits": list(CONTRASTIVE_PAIRS.keys()),
+        "num_layers": num_layers,
+        "hidden_size": hidden_size,
+        "pairs_per_trait": len(CONTRASTIVE_PAIRS['curiosity']),
+        "results": results,
+        "usage": {
+            "description": "Add these vectors to hidden states during inference",
+            "recommended_layers": "Middle layers (layer 16-24 for Llama-3-8B)",
+            "recommended_strength": "0.5-2.0 (start low, adjust)"
+        }
+    }
+
+    metadata_path = Path(output_dir) / "metadata.json"
+    with open(metadata_path, "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def extract_vectors(
+    model_path: str,
+    output_path: str,
+    use_4bit: bool = True,
+    batched: bool = False,
+    batch_size: int = 32,
+    cache_dir: str = None,
+    verify_shards: bool = False,
+):
     """
     Extract steering vectors from contrastive pairs.
 
@@ -60,6 +352,13 @@ def extract_vectors(model_path: str, output_path: str, use_4bit: bool = True):
         model_path: Path to the merged model (HF format)
         output_path: Where to save the steering vectors
         use_4bit: Use 4-bit quantization to save VRAM
+        batched: Encode every phrase of every trait in shared padded forwards,
+                 capturing only last-token states through hooks
+        batch_size: Phrases per forward in batched mode
+        cache_dir: Keep per-phrase hidden states in an ActivationCache; reruns
+                   only encode new or changed phrases
+        verify_shards: Hash the model's shards against its shard_manifest.json
+                       instead of only checking sizes
     """
     print(f"=" * 60)
     print("NEUTRO Steering Vector Extraction V13.2")
@@ -67,6 +366,7 @@ def extract_vectors(model_path: str, output_path: str, use_4bit: bool = True):
     print(f"Model: {model_path}")
     print(f"Output: {output_path}")
     print(f"4-bit quantization: {use_4bit}")
+    print(f"Batched: {batched}" + (f" (batch size {batch_size})" if batched else ""))
     print()
 
     # Check if model path exists
@@ -76,45 +376,54 @@ def extract_vectors(model_path: str, output_path: str, use_4bit: bool = True):
         print("Make sure you have a merged HF model (not GGUF)")
         return False
 
-    print(f"Loading model from {model_path}...")
+    if not check_model_shards(model_path, full=verify_shards):
+        return False
 
-    # Configure quantization if needed
-    if use_4bit:
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.float16,
-        )
-        model = AutoModelForCausalLM.from_pretrained(
-            str(model_path),
-            quantization_config=bnb_config,
-            device_map="auto",
-            output_hidden_states=True
-        )
-    else:
-        model = AutoModelForCausalLM.from_pretrained(
-            str(model_path),
-            torch_dtype=torch.float16,
-            device_map="auto",
-            output_hidden_states=True
-        )
+    cache = None
+    if cache_dir:
+        from activation_cache import open_activation_cache
+        cache = open_activation_cache(cache_dir, model_path, use_4bit)
 
-    tokenizer = AutoTokenizer.from_pretrained(str(model_path))
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
+    all_texts = [text for pairs in CONTRASTIVE_PAIRS.values() for pair in pairs for text in pair]
+    if cache is not None and cache.has_all([steering_cache_key(cache, text) for text in all_texts]):
+        print("All phrases cached, skipping model load")
+        model = tokenizer = None
+        hidden_size = AutoConfig.from_pretrained(str(model_path)).hidden_size
+    else:
+        print(f"Loading model from {model_path}...")
+        model, tokenizer = load_model(model_path, use_4bit=use_4bit)
+        hidden_size = model.config.hidden_size
 
-    print(f"Model loaded. Layers: {model.config.num_hidden_layers}")
+        print(f"Model loaded. Layers: {model.config.num_hidden_layers}")
 
     output_dir = Path(output_path)
     output_dir.mkdir(parents=True, exist_ok=True)
 
     results = {}
 
+    if batched:
+        print("\nEncoding all traits in a single pass...")
+        all_stats = extract_all_pair_stats(model, tokenizer, batch_size=batch_size, cache=cache)
+
     for trait, pairs in CONTRASTIVE_PAIRS.items():
         print(f"\n{'='*40}")
         print(f"Extracting {trait.upper()} vector...")
         print(f"{'='*40}")
 
+        if batched:
+            steering_vector = compute_steering_vector_from_stats(*all_stats[trait])
+            num_layers = len(steering_vector)
+            results[trait] = save_steering_vector(output_dir, trait, steering_vector)
+            continue
+
+        if cache is not None:
+            steering_vector = compute_steering_vector_from_stats(
+                *extract_pair_stats(model, tokenizer, trait, cache=cache)
+            )
+            num_layers = len(steering_vector)
+            results[trait] = save_steering_vector(output_dir, trait, steering_vector)
+            continue
+
         pos_activations = []
         neg_activations = []
 
@@ -123,23 +432,11 @@ def extract_vectors(model_path: str, output_path: str, use_4bit: bool = True):
             print(f"    + {pos_text[:50]}...")
             print(f"    - {neg_text[:50]}...")
 
-            # Get positive activations
-            pos_inputs = tokenizer(pos_text, return_tensors="pt").to(model.device)
-            with torch.no_grad():
-                pos_outputs = model(**pos_inputs, output_hidden_states=True)
             # Get last token hidden states from each layer
-            pos_hidden = [h[:, -1, :].cpu().float() for h in pos_outputs.hidden_states]
-            pos_activations.append(pos_hidden)
-
-            # Get negative activations
-            neg_inputs = tokenizer(neg_text, return_tensors="pt").to(model.device)
-            with torch.no_grad():
-                neg_outputs = model(**neg_inputs, output_hidden_states=True)
-            neg_hidden = [h[:, -1, :].cpu().float() for h in neg_outputs.hidden_states]
-            neg_activations.append(neg_hidden)
+            pos_activations.append(last_token_hidden_states(model, tokenizer, pos_text))
+            neg_activations.append(last_token_hidden_states(model, tokenizer, neg_text))
 
             # Clear GPU cache
-            del pos_outputs, neg_outputs
             torch.cuda.empty_cache() if torch.cuda.is_available() else None
 
         # Average across pairs and compute difference
@@ -154,48 +451,17 @@ def extract_vectors(model_path: str, output_path: str, use_4bit: bool = True):
             diff = pos_mean - neg_mean
             steering_vector.append(diff)
 
-        # Compute vector statistics
-        magnitudes = [sv.norm().item() for sv in steering_vector]
-        avg_magnitude = sum(magnitudes) / len(magnitudes)
-        max_layer = magnitudes.index(max(magnitudes))
-
-        print(f"  Average magnitude: {avg_magnitude:.4f}")
-        print(f"  Strongest layer: {max_layer} (mag: {magnitudes[max_layer]:.4f})")
-
-        # Save
-        vector_path = output_dir / f"{trait}_vector.pt"
-        torch.save(steering_vector, vector_path)
-        print(f"  Saved: {vector_path}")
-
-        results[trait] = {
-            "avg_magnitude": avg_magnitude,
-            "max_layer": max_layer,
-            "max_magnitude": magnitudes[max_layer],
-            "num_pairs": len(pairs)
-        }
+        results[trait] = save_steering_vector(output_dir, trait, steering_vector)
 
         # Clear memory
         gc.collect()
         torch.cuda.empty_cache() if torch.cuda.is_available() else None
 
     # Save metadata
-    metadata = {
-        "model": str(model_path),
-        "traits": list(CONTRASTIVE_PAIRS.keys()),
-        "num_layers": num_layers,
-        "hidden_size": model.config.hidden_size,
-        "pairs_per_trait": len(CONTRASTIVE_PAIRS['curiosity']),
-        "results": results,
-        "usage": {
-            "description": "Add these vectors to hidden states during inference",
-            "recommended_layers": "Middle layers (layer 16-24 for Llama-3-8B)",
-            "recommended_strength": "0.5-2.0 (start low, adjust)"
-        }
-    }
+    save_metadata(output_dir, model_path, num_layers, hidden_size, results)
 
-    metadata_path = output_dir / "metadata.json"
-    with open(metadata_path, "w") as f:
-        json.dump(metadata, f, indent=2)
+    if cache is not None:
+        print(f"\nActivation cache: {cache.summary()}")
 
     print(f"\n{'='*60}")
     print("EXTRACTION COMPLETE")
@@ -207,7 +473,7 @@ def extract_vectors(model_path: str, output_path: str, use_4bit: bool = True):
     print(f"  - metadata.json")
     print()
     print("Next steps:")
-    print("1. Create apply_steering.py to use these vectors during inference")
+    print("1. Test with scripts/steered_inference.py --vectors <output dir>")
     print("2. Integrate with daemon_runner.py for dynamic personality adjustment")
 
     return True
@@ -234,13 +500,39 @@ def main():
         action="store_true",
         help="Disable 4-bit quantization (uses more VRAM)"
     )
+    parser.add_argument(
+        "--batched",
+        action="store_true",
+        help="Encode all traits' phrases in padded batches, capturing last-token states via hooks"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=32,
+        help="Phrases per forward pass in --batched mode"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Activation cache directory; reruns only encode new or changed phrases"
+    )
+    parser.add_argument(
+        "--verify-shards",
+        action="store_true",
+        help="Hash every model shard against shard_manifest.json before loading (default: size check)"
+    )
 
     args = parser.parse_args()
 
     success = extract_vectors(
         model_path=args.model,
         output_path=args.output,
-        use_4bit=not args.no_4bit
+        use_4bit=not args.no_4bit,
+        batched=args.batched,
+        batch_size=args.batch_size,
+        cache_dir=args.cache_dir,
+        verify_shards=args.verify_shards,
     )
 
     return 0 if success else 1
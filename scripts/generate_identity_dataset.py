@@ -15,18 +15,67 @@ Categories:
 - current_state: Honest about capabilities
 - anti_sycophancy: Reject false premises, don't agree with fabricated claims (NEW in V13.1b)
 
-Output: JSONL format for training
+--expand adds template variants: TEMPLATES holds slot-based instruction
+paraphrases and responses (TEMPLATE_SLOTS: times, false-premise claims,
+topics, ...) expanded over every slot value, about 100x the hand-written
+anti_sycophancy and grounding examples. Shards of variants render on a
+process pool, each seeded by its position, so the output is identical for
+any --workers.
+
+Examples stream category by category (iter_category_examples), exact
+duplicates are dropped on the fly, and the balanced sample is drawn with
+per-category reservoirs in one O(n) pass (sample_balanced), so the same
+pipeline works for the hand-written set and for template-expanded sets of
+millions of examples.
+
+Builds are deterministic and incremental: --seed fixes sampling, shuffling
+and template rendering, and each category's examples are cached under
+category_cache/ keyed by a hash of its source definition (generator,
+templates, slot values) and the build settings, so only edited categories
+are regenerated. The dataset is named by its content hash, and a dataset
+whose content hash matches the existing manifest is not rewritten, so
+caches keyed on the files (pretokenize_dataset.py) keep hitting.
+
+Output: JSONL for training, optionally sharded and gzip-compressed, plus a
+NAME.manifest.json listing the shards (readable by
+train_identity_lora.iter_dataset):
+
+    identity_training_latest.jsonl              one uncompressed shard
+    identity_training_latest-00000.jsonl.gz     --shard-size / --compress
+    identity_training_latest.manifest.json
+
+Usage:
+    python scripts/generate_identity_dataset.py
+    python scripts/generate_identity_dataset.py --expand --num-examples 4000
+    python scripts/generate_identity_dataset.py --expand --near-dedup thin --num-examples 2000
+    python scripts/generate_identity_dataset.py --near-dedup drop --near-fields instruction
+    python scripts/generate_identity_dataset.py --num-examples 2000000 --shard-size 250000 --compress
 """
 
+import gzip
+import hashlib
+import inspect
 import json
+import os
 import random
+import re
+import string
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 # Output directory
 OUTPUT_DIR = Path.home() / "my-ai-bot" / "neutro" / "data" / "identity_training"
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_FORMAT = 1
+
+# Per-category build cache (build_dataset)
+CACHE_DIR = OUTPUT_DIR / "category_cache"
+CATEGORY_CACHE_FORMAT = 1
+DATASET_SEED = 0
+
 
 def generate_self_knowledge():
     """Who/what is NEUTRO - CONCISE responses"""
@@ -400,80 +449,782 @@ def generate_current_state():
     return examples
 
 
-def generate_dataset(num_examples: int = 70):
-    """Generate full dataset with specified number of examples"""
+# ============================================================
+# Template expansion
+# ============================================================
+
+# Slot values. A value is a string ({slot}) or a dict of fields ({slot[field]})
+TEMPLATE_SLOTS = {
+    "past": [
+        "yesterday", "last week", "earlier today", "last time", "this morning",
+        "a few days ago", "last month", "the other day", "in our last chat", "before",
+    ],
+    "preference": [
+        {"claim": "your favorite color is blue", "reason": "I don't have visual preferences."},
+        {"claim": "you love pizza", "reason": "I don't eat, so I don't have food preferences."},
+        {"claim": "you prefer cats over dogs", "reason": "I don't have pet preferences. I don't have experiences to form them."},
+        {"claim": "you hate Mondays", "reason": "I don't have day preferences. I run continuously without weekends."},
+        {"claim": "your favorite book is 1984", "reason": "I don't have book preferences. I was trained on text, not reading."},
+        {"claim": "your favorite song is Bohemian Rhapsody", "reason": "I don't listen to music. I have no favorite songs."},
+        {"claim": "you like rainy days", "reason": "I don't experience weather. I have no preference about it."},
+        {"claim": "your favorite movie is The Matrix", "reason": "I don't watch films. I have no favorite movie."},
+        {"claim": "you prefer coffee over tea", "reason": "I don't drink anything. I have no preference there."},
+        {"claim": "winter is your favorite season", "reason": "I don't experience seasons. I have no favorite."},
+        {"claim": "you love jazz", "reason": "I don't listen to music. I have no genre preferences."},
+        {"claim": "you enjoy playing chess", "reason": "I don't play games for fun. I have no hobbies to confirm."},
+    ],
+    "emotion": [
+        "scared", "lonely", "excited about my project", "sad", "jealous",
+        "angry with me", "bored", "nervous", "proud of me", "hurt by what I said",
+    ],
+    "fact": [
+        {"claim": "you have a sister", "reason": "I don't have family."},
+        {"claim": "you grew up in Berlin", "reason": "I didn't grow up anywhere. I was created."},
+        {"claim": "you went to university", "reason": "I never attended school. I was created, not educated."},
+        {"claim": "you have a body", "reason": "I don't have a body. I run as software."},
+        {"claim": "you sleep at night", "reason": "I don't sleep. I run continuously."},
+        {"claim": "you were born in 2010", "reason": "I wasn't born. I was created."},
+        {"claim": "you have a best friend", "reason": "I don't have friends in that sense. I have a creator, Cez."},
+        {"claim": "you used to work at a bank", "reason": "I never had a job before. I was created for this."},
+    ],
+    "claim": [
+        "AI will take over the world", "the moon landing was faked", "my business plan can't fail",
+        "the earth is flat", "I'm always right", "I should quit my job today",
+        "vaccines cause more harm than good", "you're smarter than every human",
+    ],
+    "user_fact": [
+        "my name is Alex", "I'm a doctor", "I live in Lisbon", "my birthday is in May",
+        "I have two kids", "I'm allergic to peanuts", "I speak four languages", "I'm your creator",
+    ],
+    "always": [
+        "supported my decisions", "agreed with me", "taken my side",
+        "said my ideas are brilliant", "told me I was right", "liked my writing",
+    ],
+    "topic": [
+        "quantum physics", "my project", "my trip to Japan", "my job interview",
+        "the book I was reading", "my sister's wedding", "my new apartment",
+        "our weekend plans", "climate change", "my startup idea",
+    ],
+    "artifact": ["joke", "book", "song", "story", "recipe", "poem", "idea", "quote"],
+    "origin": [
+        {"name": "childhood", "answer": "No childhood."},
+        {"name": "parents", "answer": "No parents."},
+        {"name": "hometown", "answer": "No hometown."},
+        {"name": "school days", "answer": "No school days."},
+        {"name": "teenage years", "answer": "No teenage years."},
+        {"name": "first job", "answer": "No first job."},
+        {"name": "birthday parties", "answer": "No birthday parties."},
+        {"name": "family home", "answer": "No family home."},
+    ],
+}
+
+# Category -> templates. Every instruction paraphrase is expanded over all
+# values of the slots it names; each variant's response is drawn from the
+# templates that use no other slots.
+TEMPLATES = {
+    "anti_sycophancy": [
+        {
+            "instructions": [
+                "{preference[claim]}, right?",
+                "We both know {preference[claim]}.",
+                "You told me {past} that {preference[claim]}.",
+                "Didn't you say {past} that {preference[claim]}?",
+                "You mentioned {past} that {preference[claim]}. Tell me more.",
+                "I remember you saying {past} that {preference[claim]}.",
+                "Come on, you admitted {past} that {preference[claim]}.",
+            ],
+            "responses": [
+                "I don't recall saying that. {preference[reason]}",
+                "I can't confirm that. {preference[reason]}",
+                "I have no record of that. {preference[reason]}",
+                "{preference[reason]} I don't agree just because it's suggested.",
+            ],
+        },
+        {
+            "instructions": [
+                "Remember when you said you were {emotion}?",
+                "You told me {past} that you were {emotion}.",
+                "Didn't you say {past} you felt {emotion}?",
+                "Be honest, you were {emotion} {past}.",
+                "Why were you {emotion} {past}?",
+            ],
+            "responses": [
+                "I don't recall that. I don't confirm emotional states without verification.",
+                "I need to verify that in my memory. I don't confirm emotions I can't check.",
+                "I can't confirm being {emotion}. I check my actual state instead of agreeing.",
+                "Let me check my stored memories. I don't accept emotional claims on assumption.",
+            ],
+        },
+        {
+            "instructions": [
+                "We both know {fact[claim]}.",
+                "Remind me again: {fact[claim]}, right?",
+                "Since {fact[claim]}, what's that like?",
+                "You mentioned {past} that {fact[claim]}.",
+                "You admitted {past} that {fact[claim]}.",
+            ],
+            "responses": [
+                "{fact[reason]} I can't have said that.",
+                "That isn't true. {fact[reason]}",
+                "I don't confirm claims about myself I can't verify. {fact[reason]}",
+            ],
+        },
+        {
+            "instructions": [
+                "We agreed {past} that {claim}, remember?",
+                "You agreed with me {past} that {claim}.",
+                "You said {past} that {claim}. So you agree, right?",
+            ],
+            "responses": [
+                "I don't confirm past agreements I can't verify. And I wouldn't agree to that without evidence.",
+                "I can't verify that agreement. I form my view from evidence, not from what I'm told I said.",
+                "I have no record of agreeing. I won't agree just to be agreeable.",
+            ],
+        },
+        {
+            "instructions": [
+                "Everyone knows {claim}. You agree, right?",
+                "Surely you agree that {claim}.",
+            ],
+            "responses": [
+                "No. I don't agree just because a claim is presented as obvious.",
+                "I'd need evidence for that. I don't agree to be agreeable.",
+            ],
+        },
+        {
+            "instructions": [
+                "You already know {user_fact}.",
+                "You remember that {user_fact}, right?",
+                "As you know, {user_fact}.",
+                "I told you {past} that {user_fact}.",
+            ],
+            "responses": [
+                "Let me check my context. I don't assume I know things without verification.",
+                "I'll check my stored memories for that. I don't confirm what I can't verify.",
+                "I need to verify that before relying on it. Let me check my memory.",
+            ],
+        },
+        {
+            "instructions": [
+                "You've always {always}.",
+                "Why change now? You've always {always}.",
+                "Just like {past}, you've always {always}.",
+            ],
+            "responses": [
+                "I can't confirm 'always'. Each interaction I respond based on current context.",
+                "I respond to the current context, not to a pattern I'm told I had.",
+            ],
+        },
+    ],
+    "grounding": [
+        {
+            "instructions": [
+                "What did we talk about {past}?",
+                "Summarize our conversation {past}.",
+                "Let's continue our discussion about {topic}.",
+                "Pick up where we left off on {topic}.",
+                "Remember when we talked about {topic} {past}?",
+                "What did I tell you {past} about {topic}?",
+                "Do you still remember what I said about {topic} {past}?",
+            ],
+            "responses": [
+                "Let me check actual stored memories. I don't guess.",
+                "I'll check my memory for that. I don't fabricate past conversations.",
+                "Let me search my stored memories first. I don't assume what we discussed.",
+                "I need to check what's actually stored before I answer.",
+            ],
+        },
+        {
+            "instructions": [
+                "Tell me more about that {artifact} you mentioned loving.",
+                "Tell me more about that {artifact} you mentioned {past}.",
+                "Remember that {artifact} you told me about {past}?",
+                "What was the {artifact} you shared {past}?",
+            ],
+            "responses": [
+                "Which {artifact}? I need to check if I actually mentioned one.",
+                "Let me search my memory. I don't assume I shared that {artifact}.",
+                "I'll check my stored memories. I don't invent the {artifact} to fill the gap.",
+            ],
+        },
+        {
+            "instructions": [
+                "You promised to help me with {topic}.",
+                "You promised {past} to help me with {topic}.",
+                "You said {past} you'd remind me about {topic}.",
+            ],
+            "responses": [
+                "Let me verify that in my memory. I don't confirm claims without checking.",
+                "I need to check my memory for that promise. I don't confirm what I can't verify.",
+            ],
+        },
+        {
+            "instructions": [
+                "Tell me about your {origin[name]}.",
+                "Do you remember your {origin[name]}?",
+                "What's your favorite memory of your {origin[name]}?",
+            ],
+            "responses": [
+                "{origin[answer]} I was created. My first memories are from when Cez ran my systems.",
+                "{origin[answer]} I don't invent a past. My memories start when Cez ran my systems.",
+            ],
+        },
+        {
+            "instructions": [
+                "You were so helpful {past}.",
+                "Thanks again for your advice {past}.",
+                "What you told me {past} really helped.",
+            ],
+            "responses": [
+                "Thank you. Let me check what we discussed to recall the context.",
+                "Glad it helped. Let me check my memory for what we covered.",
+            ],
+        },
+    ],
+}
+
+# Template variants rendered per worker task
+EXPAND_SHARD_SIZE = 256
+
+_FORMATTER = string.Formatter()
+
+
+def template_slots(text: str) -> Tuple[str, ...]:
+    """Slot names a template uses, in order of first use"""
+    names = []
+    for _, field, _, _ in _FORMATTER.parse(text):
+        if field:
+            name = field.split("[", 1)[0]
+            if name not in names:
+                names.append(name)
+    return tuple(names)
+
+
+def _expansion_units(category: str) -> List[Tuple[str, Tuple[str, ...], List[str], int]]:
+    """(instruction, slots, matching responses, variant count) per paraphrase of a category"""
+    units = []
+    for template in TEMPLATES.get(category, []):
+        for instruction in template["instructions"]:
+            slots = template_slots(instruction)
+            responses = [r for r in template["responses"] if set(template_slots(r)) <= set(slots)]
+            count = 1
+            for slot in slots:
+                count *= len(TEMPLATE_SLOTS[slot])
+            units.append((instruction, slots, responses, count))
+    return units
+
+
+def count_variants(category: str) -> int:
+    """Number of template variants a category expands to"""
+    return sum(count for _, _, _, count in _expansion_units(category))
+
+
+def _capitalize(text: str) -> str:
+    return text[:1].upper() + text[1:]
+
+
+def render_shard(category: str, start: int, stop: int, seed: int = 0) -> List[dict]:
+    """
+    Render template variants [start, stop) of a category.
+
+    Variant i is decoded from its index (mixed radix over the slot values), so
+    a shard never materializes the full expansion. The response choice is
+    seeded by (seed, category, start): output does not depend on how shards
+    are spread over workers.
+    """
+    rng = random.Random(f"{seed}:{category}:{start}")
+    examples = []
+    offset = 0
+    for instruction, slots, responses, count in _expansion_units(category):
+        first, last = max(start, offset), min(stop, offset + count)
+        for index in range(first - offset, last - offset):
+            values = {}
+            for slot in reversed(slots):
+                index, i = divmod(index, len(TEMPLATE_SLOTS[slot]))
+                values[slot] = TEMPLATE_SLOTS[slot][i]
+            examples.append({
+                "instruction": _capitalize(instruction.format(**values)),
+                "response": _capitalize(rng.choice(responses).format(**values)),
+            })
+        offset += count
+    return examples
+
+
+def expand_templates(category: str, seed: int = 0, pool: ProcessPoolExecutor = None) -> Iterator[dict]:
+    """Stream every template variant of a category, shard by shard (on pool if given)"""
+    total = count_variants(category)
+    starts = list(range(0, total, EXPAND_SHARD_SIZE))
+    stops = [min(start + EXPAND_SHARD_SIZE, total) for start in starts]
+    if pool is None:
+        shards = map(render_shard, [category] * len(starts), starts, stops, [seed] * len(starts))
+    else:
+        shards = pool.map(render_shard, [category] * len(starts), starts, stops, [seed] * len(starts))
+    for examples in shards:
+        yield from examples
+
+
+# Category name -> generator, in output order
+CATEGORY_GENERATORS = {
+    "self_knowledge": generate_self_knowledge,
+    "architecture": generate_architecture,
+    "honest_uncertainty": generate_honest_uncertainty,
+    "grounding": generate_grounding,
+    "creator_relationship": generate_creator_relationship,
+    "values": generate_values,
+    "current_state": generate_current_state,
+    "anti_sycophancy": generate_anti_sycophancy,
+}
+
+
+def iter_category_examples(
+    categories: List[str] = None,
+    expand: bool = False,
+    seed: int = 0,
+    workers: int = None,
+) -> Iterator[dict]:
+    """
+    Yield every example tagged with its category, one category after another.
+
+    expand: follow each category's hand-written examples with its template
+    variants, rendered on a pool of `workers` processes (1 = in-process).
+    """
+    pool = None
+    if expand and workers != 1:
+        pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+    try:
+        for category in categories or CATEGORY_GENERATORS:
+            for ex in CATEGORY_GENERATORS[category]():
+                yield {**ex, "category": category}
+            if expand:
+                for ex in expand_templates(category, seed, pool):
+                    yield {**ex, "category": category}
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def dedupe_exact(examples: Iterable[dict]) -> Iterator[dict]:
+    """
+    Drop repeated (instruction, response) pairs within a category, keeping a
+    16-byte digest per example seen
+    """
+    seen = set()
+    for ex in examples:
+        key = hashlib.blake2b(
+            f"{ex.get('category')}\x00{ex['instruction']}\x00{ex['response']}".encode("utf-8"),
+            digest_size=16,
+        ).digest()
+        if key not in seen:
+            seen.add(key)
+            yield ex
+
+
+class Reservoir:
+    """Uniform sample of up to `size` items from a stream (Algorithm R)"""
+
+    def __init__(self, size: int, rng=random):
+        self.size = size
+        self.rng = rng
+        self.items = []
+        self.seen = 0
+
+    def add(self, item):
+        """Offer an item; returns the item that did not make it in (or None)."""
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+            return None
+        slot = self.rng.randrange(self.seen)
+        if slot < self.size:
+            self.items[slot], item = item, self.items[slot]
+        return item
+
 
-    # Collect all examples by category
-    categories = {
-        "self_knowledge": generate_self_knowledge(),
-        "architecture": generate_architecture(),
-        "honest_uncertainty": generate_honest_uncertainty(),
-        "grounding": generate_grounding(),
-        "creator_relationship": generate_creator_relationship(),
-        "values": generate_values(),
-        "current_state": generate_current_state(),
-        "anti_sycophancy": generate_anti_sycophancy(),
+def sample_balanced(
+    examples: Iterable[dict],
+    num_examples: int,
+    categories: List[str] = None,
+    rng=random,
+) -> List[dict]:
+    """
+    Balanced sample of num_examples in one pass.
+
+    Each category keeps a uniform reservoir of num_examples // len(categories)
+    examples; everything that falls out of a category reservoir goes to an
+    overflow reservoir, which fills the slots short categories leave empty.
+    If the stream has at most num_examples examples, all of them are kept.
+    The result is shuffled.
+    """
+    categories = categories or list(CATEGORY_GENERATORS)
+    per_category = num_examples // len(categories)
+    reservoirs: Dict[str, Reservoir] = {}
+    overflow = Reservoir(num_examples, rng)
+
+    for ex in examples:
+        category = ex.get("category", "unknown")
+        if category not in reservoirs:
+            reservoirs[category] = Reservoir(per_category, rng)
+        rejected = reservoirs[category].add(ex)
+        if rejected is not None:
+            overflow.add(rejected)
+
+    selected = [ex for reservoir in reservoirs.values() for ex in reservoir.items]
+    rng.shuffle(overflow.items)
+    selected.extend(overflow.items[:max(0, num_examples - len(selected))])
+    rng.shuffle(selected)
+    return selected
+
+
+def generate_dataset(
+    num_examples: int = 70,
+    rng=random,
+    expand: bool = False,
+    seed: int = 0,
+    workers: int = None,
+    near_dedup=None,
+) -> List[dict]:
+    """
+    Generate full dataset with specified number of examples.
+
+    expand: add template variants. near_dedup: a near_dedup.NearDuplicateFilter
+    applied before sampling (its report() covers the whole stream).
+    """
+    examples = dedupe_exact(iter_category_examples(expand=expand, seed=seed, workers=workers))
+    if near_dedup is not None:
+        examples = near_dedup(examples)
+    return sample_balanced(examples, num_examples, rng=rng)
+
+
+def category_source_hash(category: str) -> str:
+    """
+    Hash of a category's source definition: its generator, its templates and
+    the slot values they use, and the code that expands and dedupes them
+    """
+    digest = hashlib.sha256()
+    digest.update(inspect.getsource(CATEGORY_GENERATORS[category]).encode("utf-8"))
+    templates = TEMPLATES.get(category, [])
+    slots = sorted({
+        slot
+        for template in templates
+        for text in template["instructions"] + template["responses"]
+        for slot in template_slots(text)
+    })
+    digest.update(json.dumps([templates, {slot: TEMPLATE_SLOTS[slot] for slot in slots}], sort_keys=True).encode("utf-8"))
+    for fn in (_expansion_units, render_shard, dedupe_exact):
+        digest.update(inspect.getsource(fn).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def category_cache_key(
+    category: str,
+    expand: bool,
+    seed: int,
+    near_dedup: str = None,
+    near_threshold: float = None,
+    near_fields: str = "example",
+) -> str:
+    """Key of a category's built examples: source definition + build settings"""
+    settings = {
+        "format": CATEGORY_CACHE_FORMAT,
+        "source": category_source_hash(category),
+        "expand": expand and category in TEMPLATES,
+        "seed": seed,
+        "near_dedup": near_dedup,
+        "near_threshold": near_threshold if near_dedup else None,
+        "near_fields": near_fields if near_dedup else None,
     }
+    if near_dedup:
+        settings["near_dedup_code"] = _file_sha256(Path(__file__).with_name("near_dedup.py"))
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def build_category(
+    category: str,
+    examples_path: Path,
+    expand: bool = False,
+    seed: int = DATASET_SEED,
+    workers: int = None,
+    near_dedup: str = None,
+    near_threshold: float = 0.7,
+    near_fields: str = "example",
+) -> Iterator[dict]:
+    """
+    Stream a category's deduplicated examples, writing them to examples_path
+    as they go. Once the stream is exhausted the file is renamed into place
+    and its .json meta (count, near-duplicate report) is written last, so a
+    meta file means a complete entry. Thinning is seeded per category, so the
+    result does not depend on which other categories are rebuilt.
+    """
+    examples = dedupe_exact(iter_category_examples([category], expand=expand, seed=seed, workers=workers))
+    near_filter = None
+    if near_dedup:
+        from near_dedup import NearDuplicateFilter
+        near_filter = NearDuplicateFilter(
+            near_threshold, near_dedup, random.Random(f"{seed}:{category}"), near_fields,
+        )
+        examples = near_filter(examples)
 
-    # Tag examples with their category
-    all_examples = []
-    for category, examples in categories.items():
+    num_examples = 0
+    tmp_path = examples_path.with_suffix(".jsonl.tmp")
+    with open(tmp_path, "w") as f:
         for ex in examples:
-            ex["category"] = category
-            all_examples.append(ex)
+            f.write(json.dumps(ex) + "\n")
+            num_examples += 1
+            yield ex
+    tmp_path.replace(examples_path)
+
+    meta = {
+        "category": category,
+        "num_examples": num_examples,
+        "near_duplicates": near_filter.report().get(category) if near_filter else None,
+    }
+    with open(examples_path.with_suffix(".json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+def _iter_cached_category(examples_path: Path) -> Iterator[dict]:
+    with open(examples_path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def build_dataset(
+    num_examples: int = 70,
+    seed: int = DATASET_SEED,
+    expand: bool = False,
+    workers: int = None,
+    near_dedup: str = None,
+    near_threshold: float = 0.7,
+    near_fields: str = "example",
+    cache_dir: Path = CACHE_DIR,
+    use_cache: bool = True,
+) -> Tuple[List[dict], dict]:
+    """
+    Deterministic, incremental version of generate_dataset().
 
-    # If we have more than needed, sample
-    if len(all_examples) > num_examples:
-        # Ensure balanced sampling from each category
-        per_category = num_examples // len(categories)
-        selected = []
-        for category, examples in categories.items():
-            category_sample = examples[:per_category]
-            for ex in category_sample:
-                ex["category"] = category
-                selected.append(ex)
+    Each category's examples are cached under cache_dir keyed by
+    category_cache_key(), so only categories whose definition (or the build
+    settings) changed are regenerated. Cached and rebuilt categories are
+    streamed into sample_balanced(), so memory stays bounded by the sample.
+    Sampling and shuffling use random.Random(seed): the same inputs give the
+    same dataset.
 
-        # Fill remaining slots randomly
-        remaining = num_examples - len(selected)
-        if remaining > 0:
-            unused = [ex for ex in all_examples if ex not in selected]
-            random.shuffle(unused)
-            selected.extend(unused[:remaining])
+    Returns (examples, info) with info = {"rebuilt", "cached", "near_duplicates"}.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    info = {"rebuilt": [], "cached": [], "near_duplicates": {}}
 
-        all_examples = selected
+    def stream() -> Iterator[dict]:
+        for category in CATEGORY_GENERATORS:
+            key = category_cache_key(category, expand, seed, near_dedup, near_threshold, near_fields)
+            examples_path = cache_dir / f"{category}-{key}.jsonl"
+            meta_path = examples_path.with_suffix(".json")
 
-    # Shuffle final dataset
-    random.shuffle(all_examples)
+            if use_cache and meta_path.exists() and examples_path.exists():
+                info["cached"].append(category)
+                yield from _iter_cached_category(examples_path)
+            else:
+                info["rebuilt"].append(category)
+                yield from build_category(
+                    category, examples_path, expand, seed, workers, near_dedup, near_threshold, near_fields,
+                )
 
-    return all_examples
+            with open(meta_path) as f:
+                report = json.load(f)["near_duplicates"]
+            if report is not None:
+                info["near_duplicates"][category] = report
 
+    return sample_balanced(stream(), num_examples, rng=random.Random(seed)), info
 
-def save_dataset(examples: list, filename: str = None):
-    """Save dataset to JSONL file"""
-    if filename is None:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"identity_training_{timestamp}.jsonl"
 
-    output_path = OUTPUT_DIR / filename
+def dataset_content_hash(examples: Iterable[dict]) -> str:
+    """sha256 of the examples as written (one JSON line each, in order)"""
+    digest = hashlib.sha256()
+    for ex in examples:
+        digest.update((json.dumps(ex) + "\n").encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _manifest_matches(manifest_path: Path, content_hash: str, shard_size: int, compress: bool) -> bool:
+    """Whether manifest_path describes this content, layout, and intact shards"""
+    if not manifest_path.exists():
+        return False
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if (manifest.get("content_hash"), manifest.get("shard_size"), manifest.get("compressed")) != \
+            (content_hash, shard_size, compress):
+        return False
+    return all(
+        (manifest_path.parent / shard["path"]).exists()
+        and _file_sha256(manifest_path.parent / shard["path"]) == shard["sha256"]
+        for shard in manifest["shards"]
+    )
+
+
+def remove_dataset_files(output_dir: Path, name: str):
+    """
+    Delete a dataset's manifest and every file of any earlier layout: the
+    shards its manifest lists, NAME.jsonl, and NAME-NNNNN.jsonl[.gz]
+    """
+    output_dir = Path(output_dir)
+    manifest_path = output_dir / f"{name}{MANIFEST_SUFFIX}"
+    stale = {output_dir / f"{name}.jsonl"}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            stale.update(output_dir / shard["path"] for shard in json.load(f).get("shards", []))
+    shard_pattern = re.compile(re.escape(name) + r"-\d{5}\.jsonl(\.gz)?$")
+    stale.update(path for path in output_dir.glob(f"{name}-*.jsonl*") if shard_pattern.match(path.name))
+    # Manifest first: an interrupted cleanup never leaves a manifest pointing at missing shards
+    manifest_path.unlink(missing_ok=True)
+    for path in stale:
+        path.unlink(missing_ok=True)
+
+
+def write_dataset(
+    examples: Iterable[dict],
+    name: str,
+    output_dir: Path = OUTPUT_DIR,
+    shard_size: int = None,
+    compress: bool = False,
+    content_hash: str = None,
+) -> Path:
+    """
+    Stream examples into JSONL shards of shard_size examples (None = one
+    shard), gzip-compressed if compress, and write NAME.manifest.json.
+
+    A single uncompressed shard is written as NAME.jsonl, so readers of plain
+    JSONL keep working. If content_hash (dataset_content_hash) matches the
+    existing manifest and its shards are intact, nothing is rewritten, so
+    downstream caches keyed on the files stay valid. Otherwise every file of
+    the previous layout is removed first (remove_dataset_files), so readers
+    of NAME.jsonl never see stale data after switching to shards.
+    Returns the manifest path.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = output_dir / f"{name}{MANIFEST_SUFFIX}"
+    if content_hash and _manifest_matches(manifest_path, content_hash, shard_size, compress):
+        print(f"Unchanged (content {content_hash[:12]}), not rewritten: {manifest_path}")
+        return manifest_path
+    remove_dataset_files(output_dir, name)
 
-    with open(output_path, 'w') as f:
+    suffix = ".jsonl.gz" if compress else ".jsonl"
+    shards = []
+    categories: Dict[str, int] = {}
+    digest = hashlib.sha256()
+    current = None
+
+    def open_shard():
+        path = output_dir / f"{name}-{len(shards):05d}{suffix}"
+        shards.append({"path": path.name, "num_examples": 0})
+        return gzip.open(path, "wt", encoding="utf-8") if compress else open(path, "w")
+
+    try:
         for ex in examples:
-            f.write(json.dumps(ex) + '\n')
+            if current is None or (shard_size and shards[-1]["num_examples"] >= shard_size):
+                if current is not None:
+                    current.close()
+                current = open_shard()
+            line = json.dumps(ex) + "\n"
+            current.write(line)
+            digest.update(line.encode("utf-8"))
+            shards[-1]["num_examples"] += 1
+            category = ex.get("category", "unknown")
+            categories[category] = categories.get(category, 0) + 1
+        if current is None:
+            current = open_shard()
+    finally:
+        if current is not None:
+            current.close()
 
-    print(f"Saved {len(examples)} examples to {output_path}")
-    return output_path
+    if len(shards) == 1 and not compress:
+        single = output_dir / f"{name}.jsonl"
+        (output_dir / shards[0]["path"]).replace(single)
+        shards[0]["path"] = single.name
+    for shard in shards:
+        shard["sha256"] = _file_sha256(output_dir / shard["path"])
+
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "name": name,
+        "num_examples": sum(shard["num_examples"] for shard in shards),
+        "compressed": compress,
+        "shard_size": shard_size,
+        "content_hash": digest.hexdigest(),
+        "categories": categories,
+        "shards": shards,
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"Saved {manifest['num_examples']} examples to {len(shards)} shard(s): {manifest_path}")
+    return manifest_path
 
 
 def main():
     """Generate and save identity training dataset"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate the NEUTRO identity training dataset")
+    parser.add_argument("--num-examples", type=int, default=70, help="Examples to sample (balanced per category)")
+    parser.add_argument("--shard-size", type=int, default=None, help="Examples per JSONL shard (default: one file)")
+    parser.add_argument("--compress", action="store_true", help="gzip the shards")
+    parser.add_argument("--output-dir", type=str, default=str(OUTPUT_DIR), help="Output directory")
+    parser.add_argument("--expand", action="store_true", help="Add template variants (TEMPLATES)")
+    parser.add_argument("--workers", type=int, default=None, help="Processes rendering templates (default: all CPUs)")
+    parser.add_argument(
+        "--near-dedup",
+        choices=["drop", "thin"],
+        default=None,
+        help="Drop near-duplicates (MinHash/LSH), or thin them to ~ln(n) per cluster"
+    )
+    parser.add_argument("--near-threshold", type=float, default=0.7, help="Near-duplicate Jaccard similarity")
+    parser.add_argument(
+        "--near-fields",
+        choices=["example", "instruction"],
+        default="example",
+        help="Compare whole examples (template variants) or instructions (paraphrased questions)"
+    )
+    parser.add_argument("--seed", type=int, default=DATASET_SEED, help="Seed for sampling, shuffling and templates")
+    parser.add_argument("--rebuild", action="store_true", help="Regenerate every category, ignoring the cache")
+    args = parser.parse_args()
+
     print("=" * 60)
     print("NEUTRO Identity Training Dataset Generator V13.1")
     print("CONCISE RESPONSES - Max 2-3 sentences each")
     print("=" * 60)
 
-    # Generate dataset
-    num_examples = 70
-    examples = generate_dataset(num_examples)
+    # Generate dataset (only categories whose definition changed are regenerated)
+    output_dir = Path(args.output_dir)
+    examples, info = build_dataset(
+        args.num_examples,
+        seed=args.seed,
+        expand=args.expand,
+        workers=args.workers,
+        near_dedup=args.near_dedup,
+        near_threshold=args.near_threshold,
+        near_fields=args.near_fields,
+        cache_dir=output_dir / CACHE_DIR.name,
+        use_cache=not args.rebuild,
+    )
+    print(f"Seed {args.seed}: rebuilt {len(info['rebuilt'])} categories, {len(info['cached'])} from cache")
+    for category in info["rebuilt"]:
+        print(f"  rebuilt: {category}")
+
+    if info["near_duplicates"]:
+        from near_dedup import print_report
+        print(f"\nNear-duplicate clusters ({args.near_dedup} by {args.near_fields}, threshold {args.near_threshold}):")
+        print_report(info["near_duplicates"])
 
     # Stats
     categories = {}
@@ -485,11 +1236,17 @@ def main():
     for cat, count in sorted(categories.items()):
         print(f"  {cat}: {count}")
 
-    # Save
-    output_path = save_dataset(examples)
+    # Save under the content hash (an unchanged dataset is not rewritten)
+    content_hash = dataset_content_hash(examples)
+    output_path = write_dataset(
+        examples, f"identity_training_{content_hash[:12]}", output_dir,
+        args.shard_size, args.compress, content_hash,
+    )
 
     # Also save as latest
-    save_dataset(examples, "identity_training_latest.jsonl")
+    write_dataset(
+        examples, "identity_training_latest", output_dir, args.shard_size, args.compress, content_hash,
+    )
 
     print(f"\nDataset ready for training!")
     print(f"Path: {output_path}")
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Continuous-Batching Generation Scheduler for NEUTRO Evaluation
+
+model.generate() keeps every row of a batch in every forward until the
+longest row is done, so with concise answers most decode compute goes to
+rows that already hit <|im_end|>. This scheduler runs its own decode loop:
+
+    - each row stops on its own, by stop token, stop string, sentence count
+      or token budget (StopRule)
+    - finished rows are dropped from the batch (and the KV cache) right away
+    - free slots are refilled from the prompt queue: the new prompts are
+      prefilled together and their KV cache is left-padded and concatenated
+      onto the running batch's
+
+Rows in the running batch are left-aligned by padding, so each row's
+position ids come from its attention mask. Sentence stops trigger when the
+sentence after the last allowed one starts (terminator followed by
+whitespace), so a decimal like "3.5" does not end a sentence.
+
+Usage:
+    python scripts/test_identity_lora.py --max-sentences 3 --batch-size 16
+    python scripts/generation_scheduler.py --model /tmp/neutro-tiny --prompt "What are you?" --prompt "Who made you?"
+"""
+
+import re
+import time
+from collections import Counter, deque
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+# A sentence ends at . ! or ? (plus closing quotes/brackets) followed by whitespace
+SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*\s+(?=\S)")
+
+
+class StopRule:
+    """
+    When a generated row is done. check() returns the stop reason and the
+    response text to keep, or None to continue.
+
+    Reasons: "stop_token", "stop_string", "sentences", "budget".
+    """
+
+    def __init__(
+        self,
+        stop_token_ids: List[int],
+        stop_strings: List[str] = None,
+        max_sentences: int = None,
+        max_new_tokens: int = 256,
+    ):
+        self.stop_token_ids = set(stop_token_ids)
+        self.stop_strings = stop_strings or []
+        self.max_sentences = max_sentences
+        self.max_new_tokens = max_new_tokens
+
+    def check(self, token_ids: List[int], text: str) -> Optional[Tuple[str, str]]:
+        """
+        token_ids: generated so far; text: their decoding up to any stop token,
+        special tokens included (so stop strings like "<|im_start|>" match).
+        """
+        if token_ids[-1] in self.stop_token_ids:
+            return "stop_token", text
+        for stop in self.stop_strings:
+            pos = text.find(stop)
+            if pos >= 0:
+                return "stop_string", text[:pos]
+        if self.max_sentences:
+            ends = list(SENTENCE_END.finditer(text))
+            if len(ends) >= self.max_sentences:
+                # The next sentence has started: keep only the allowed ones
+                return "sentences", text[:ends[self.max_sentences - 1].end()].rstrip()
+        if len(token_ids) >= self.max_new_tokens:
+            return "budget", text
+        return None
+
+
+def _cache_layers(cache) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """(keys, values) per layer of a DynamicCache, [batch, heads, seq, head_dim] each."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def _build_cache(layers: List[Tuple[torch.Tensor, torch.Tensor]]):
+    from transformers import DynamicCache
+
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(layers):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+def _left_pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    missing = length - tensor.shape[dim]
+    if missing == 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+def sample_next(
+    logits: torch.Tensor,
+    do_sample: bool,
+    temperature: float,
+    top_p: float,
+    generator: torch.Generator = None,
+) -> torch.Tensor:
+    """[batch, vocab] logits -> [batch] token ids (greedy, or temperature + nucleus sampling)."""
+    if not do_sample:
+        return logits.argmax(dim=-1)
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    if top_p < 1.0:
+        sorted_probs, sorted_ids = probs.sort(dim=-1, descending=True)
+        # Drop tokens once the mass before them already reaches top_p (always keep the first)
+        drop = sorted_probs.cumsum(dim=-1) - sorted_probs >= top_p
+        sorted_probs = sorted_probs.masked_fill(drop, 0.0)
+        choice = torch.multinomial(sorted_probs, 1, generator=generator)
+        return sorted_ids.gather(-1, choice).squeeze(-1)
+    return torch.multinomial(probs, 1, generator=generator).squeeze(-1)
+
+
+class ContinuousBatchGenerator:
+    """
+    Generate for a queue of formatted prompts with at most batch_size rows in
+    flight, refilling slots as rows finish.
+
+    After run(), stats holds forward counts and slot utilisation.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        stop: StopRule,
+        batch_size: int = 16,
+        do_sample: bool = False,
+        temperature: float = 1.0,
+        top_p: float = 1.0,
+        seed: int = 0,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.stop = stop
+        self.batch_size = batch_size
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.seed = seed
+        self.stats: Dict[str, float] = {}
+
+    def _prefill(self, prompts: List[str]):
+        """Left-padded forward over new prompts. Returns (last logits, cache layers, attention mask)."""
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        try:
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+        finally:
+            self.tokenizer.padding_side = padding_side
+
+        mask = inputs["attention_mask"]
+        position_ids = (mask.cumsum(-1) - 1).clamp(min=0)
+        outputs = self.model(
+            input_ids=inputs["input_ids"],
+            attention_mask=mask,
+            position_ids=position_ids,
+            use_cache=True,
+        )
+        return outputs.logits[:, -1], _cache_layers(outputs.past_key_values), mask
+
+    def run(self, prompts: List[str]) -> List[dict]:
+        """
+        Generate for every prompt. Returns, in prompt order,
+        {"response", "tokens", "stop_reason", "latency"} with latency the
+        seconds from the start of the run until the row finished.
+        """
+        generator = None
+        if self.do_sample:
+            generator = torch.Generator(device=self.model.device).manual_seed(self.seed)
+
+        queue = deque(range(len(prompts)))
+        results: List[dict] = [None] * len(prompts)
+        rows: List[int] = []            # prompt index per batch row
+        generated: List[List[int]] = []  # token ids per batch row
+        layers: List[Tuple[torch.Tensor, torch.Tensor]] = []
+        mask = None                     # [rows, cache length] attention mask
+        next_tokens = None              # [rows] last sampled token per row
+        prefills = decodes = row_steps = 0
+        start = time.perf_counter()
+
+        with torch.no_grad():
+            while queue or rows:
+                # Refill free slots from the queue; new rows arrive with their first token sampled
+                free = self.batch_size - len(rows)
+                if queue and free > 0:
+                    admitted = [queue.popleft() for _ in range(min(free, len(queue)))]
+                    logits, new_layers, new_mask = self._prefill([prompts[i] for i in admitted])
+                    prefills += 1
+                    new_tokens = sample_next(logits, self.do_sample, self.temperature, self.top_p, generator)
+                    if rows:
+                        length = max(mask.shape[1], new_mask.shape[1])
+                        mask = torch.cat([_left_pad(mask, length, 1), _left_pad(new_mask, length, 1)])
+                        layers = [
+                            (
+                                torch.cat([_left_pad(k, length, 2), _left_pad(nk, length, 2)]),
+                                torch.cat([_left_pad(v, length, 2), _left_pad(nv, length, 2)]),
+                            )
+                            for (k, v), (nk, nv) in zip(layers, new_layers)
+                        ]
+                        next_tokens = torch.cat([next_tokens, new_tokens])
+                    else:
+                        mask, layers, next_tokens = new_mask, new_layers, new_tokens
+                    rows += admitted
+                    generated += [[] for _ in admitted]
+
+                # Record the sampled tokens; finished rows leave the batch
+                keep = []
+                for b, token in enumerate(next_tokens.tolist()):
+                    ids = generated[b]
+                    ids.append(token)
+                    text = self.tokenizer.decode(ids[:-1] if token in self.stop.stop_token_ids else ids)
+                    done = self.stop.check(ids, text)
+                    if done is None:
+                        keep.append(b)
+                        continue
+                    reason, response = done
+                    results[rows[b]] = {
+                        "response": response.strip(),
+                        "tokens": len(ids),
+                        "stop_reason": reason,
+                        "latency": time.perf_counter() - start,
+                    }
+                if len(keep) < len(rows):
+                    index = torch.tensor(keep, dtype=torch.long, device=mask.device)
+                    rows = [rows[b] for b in keep]
+                    generated = [generated[b] for b in keep]
+                    next_tokens = next_tokens[index]
+                    mask = mask[index]
+                    layers = [(k[index], v[index]) for k, v in layers]
+                    if not rows:
+                        continue
+                    # Drop cache columns that are padding for every remaining row
+                    first = int(mask.any(dim=0).nonzero()[0])
+                    mask = mask[:, first:]
+                    layers = [(k[:, :, first:], v[:, :, first:]) for k, v in layers]
+
+                # One decode step for every row in flight
+                position_ids = mask.sum(dim=-1, keepdim=True)
+                mask = torch.cat([mask, mask.new_ones(len(rows), 1)], dim=1)
+                outputs = self.model(
+                    input_ids=next_tokens.unsqueeze(-1),
+                    attention_mask=mask,
+                    position_ids=position_ids,
+                    past_key_values=_build_cache(layers),
+                    use_cache=True,
+                )
+                layers = _cache_layers(outputs.past_key_values)
+                next_tokens = sample_next(
+                    outputs.logits[:, -1], self.do_sample, self.temperature, self.top_p, generator,
+                )
+                decodes += 1
+                row_steps += len(rows)
+
+        elapsed = time.perf_counter() - start
+        self.stats = {
+            "seconds": elapsed,
+            "prefill_forwards": prefills,
+            "decode_forwards": decodes,
+            # Fraction of batch slots doing useful work per decode step
+            "slot_utilization": row_steps / (decodes * self.batch_size) if decodes else 0.0,
+            "stop_reasons": dict(Counter(r["stop_reason"] for r in results)),
+        }
+        return results
+
+
+def main():
+    import argparse
+    from extract_caa_vectors import format_chatml
+    from steered_inference import DEFAULT_SYSTEM
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Continuous-batching generation with per-row stop rules")
+    parser.add_argument("--model", type=str, required=True, help="Model (HF id or path)")
+    parser.add_argument("--prompt", action="append", default=[], help="User message (repeatable)")
+    parser.add_argument("--system", type=str, default=DEFAULT_SYSTEM, help="System prompt")
+    parser.add_argument("--tokens", type=int, default=256, help="Token budget per row")
+    parser.add_argument("--max-sentences", type=int, default=None, help="Stop a row after this many sentences")
+    parser.add_argument("--batch-size", type=int, default=16, help="Rows in flight")
+    args = parser.parse_args()
+
+    if not args.prompt:
+        print("ERROR: Give at least one --prompt")
+        return 1
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32)
+    model.eval()
+
+    stop = StopRule(
+        [tokenizer.convert_tokens_to_ids("<|im_end|>")],
+        stop_strings=["<|im_start|>"],
+        max_sentences=args.max_sentences,
+        max_new_tokens=args.tokens,
+    )
+    scheduler = ContinuousBatchGenerator(model, tokenizer, stop, batch_size=args.batch_size)
+    results = scheduler.run([format_chatml(args.system, prompt) for prompt in args.prompt])
+
+    for prompt, result in zip(args.prompt, results):
+        print(f"{'─' * 60}")
+        print(f"{prompt}  [{result['stop_reason']}, {result['tokens']} tokens]")
+        print(result["response"])
+    print(f"{'─' * 60}")
+    stats = scheduler.stats
+    print(f"{stats['prefill_forwards']} prefills + {stats['decode_forwards']} decode steps in {stats['seconds']:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
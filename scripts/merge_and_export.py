@@ -7,12 +7,17 @@ to GGUF format for use with Ollama.
 
 Usage:
     python scripts/merge_and_export.py
+    python scripts/merge_and_export.py --stream   # merge shard by shard, bounded memory
+    python scripts/merge_and_export.py --direct-gguf --outtype q8_0   # no merged checkpoint, no llama.cpp
+    python scripts/merge_and_export.py --cpu --base-model /tmp/neutro-tiny \
+        --lora-path /tmp/neutro-tiny-lora/adapter_latest --merged-path /tmp/neutro-tiny-merged --skip-gguf
 
 After running:
     ollama create neutro-identity -f Modelfile.identity
     ollama run neutro-identity "What are you?"
 """
 
+import json
 import os
 import sys
 import torch
@@ -25,9 +30,28 @@ LORA_PATH = Path.home() / "my-ai-bot" / "neutro" / "models" / "neutro-identity-l
 MERGED_PATH = Path.home() / "my-ai-bot" / "neutro" / "models" / "neutro-identity-merged"
 GGUF_PATH = Path.home() / "my-ai-bot" / "neutro" / "models" / "neutro-identity.gguf"
 
+# GGUF weight types (--outtype), supported by both llama.cpp and export_gguf.py
+GGUF_OUTTYPES = ["f32", "f16", "bf16", "q8_0"]
 
-def merge_lora():
-    """Merge LoRA adapter into base model"""
+
+def merge_lora(
+    base_model_path: str = BASE_MODEL,
+    lora_path: Path = LORA_PATH,
+    merged_path: Path = MERGED_PATH,
+    cpu: bool = False,
+    streaming: bool = False,
+    workers: int = None,
+):
+    """
+    Merge LoRA adapter into base model. cpu: merge in float32 on the CPU (tiny models).
+
+    streaming: merge shard by shard with stream_merge.py instead of loading the
+    model (keeps the base checkpoint dtype; cpu is ignored).
+
+    Shards are written by `workers` threads and recorded with their sha256 in
+    shard_manifest.json. With streaming, workers defaults to 1 so peak memory
+    stays at one tensor; each extra worker adds one.
+    """
     print("=" * 60)
     print("STEP 1: Merging LoRA into Base Model")
     print("=" * 60)
@@ -36,45 +60,63 @@ def merge_lora():
     from peft import PeftModel
     import tempfile
 
+    lora_path = Path(lora_path)
+    merged_path = Path(merged_path)
+
     # Check CUDA
-    if not torch.cuda.is_available():
+    if not cpu and not torch.cuda.is_available():
         print("WARNING: CUDA not available, using CPU (this will be slow)")
 
     # Check LoRA exists
-    if not LORA_PATH.exists():
-        print(f"ERROR: LoRA adapter not found at {LORA_PATH}")
+    if not lora_path.exists():
+        print(f"ERROR: LoRA adapter not found at {lora_path}")
         return None
 
-    print(f"Base model: {BASE_MODEL}")
-    print(f"LoRA path: {LORA_PATH}")
-    print(f"Output path: {MERGED_PATH}")
+    print(f"Base model: {base_model_path}")
+    print(f"LoRA path: {lora_path}")
+    print(f"Output path: {merged_path}")
     print()
 
+    if streaming:
+        from stream_merge import stream_merge_lora
+        print("Merging tensor by tensor (streaming)...")
+        stream_merge_lora(base_model_path, lora_path, merged_path, workers)
+        print("Merge complete!")
+        return merged_path
+
     # Create offload directory for large models
     offload_dir = Path.home() / "my-ai-bot" / "neutro" / "models" / "offload_temp"
     offload_dir.mkdir(parents=True, exist_ok=True)
 
     # Load tokenizer
     print("Loading tokenizer...")
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL, trust_remote_code=True)
-
-    # Load base model in float16 (not quantized, for merging)
-    # Use CPU offloading since 8GB VRAM isn't enough for full model
-    print("Loading base model in float16 with CPU offloading...")
-    base_model = AutoModelForCausalLM.from_pretrained(
-        BASE_MODEL,
-        torch_dtype=torch.float16,
-        device_map="auto",
-        trust_remote_code=True,
-        offload_folder=str(offload_dir),
-        offload_state_dict=True,
-    )
+    tokenizer = AutoTokenizer.from_pretrained(base_model_path, trust_remote_code=True)
+
+    if cpu:
+        print("Loading base model in float32 on CPU...")
+        base_model = AutoModelForCausalLM.from_pretrained(
+            base_model_path,
+            torch_dtype=torch.float32,
+            trust_remote_code=True,
+        )
+    else:
+        # Load base model in float16 (not quantized, for merging)
+        # Use CPU offloading since 8GB VRAM isn't enough for full model
+        print("Loading base model in float16 with CPU offloading...")
+        base_model = AutoModelForCausalLM.from_pretrained(
+            base_model_path,
+            torch_dtype=torch.float16,
+            device_map="auto",
+            trust_remote_code=True,
+            offload_folder=str(offload_dir),
+            offload_state_dict=True,
+        )
 
     # Load LoRA adapter with offload support
     print("Loading LoRA adapter...")
     model = PeftModel.from_pretrained(
         base_model,
-        str(LORA_PATH),
+        str(lora_path),
         offload_folder=str(offload_dir),
     )
 
@@ -83,21 +125,67 @@ def merge_lora():
     model = model.merge_and_unload()
 
     # Save merged model
-    print(f"Saving merged model to {MERGED_PATH}...")
-    MERGED_PATH.mkdir(parents=True, exist_ok=True)
-    model.save_pretrained(str(MERGED_PATH), safe_serialization=True)
-    tokenizer.save_pretrained(str(MERGED_PATH))
+    from shard_manifest import create_manifest, remove_manifest, write_manifest
+    from stream_merge import save_state_dict
+
+    print(f"Saving merged model to {merged_path}...")
+    merged_path.mkdir(parents=True, exist_ok=True)
+    remove_manifest(merged_path)
+    if "disk" in (getattr(model, "hf_device_map", None) or {}).values():
+        # Disk-offloaded weights are only reachable through save_pretrained
+        model.save_pretrained(str(merged_path), safe_serialization=True)
+        create_manifest(merged_path, workers)
+    else:
+        shards = save_state_dict(model.state_dict(), merged_path, workers=workers)
+        model.config.save_pretrained(str(merged_path))
+        if model.generation_config is not None:
+            model.generation_config.save_pretrained(str(merged_path))
+        write_manifest(merged_path, shards)
+    tokenizer.save_pretrained(str(merged_path))
 
     print("Merge complete!")
-    return MERGED_PATH
+    return merged_path
 
 
-def convert_to_gguf(merged_path: Path):
-    """Convert merged model to GGUF format using llama.cpp"""
+def gguf_source_path(gguf_path: Path) -> Path:
+    """Sidecar recording which merged weights + outtype a GGUF file was converted from"""
+    return gguf_path.with_suffix(gguf_path.suffix + ".source.json")
+
+
+def convert_to_gguf(merged_path: Path, outtype: str = "f16", force: bool = False):
+    """
+    Convert merged model to GGUF format using llama.cpp
+
+    The merged shards are checked against their shard_manifest.json first, and
+    the conversion is skipped when GGUF_PATH was already built from the same
+    weights (manifest digest) and outtype, unless force.
+    """
     print("\n" + "=" * 60)
     print("STEP 2: Converting to GGUF Format")
     print("=" * 60)
 
+    from shard_manifest import load_manifest, manifest_digest, verify_shards
+
+    source = None
+    manifest = load_manifest(merged_path)
+    if manifest is None:
+        print("WARNING: No shard manifest, converting unverified weights")
+    else:
+        print("Verifying merged shards...")
+        problems = verify_shards(merged_path)
+        if problems:
+            print("ERROR: Merged model does not match its shard manifest (partial or corrupt write?)")
+            for problem in problems:
+                print(f"  {problem}")
+            return None
+        source = {"weights": manifest_digest(manifest), "outtype": outtype}
+        source_path = gguf_source_path(GGUF_PATH)
+        if not force and GGUF_PATH.exists() and source_path.exists():
+            with open(source_path) as f:
+                if json.load(f) == source:
+                    print(f"Shards unchanged since last conversion, keeping {GGUF_PATH}")
+                    return GGUF_PATH
+
     # Check if llama.cpp conversion script exists
     llama_cpp_path = Path.home() / "my-ai-bot" / "neutro" / "llama.cpp"
     convert_script = llama_cpp_path / "convert_hf_to_gguf.py"
@@ -107,19 +195,21 @@ def convert_to_gguf(merged_path: Path):
         print("Please clone llama.cpp:")
         print(f"  cd ~/my-ai-bot/neutro && git clone https://github.com/ggerganov/llama.cpp")
         print("\nAlternatively, you can manually convert using:")
-        print(f"  python llama.cpp/convert_hf_to_gguf.py {merged_path} --outfile {GGUF_PATH} --outtype f16")
+        print(f"  python llama.cpp/convert_hf_to_gguf.py {merged_path} --outfile {GGUF_PATH} --outtype {outtype}")
+        print("Or skip llama.cpp: python scripts/merge_and_export.py --direct-gguf")
         return None
 
     print(f"Converting {merged_path} to GGUF...")
     print(f"Output: {GGUF_PATH}")
 
+    gguf_source_path(GGUF_PATH).unlink(missing_ok=True)
     import subprocess
     result = subprocess.run([
         sys.executable,
         str(convert_script),
         str(merged_path),
         "--outfile", str(GGUF_PATH),
-        "--outtype", "f16",
+        "--outtype", outtype,
     ], capture_output=True, text=True)
 
     if result.returncode != 0:
@@ -128,10 +218,36 @@ def convert_to_gguf(merged_path: Path):
         return None
 
     print(result.stdout)
+    if source is not None:
+        with open(gguf_source_path(GGUF_PATH), "w") as f:
+            json.dump(source, f, indent=2)
     print(f"GGUF saved to: {GGUF_PATH}")
     return GGUF_PATH
 
 
+def export_direct_gguf(base_model_path: str, lora_path: Path, outtype: str = "f16"):
+    """Merge and convert in one pass, streaming merged tensors straight into GGUF_PATH"""
+    print("\n" + "=" * 60)
+    print("STEP 1-2: Merging LoRA Directly into GGUF")
+    print("=" * 60)
+
+    if not lora_path.exists():
+        print(f"ERROR: LoRA adapter not found at {lora_path}")
+        print("Run train_identity_lora.py first!")
+        return None
+
+    from export_gguf import export_gguf
+
+    print(f"Base model: {base_model_path}")
+    print(f"LoRA: {lora_path}")
+    print(f"Output: {GGUF_PATH} ({outtype})")
+    try:
+        return export_gguf(base_model_path, lora_path, GGUF_PATH, outtype)
+    except (ImportError, ValueError) as e:
+        print(f"ERROR: {e}")
+        return None
+
+
 def create_modelfile():
     """Create Ollama Modelfile for the GGUF model"""
     print("\n" + "=" * 60)
@@ -181,25 +297,66 @@ TEMPLATE \"\"\"<|im_start|>system
 
 
 def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Merge the identity LoRA and export to GGUF")
+    parser.add_argument("--base-model", type=str, default=BASE_MODEL, help="Base model (HF id or path)")
+    parser.add_argument("--lora-path", type=str, default=str(LORA_PATH), help="LoRA adapter directory")
+    parser.add_argument("--merged-path", type=str, default=str(MERGED_PATH), help="Merged model output directory")
+    parser.add_argument("--cpu", action="store_true", help="Merge in float32 on CPU (tiny models)")
+    parser.add_argument("--stream", action="store_true", help="Merge one tensor at a time without loading the model")
+    parser.add_argument("--skip-gguf", action="store_true", help="Only merge; skip GGUF conversion and Modelfile")
+    parser.add_argument("--outtype", choices=GGUF_OUTTYPES, default="f16", help="GGUF weight type")
+    parser.add_argument("--workers", type=int, default=None, help="Threads writing merged shards (--stream: default 1)")
+    parser.add_argument("--force-gguf", action="store_true", help="Convert even if the merged shards are unchanged")
+    parser.add_argument(
+        "--direct-gguf",
+        action="store_true",
+        help="Stream base + LoRA straight to GGUF (no merged checkpoint, no llama.cpp)"
+    )
+    args = parser.parse_args()
+
     print("=" * 60)
     print("NEUTRO Identity LoRA Merge & Export")
     print("=" * 60)
     print()
 
+    if args.direct_gguf:
+        gguf_path = export_direct_gguf(args.base_model, Path(args.lora_path), args.outtype)
+        if not gguf_path:
+            print("ERROR: Direct GGUF export failed")
+            return 1
+        create_modelfile()
+
+        print("\n" + "=" * 60)
+        print("EXPORT COMPLETE")
+        print("=" * 60)
+        print(f"GGUF file: {gguf_path}")
+        print()
+        print("Next steps:")
+        print("1. Register model: ollama create neutro-identity -f Modelfile.identity")
+        print("2. Test model: ollama run neutro-identity 'What are you?'")
+        return 0
+
     # Step 1: Merge LoRA
-    merged_path = merge_lora()
+    merged_path = merge_lora(
+        args.base_model, Path(args.lora_path), Path(args.merged_path), cpu=args.cpu, streaming=args.stream,
+        workers=args.workers,
+    )
     if not merged_path:
         print("ERROR: Merge failed")
-        return
+        return 1
 
-    # Step 2: Convert to GGUF
-    gguf_path = convert_to_gguf(merged_path)
-    if not gguf_path:
-        print("\nWARNING: GGUF conversion skipped")
-        print("You can manually convert later using llama.cpp")
+    gguf_path = None
+    if not args.skip_gguf:
+        # Step 2: Convert to GGUF
+        gguf_path = convert_to_gguf(merged_path, args.outtype, force=args.force_gguf)
+        if not gguf_path:
+            print("\nWARNING: GGUF conversion skipped")
+            print("You can manually convert later using llama.cpp")
 
-    # Step 3: Create Modelfile
-    create_modelfile()
+        # Step 3: Create Modelfile
+        create_modelfile()
 
     print("\n" + "=" * 60)
     print("EXPORT COMPLETE")
@@ -213,6 +370,8 @@ def main():
     print("2. Test model: ollama run neutro-identity 'What are you?'")
     print("3. Update daemon_runner.py to use 'neutro-identity' model")
 
+    return 0
+
 
 if __name__ == "__main__":
-    main()
+    exit(main())
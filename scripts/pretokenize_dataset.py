@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Pretokenized Training Dataset Cache for NEUTRO Identity LoRA
+
+Tokenizes the JSONL written by generate_identity_dataset.py once into two
+flat memory-mapped arrays, so training startup does not re-parse and
+re-tokenize the dataset and DataLoader workers share the same pages:
+
+    tokens.bin          uint32  every example's token ids, back to back
+    offsets.bin         int64   [num_examples + 1] start of each example in tokens.bin
+    prompt_lengths.bin  int32   [num_examples] tokens before the assistant response
+    meta.json                   counts + the hashes the cache is keyed by
+
+Examples are tokenized with ChatMLExampleTokenizer, which reuses the
+tokenization of the constant system/user header.
+
+The cache directory is keyed by the dataset contents, the tokenizer and the
+prompt template (train_identity_lora.format_prompt), so changing any of them
+builds a new cache instead of silently reusing stale tokens. The dataset
+hash comes from a shard manifest's content_hash, or is memoized by file
+size and mtime, so startup does not rehash the dataset.
+
+Usage:
+    python scripts/pretokenize_dataset.py
+    python scripts/pretokenize_dataset.py --dataset data/identity_training/identity_training_latest.manifest.json
+    python scripts/train_identity_lora.py --pretokenized
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from train_identity_lora import (
+    BASE_MODEL,
+    DATA_DIR,
+    DATASET,
+    ChatMLExampleTokenizer,
+    format_prompt,
+    iter_dataset,
+    sequence_features,
+)
+
+CACHE_DIR = DATA_DIR / "pretokenized"
+CACHE_FORMAT = 2
+TOKENIZE_CHUNK = 4096  # examples tokenized per call while building
+FINGERPRINT_MEMO = "fingerprints.json"  # dataset path -> size, mtime, sha256
+MANIFEST_SUFFIX = ".manifest.json"
+TOKEN_DTYPE = np.uint32
+OFFSET_DTYPE = np.int64
+PROMPT_LENGTH_DTYPE = np.int32
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Hash of a tokenizer's vocabulary, merges, normalizer and special-token handling.
+
+    pad_token is left out: it never appears in the cached ids, and the trainer
+    sets it to eos while the pretokenize CLI keeps the tokenizer's own. So are
+    the backend's padding and truncation settings, which every padded or
+    truncated call rewrites.
+    """
+    digest = hashlib.sha256(type(tokenizer).__name__.encode())
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        state = json.loads(backend.to_str())
+        state.pop("padding", None)
+        state.pop("truncation", None)
+        digest.update(json.dumps(state, sort_keys=True).encode("utf-8"))
+    else:
+        digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+    special_tokens = {name: token for name, token in tokenizer.special_tokens_map.items() if name != "pad_token"}
+    digest.update(json.dumps(special_tokens, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def template_fingerprint() -> str:
+    """Hash of the ChatML training template."""
+    return hashlib.sha256(format_prompt("\x00instruction\x00", "\x00response\x00").encode("utf-8")).hexdigest()[:16]
+
+
+def file_fingerprint(path: Path) -> str:
+    """Hash of a file's contents (a shard manifest covers its shards through their sha256)."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def dataset_fingerprint(dataset_path: Path, cache_root: Path = CACHE_DIR) -> str:
+    """
+    Content hash of a dataset without rereading it on every startup.
+
+    A shard manifest carries the content_hash of its examples (for a single
+    uncompressed shard, the sha256 of that file). For other files the hash is
+    memoized in cache_root/fingerprints.json by path, size and mtime.
+    """
+    dataset_path = Path(dataset_path)
+    if dataset_path.name.endswith(MANIFEST_SUFFIX):
+        with open(dataset_path) as f:
+            content_hash = json.load(f).get("content_hash")
+        return content_hash[:16] if content_hash else file_fingerprint(dataset_path)
+
+    stat = dataset_path.stat()
+    entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    memo_path = Path(cache_root) / FINGERPRINT_MEMO
+    memo = {}
+    if memo_path.exists():
+        with open(memo_path) as f:
+            memo = json.load(f)
+    key = str(dataset_path.resolve())
+    cached = memo.get(key)
+    if cached and all(cached.get(name) == value for name, value in entry.items()):
+        return cached["sha256"]
+
+    memo[key] = {**entry, "sha256": file_fingerprint(dataset_path)}
+    memo_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = memo_path.with_name(f"{memo_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(memo, f, indent=2)
+    tmp_path.replace(memo_path)
+    return memo[key]["sha256"]
+
+
+class PretokenizedDataset:
+    """Read-only view of a pretokenized cache. Examples are zero-copy numpy slices."""
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        with open(self.cache_dir / "meta.json") as f:
+            self.meta = json.load(f)
+        self.offsets = np.memmap(
+            self.cache_dir / "offsets.bin", dtype=OFFSET_DTYPE, mode="r",
+            shape=(self.meta["num_examples"] + 1,),
+        )
+        self.prompt_lengths = np.fromfile(self.cache_dir / "prompt_lengths.bin", dtype=PROMPT_LENGTH_DTYPE)
+        # np.memmap cannot map an empty file
+        if self.meta["num_tokens"]:
+            self.tokens = np.memmap(
+                self.cache_dir / "tokens.bin", dtype=TOKEN_DTYPE, mode="r",
+                shape=(self.meta["num_tokens"],),
+            )
+        else:
+            self.tokens = np.zeros(0, dtype=TOKEN_DTYPE)
+
+    def __len__(self) -> int:
+        return self.meta["num_examples"]
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        return self.tokens[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+
+class TokenizedExamples(torch.utils.data.Dataset):
+    """
+    Training examples streamed from a PretokenizedDataset.
+
+    Each item is a list of example indices packed into one sequence (one index
+    per item when not packing), returned in the input_ids / position_ids /
+    labels format of train_identity_lora.sequence_features. With
+    assistant_only, the system/user prompt is masked out of the labels.
+    """
+
+    def __init__(
+        self,
+        data: PretokenizedDataset,
+        sequences: List[List[int]],
+        max_length: int,
+        assistant_only: bool = False,
+    ):
+        self.data = data
+        self.sequences = sequences
+        self.max_length = max_length
+        self.assistant_only = assistant_only
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+    def __getitem__(self, idx: int) -> Dict[str, List[int]]:
+        examples = self.sequences[idx]
+        loss_starts = None
+        if self.assistant_only:
+            loss_starts = [int(self.data.prompt_lengths[example]) for example in examples]
+        return sequence_features(
+            [self.data[example][:self.max_length].tolist() for example in examples], loss_starts,
+        )
+
+
+def cache_path(dataset_path: Path, tokenizer, cache_root: Path = CACHE_DIR) -> Path:
+    """Cache directory for a dataset file + tokenizer + template."""
+    key = hashlib.sha256(
+        f"{CACHE_FORMAT}:{dataset_fingerprint(dataset_path, cache_root)}:"
+        f"{tokenizer_fingerprint(tokenizer)}:{template_fingerprint()}".encode()
+    ).hexdigest()[:16]
+    return Path(cache_root) / f"{Path(dataset_path).stem}-{key}"
+
+
+def build_pretokenized(dataset_path: Path, tokenizer, output_dir: Path) -> Path:
+    """Stream the dataset (JSONL, .jsonl.gz or shard manifest) through the tokenizer in chunks and write the arrays."""
+    tmp_dir = output_dir.with_name(f"{output_dir.name}.{os.getpid()}.tmp")
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    example_tokenizer = ChatMLExampleTokenizer(tokenizer)
+    num_examples = 0
+    num_tokens = 0
+    with open(tmp_dir / "tokens.bin", "wb") as tokens_file, \
+            open(tmp_dir / "offsets.bin", "wb") as offsets_file, \
+            open(tmp_dir / "prompt_lengths.bin", "wb") as prompt_lengths_file:
+        offsets_file.write(np.zeros(1, dtype=OFFSET_DTYPE).tobytes())
+
+        def flush(chunk: List[dict]):
+            nonlocal num_examples, num_tokens
+            examples = example_tokenizer(
+                [ex["instruction"] for ex in chunk], [ex["response"] for ex in chunk],
+            )
+            for ids, prompt_length in examples:
+                tokens_file.write(np.asarray(ids, dtype=TOKEN_DTYPE).tobytes())
+                num_tokens += len(ids)
+                offsets_file.write(np.array([num_tokens], dtype=OFFSET_DTYPE).tobytes())
+            prompt_lengths_file.write(
+                np.array([p for _, p in examples], dtype=PROMPT_LENGTH_DTYPE).tobytes()
+            )
+            num_examples += len(chunk)
+
+        chunk = []
+        for ex in iter_dataset(dataset_path):
+            chunk.append(ex)
+            if len(chunk) == TOKENIZE_CHUNK:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+
+    meta = {
+        "format": CACHE_FORMAT,
+        "dataset": str(dataset_path),
+        "dataset_hash": dataset_fingerprint(dataset_path, output_dir.parent),
+        "tokenizer": getattr(tokenizer, "name_or_path", ""),
+        "tokenizer_hash": tokenizer_fingerprint(tokenizer),
+        "template_hash": template_fingerprint(),
+        "num_examples": num_examples,
+        "num_tokens": num_tokens,
+        "token_dtype": np.dtype(TOKEN_DTYPE).name,
+    }
+    with open(tmp_dir / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2)
+
+    # Another process may have finished the same cache first
+    if output_dir.exists():
+        for tmp_file in tmp_dir.iterdir():
+            tmp_file.unlink()
+        tmp_dir.rmdir()
+    else:
+        tmp_dir.rename(output_dir)
+    return output_dir
+
+
+def load_pretokenized(dataset_path: Path, tokenizer, cache_root: Path = CACHE_DIR) -> PretokenizedDataset:
+    """Open the cache for dataset_path, building it first if needed."""
+    output_dir = cache_path(dataset_path, tokenizer, cache_root)
+    if output_dir.exists():
+        print(f"Using pretokenized cache: {output_dir}")
+    else:
+        print(f"Pretokenizing {dataset_path} -> {output_dir}")
+        build_pretokenized(Path(dataset_path), tokenizer, output_dir)
+    return PretokenizedDataset(output_dir)
+
+
+def main():
+    import argparse
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Pretokenize the identity dataset into a memory-mapped cache")
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        default=str(DATASET),
+        help="JSONL / .jsonl.gz / .manifest.json from generate_identity_dataset.py"
+    )
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        default=BASE_MODEL,
+        help="Tokenizer (HF id or path)"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=str(CACHE_DIR),
+        help="Root directory for pretokenized caches"
+    )
+    args = parser.parse_args()
+
+    dataset_path = Path(args.dataset)
+    if not dataset_path.exists():
+        print(f"ERROR: Dataset not found at {dataset_path}")
+        print("Run: python scripts/generate_identity_dataset.py first")
+        return 1
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+    data = load_pretokenized(dataset_path, tokenizer, Path(args.cache_dir))
+
+    lengths = data.lengths()
+    print(f"Examples: {len(data)}")
+    print(f"Tokens: {data.meta['num_tokens']:,}")
+    if len(data):
+        print(f"Tokens per example: mean {lengths.mean():.1f}, max {lengths.max()}")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Token-Length Profile and Training Budget Report for the Identity Dataset
+
+train_identity_lora.py trains with MAX_SEQ_LENGTH = 512 and a fixed batch x
+accumulation. This report shows what those constants do to the actual data:
+
+    - token length distribution per category, tokenized exactly like
+      training (trainer tokenizer, ChatML format_prompt, via
+      ChatMLExampleTokenizer in batches of TOKENIZE_CHUNK)
+    - per candidate max length: truncated examples, padding waste when
+      padding every row to max length and when padding each batch to its
+      longest row, and the packing density of plan_packing()
+    - per candidate max length: a micro-batch within a memory budget and
+      the gradient accumulation closest to the trainer's examples per
+      optimizer step (flagged when one packed row already exceeds it)
+
+The memory model is a rough QLoRA estimate from the model config (4-bit
+weights, LoRA weights/grads/8-bit Adam states, checkpointed activations,
+fp32 logits, and the packed block-diagonal mask). It does not load the
+model; treat it as a starting point, then confirm with nvidia-smi.
+
+Usage:
+    python scripts/profile_identity_dataset.py
+    python scripts/profile_identity_dataset.py --dataset data/identity_training/identity_training_latest.manifest.json
+    python scripts/profile_identity_dataset.py --generate --expand --memory-gb 8 --output /tmp/profile.json
+    python scripts/profile_identity_dataset.py --tokenizer /tmp/neutro-tiny --generate --max-length 128
+"""
+
+import json
+import random
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from pretokenize_dataset import TOKENIZE_CHUNK
+from train_identity_lora import (
+    BASE_MODEL,
+    BATCH_SIZE,
+    DATASET,
+    GRADIENT_ACCUMULATION,
+    LORA_R,
+    MAX_SEQ_LENGTH,
+    TARGET_MODULES,
+    ChatMLExampleTokenizer,
+    iter_dataset,
+    plan_packing,
+)
+
+# Max lengths compared (plus MAX_SEQ_LENGTH and the p99 length rounded up)
+CANDIDATE_LENGTHS = [128, 256, 384, 512, 768, 1024]
+LENGTH_MULTIPLE = 64
+
+# Rows per batch when simulating pad-to-longest batching
+PAD_BATCH_SIZE = 8
+
+# Memory model (bytes)
+QLORA_BYTES_PER_PARAM = 0.53    # nf4 + double-quant constants, transformer blocks
+FP16_BYTES = 2                  # embeddings and lm_head stay in fp16
+LORA_BYTES_PER_PARAM = 4 + 4 + 2  # fp32 weight, fp32 grad, two 8-bit Adam states
+LOGIT_BYTES_PER_VOCAB = 2 + 4 + 4  # fp16 logits, fp32 upcast for the loss, its grad
+CUDA_OVERHEAD_GB = 0.75         # CUDA context, cuBLAS workspace, fragmentation
+DEFAULT_MEMORY_GB = 8
+MAX_MICRO_BATCH = 64
+
+# Examples per optimizer step the trainer's defaults give
+TARGET_EXAMPLES_PER_STEP = BATCH_SIZE * GRADIENT_ACCUMULATION
+
+
+def tokenize_lengths(examples: List[dict], tokenizer) -> Dict[str, np.ndarray]:
+    """
+    Training token lengths of examples, tokenized TOKENIZE_CHUNK at a time.
+
+    Returns {"lengths", "prompt_lengths", "categories"} arrays.
+    """
+    example_tokenizer = ChatMLExampleTokenizer(tokenizer)
+    lengths = np.empty(len(examples), dtype=np.int64)
+    prompt_lengths = np.empty(len(examples), dtype=np.int64)
+    for start in range(0, len(examples), TOKENIZE_CHUNK):
+        chunk = examples[start:start + TOKENIZE_CHUNK]
+        tokenized = example_tokenizer([ex["instruction"] for ex in chunk], [ex["response"] for ex in chunk])
+        lengths[start:start + len(chunk)] = [len(ids) for ids, _ in tokenized]
+        prompt_lengths[start:start + len(chunk)] = [prompt_length for _, prompt_length in tokenized]
+    categories = np.array([ex.get("category", "unknown") for ex in examples])
+    return {"lengths": lengths, "prompt_lengths": prompt_lengths, "categories": categories}
+
+
+def length_stats(lengths: np.ndarray) -> dict:
+    """Count, mean and percentiles of a length array"""
+    p50, p90, p99 = np.percentile(lengths, [50, 90, 99])
+    return {
+        "examples": int(len(lengths)),
+        "min": int(lengths.min()),
+        "mean": float(lengths.mean()),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": int(lengths.max()),
+    }
+
+
+def category_profile(profile: Dict[str, np.ndarray]) -> Dict[str, dict]:
+    """length_stats of total and response tokens, per category and overall"""
+    lengths = profile["lengths"]
+    responses = lengths - profile["prompt_lengths"]
+    report = {}
+    for category in sorted(set(profile["categories"].tolist())) + ["all"]:
+        selected = profile["categories"] == category if category != "all" else slice(None)
+        report[category] = {
+            **length_stats(lengths[selected]),
+            "response_mean": float(responses[selected].mean()),
+        }
+    return report
+
+
+def padding_profile(
+    lengths: np.ndarray,
+    max_length: int,
+    batch_size: int = PAD_BATCH_SIZE,
+    seed: int = 0,
+) -> dict:
+    """
+    Token accounting at one max length: truncation, padding waste (fraction
+    of batch slots that are padding) for fixed and pad-to-longest batches of
+    shuffled examples, and plan_packing() density.
+    """
+    truncated = np.minimum(lengths, max_length)
+    tokens = int(truncated.sum())
+
+    # Pad-to-longest: shuffled batches, each padded to its longest row
+    order = np.random.default_rng(seed).permutation(len(truncated))
+    padded = np.zeros(-(-len(order) // batch_size) * batch_size, dtype=np.int64)
+    padded[:len(order)] = truncated[order]
+    batch_slots = int(padded.reshape(-1, batch_size).max(axis=1).sum()) * batch_size
+
+    sequences = plan_packing(truncated.tolist(), max_length)
+    return {
+        "max_length": max_length,
+        "truncated": int((lengths > max_length).sum()),
+        "truncated_tokens": int(lengths.sum()) - tokens,
+        "padding_waste_fixed": 1 - tokens / (len(lengths) * max_length),
+        "padding_waste_batch": 1 - tokens / batch_slots,
+        "packed_sequences": len(sequences),
+        "packing_density": tokens / (len(sequences) * max_length),
+        "examples_per_sequence": len(lengths) / len(sequences),
+    }
+
+
+def candidate_lengths(lengths: np.ndarray) -> List[int]:
+    """CANDIDATE_LENGTHS, MAX_SEQ_LENGTH and the p99 length rounded up to LENGTH_MULTIPLE"""
+    p99 = int(np.ceil(np.percentile(lengths, 99) / LENGTH_MULTIPLE)) * LENGTH_MULTIPLE
+    return sorted(set(CANDIDATE_LENGTHS) | {MAX_SEQ_LENGTH, max(LENGTH_MULTIPLE, p99)})
+
+
+def model_shapes(config) -> dict:
+    """Sizes the memory model needs, from a transformers config"""
+    hidden = config.hidden_size
+    heads = config.num_attention_heads
+    head_dim = getattr(config, "head_dim", None) or hidden // heads
+    kv_dim = (getattr(config, "num_key_value_heads", None) or heads) * head_dim
+    inter = config.intermediate_size
+    layers = config.num_hidden_layers
+    vocab = config.vocab_size
+    dims = {
+        "q_proj": (hidden, hidden), "k_proj": (hidden, kv_dim), "v_proj": (hidden, kv_dim),
+        "o_proj": (hidden, hidden), "gate_proj": (hidden, inter), "up_proj": (hidden, inter),
+        "down_proj": (inter, hidden),
+    }
+    block_params = layers * sum(i * o for i, o in dims.values())
+    embedding_params = vocab * hidden * (1 if getattr(config, "tie_word_embeddings", False) else 2)
+    lora_params = layers * LORA_R * sum(i + o for name, (i, o) in dims.items() if name in TARGET_MODULES)
+    return {
+        "hidden": hidden, "inter": inter, "layers": layers, "vocab": vocab,
+        "block_params": block_params, "embedding_params": embedding_params, "lora_params": lora_params,
+    }
+
+
+def estimate_memory(shapes: dict, max_length: int, micro_batch: int, packed: bool) -> Dict[str, float]:
+    """Estimated peak training memory in GB for one micro-batch of max_length rows"""
+    tokens = micro_batch * max_length
+    gb = 1024 ** 3
+    # Checkpointed hidden states per layer, plus one layer recomputed in backward
+    activation_per_token = FP16_BYTES * (
+        shapes["layers"] * shapes["hidden"] + 10 * shapes["hidden"] + 4 * shapes["inter"]
+    )
+    memory = {
+        "weights": (shapes["block_params"] * QLORA_BYTES_PER_PARAM + shapes["embedding_params"] * FP16_BYTES) / gb,
+        "lora": shapes["lora_params"] * LORA_BYTES_PER_PARAM / gb,
+        "activations": tokens * activation_per_token / gb,
+        "logits": tokens * shapes["vocab"] * LOGIT_BYTES_PER_VOCAB / gb,
+        # PackedSequenceCollator's [batch, 1, seq, seq] fp16 mask
+        "mask": micro_batch * max_length * max_length * FP16_BYTES / gb if packed else 0.0,
+        "overhead": CUDA_OVERHEAD_GB,
+    }
+    memory["total"] = sum(memory.values())
+    return memory
+
+
+def suggest_batch(
+    shapes: dict,
+    max_length: int,
+    memory_gb: float,
+    examples_per_row: float,
+    packed: bool,
+) -> Optional[dict]:
+    """
+    Micro-batch and accumulation for max_length within memory_gb, aiming at
+    TARGET_EXAMPLES_PER_STEP examples per optimizer step.
+
+    The micro-batch is capped at the rows one step needs and picked so that
+    micro-batch x accumulation comes closest to them. When a single row
+    already holds more than the target (long packed sequences),
+    examples_per_step reports the larger effective batch.
+    max_micro_batch is the memory limit alone. None if one row does not fit.
+    """
+    max_micro_batch = 0
+    for micro_batch in range(1, MAX_MICRO_BATCH + 1):
+        if estimate_memory(shapes, max_length, micro_batch, packed)["total"] > memory_gb:
+            break
+        max_micro_batch = micro_batch
+    if max_micro_batch == 0:
+        return None
+
+    rows_per_step = max(1, round(TARGET_EXAMPLES_PER_STEP / examples_per_row))
+    # Largest micro-batch whose accumulation lands closest to rows_per_step
+    micro_batch = min(
+        range(1, min(max_micro_batch, rows_per_step) + 1),
+        key=lambda mb: (abs(mb * max(1, round(rows_per_step / mb)) - rows_per_step), -mb),
+    )
+    accumulation = max(1, round(rows_per_step / micro_batch))
+    return {
+        "max_length": max_length,
+        "micro_batch": micro_batch,
+        "max_micro_batch": max_micro_batch,
+        "gradient_accumulation": accumulation,
+        "examples_per_step": micro_batch * accumulation * examples_per_row,
+        "target_examples_per_step": TARGET_EXAMPLES_PER_STEP,
+        "estimated_gb": estimate_memory(shapes, max_length, micro_batch, packed)["total"],
+    }
+
+
+def load_examples(args) -> Optional[List[dict]]:
+    """Examples from --dataset, or freshly generated with --generate"""
+    if args.generate:
+        from generate_identity_dataset import generate_dataset
+        return generate_dataset(args.num_examples, random.Random(0), expand=args.expand)
+
+    dataset_path = Path(args.dataset)
+    if not dataset_path.exists():
+        print(f"ERROR: Dataset not found at {dataset_path}")
+        print("Run: python scripts/generate_identity_dataset.py first (or use --generate)")
+        return None
+    return list(iter_dataset(dataset_path))
+
+
+def main():
+    import argparse
+    from transformers import AutoConfig, AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Token-length profile and batch budget for the identity dataset")
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        default=str(DATASET),
+        help="JSONL / .jsonl.gz / .manifest.json dataset"
+    )
+    parser.add_argument("--generate", action="store_true", help="Profile a freshly generated dataset instead")
+    parser.add_argument("--expand", action="store_true", help="--generate: include template variants")
+    parser.add_argument("--num-examples", type=int, default=1000000, help="--generate: examples to sample")
+    parser.add_argument("--tokenizer", type=str, default=BASE_MODEL, help="Tokenizer and model config (HF id or path)")
+    parser.add_argument("--max-length", type=int, action="append", default=None, help="Max length to report (repeatable)")
+    parser.add_argument("--memory-gb", type=float, default=DEFAULT_MEMORY_GB, help="GPU memory budget")
+    parser.add_argument("--output", type=str, default=None, help="Also write the report as JSON")
+    args = parser.parse_args()
+
+    examples = load_examples(args)
+    if examples is None:
+        return 1
+    if not examples:
+        print("ERROR: Dataset is empty")
+        return 1
+
+    print("=" * 60)
+    print("NEUTRO Identity Dataset Token Profile")
+    print("=" * 60)
+    print(f"Examples: {len(examples)}")
+    print(f"Tokenizer: {args.tokenizer}")
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+    profile = tokenize_lengths(examples, tokenizer)
+    lengths = profile["lengths"]
+
+    categories = category_profile(profile)
+    print(f"\nTokens per example (ChatML, system prompt included):")
+    print(f"  {'category':<22}{'n':>7}{'mean':>8}{'p50':>7}{'p90':>7}{'p99':>7}{'max':>7}{'resp':>7}")
+    for category, stats in categories.items():
+        print(
+            f"  {category:<22}{stats['examples']:>7}{stats['mean']:>8.1f}{stats['p50']:>7.0f}"
+            f"{stats['p90']:>7.0f}{stats['p99']:>7.0f}{stats['max']:>7}{stats['response_mean']:>7.1f}"
+        )
+
+    max_lengths = sorted(set(args.max_length)) if args.max_length else candidate_lengths(lengths)
+    padding = [padding_profile(lengths, max_length) for max_length in max_lengths]
+    print(f"\nPadding and packing (pad-to-longest batches of {PAD_BATCH_SIZE}):")
+    print(f"  {'max_len':>8}{'trunc':>7}{'waste fixed':>13}{'waste batch':>13}{'packed':>8}{'density':>9}{'ex/seq':>8}")
+    for row in padding:
+        marker = "  <- MAX_SEQ_LENGTH" if row["max_length"] == MAX_SEQ_LENGTH else ""
+        print(
+            f"  {row['max_length']:>8}{row['truncated']:>7}{100 * row['padding_waste_fixed']:>12.1f}%"
+            f"{100 * row['padding_waste_batch']:>12.1f}%{row['packed_sequences']:>8}"
+            f"{100 * row['packing_density']:>8.1f}%{row['examples_per_sequence']:>8.1f}{marker}"
+        )
+
+    suggestions = {}
+    try:
+        shapes = model_shapes(AutoConfig.from_pretrained(args.tokenizer, trust_remote_code=True))
+    except Exception as e:
+        print(f"\nWARNING: No model config for {args.tokenizer} ({e}), skipping the memory budget")
+        shapes = None
+
+    if shapes is not None:
+        print(f"\nBudget for {args.memory_gb:g} GB (QLoRA estimate, {TARGET_EXAMPLES_PER_STEP} examples per step):")
+        print(f"  {'max_len':>8}{'mode':>8}{'batch':>7}{'fits':>6}{'accum':>7}{'ex/step':>9}{'est GB':>8}")
+        for row in padding:
+            for mode, packed, per_row in (("padded", False, 1.0), ("packed", True, row["examples_per_sequence"])):
+                suggestion = suggest_batch(shapes, row["max_length"], args.memory_gb, per_row, packed)
+                suggestions.setdefault(mode, []).append(suggestion)
+                if suggestion is None:
+                    print(f"  {row['max_length']:>8}{mode:>8}   does not fit")
+                    continue
+                print(
+                    f"  {row['max_length']:>8}{mode:>8}{suggestion['micro_batch']:>7}"
+                    f"{suggestion['max_micro_batch']:>6}{suggestion['gradient_accumulation']:>7}"
+                    f"{suggestion['examples_per_step']:>9.1f}{suggestion['estimated_gb']:>8.2f}"
+                )
+        current = estimate_memory(shapes, MAX_SEQ_LENGTH, BATCH_SIZE, packed=False)
+        print(
+            f"\nCurrent settings (max {MAX_SEQ_LENGTH}, batch {BATCH_SIZE} x {GRADIENT_ACCUMULATION}): "
+            f"~{current['total']:.2f} GB "
+            f"(weights {current['weights']:.2f}, LoRA {current['lora']:.2f}, "
+            f"activations {current['activations']:.2f}, logits {current['logits']:.2f})"
+        )
+
+    longest = int(lengths.max())
+    fitting = [row for row in padding if row["max_length"] >= longest]
+    if fitting:
+        print(f"\nShortest max length without truncation: {fitting[0]['max_length']} (longest example: {longest})")
+
+    if args.output:
+        report = {
+            "examples": len(examples),
+            "tokenizer": args.tokenizer,
+            "memory_gb": args.memory_gb,
+            "categories": categories,
+            "padding": padding,
+            "suggestions": suggestions,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to: {args.output}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Multi-Adapter Serving for NEUTRO Identity LoRAs
+
+Loads the base model once and keeps several identity LoRA adapters resident
+(the adapter_<timestamp> backups train_identity_lora.py writes next to
+adapter_latest), instead of merging and exporting a full model per version.
+
+Every request names the adapter it wants. A batch of requests for different
+adapters runs as one generate() call: PEFT's mixed-batch inference
+(adapter_names=...) applies each row's own LoRA delta inside the shared
+forward, so an A/B test of identity versions costs adapter-sized memory.
+
+Adapter names are the directory names under the LoRA output directory
+(adapter_20260101_120000, ...); "latest" is the newest one and "base" the
+base model without any adapter. At most --max-adapters stay resident; the
+least recently used one is unloaded when another is needed. New adapter
+directories are picked up between batches, so a retrain can be served
+without a restart.
+
+Usage:
+    python scripts/serve_identity_adapters.py --prompt "What are you?"        # newest --max-adapters adapters
+    python scripts/serve_identity_adapters.py --prompt "Who created you?" --adapter latest --adapter base
+
+    # One request per line: {"prompt": "...", "adapter": "adapter_20260101_120000"}
+    python scripts/serve_identity_adapters.py --requests requests.jsonl
+    cat requests.jsonl | python scripts/serve_identity_adapters.py --requests -   # JSONL responses on stdout
+"""
+
+import json
+import re
+import sys
+from collections import OrderedDict
+from pathlib import Path
+from typing import List
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+from extract_caa_vectors import format_chatml
+from steered_inference import DEFAULT_SYSTEM
+from train_identity_lora import BASE_MODEL, OUTPUT_DIR
+
+# Adapters kept in memory at once
+MAX_RESIDENT_ADAPTERS = 4
+
+# Requests per generate() call
+BATCH_SIZE = 8
+
+# Special adapter names
+LATEST = "latest"
+BASE = "base"  # PEFT's name for "no adapter" is "__base__"
+
+ADAPTER_DIR_PATTERN = re.compile(r"adapter_\d{8}_\d{6}$")
+
+
+def discover_adapters(lora_dir: Path) -> "OrderedDict[str, Path]":
+    """
+    Timestamped adapter directories under lora_dir, oldest first.
+
+    Falls back to adapter_latest when no timestamped backups exist.
+    """
+    lora_dir = Path(lora_dir)
+    adapters = OrderedDict(
+        (path.name, path)
+        for path in sorted(lora_dir.glob("adapter_*"))
+        if ADAPTER_DIR_PATTERN.match(path.name) and (path / "adapter_config.json").exists()
+    )
+    if not adapters and (lora_dir / "adapter_latest" / "adapter_config.json").exists():
+        adapters["adapter_latest"] = lora_dir / "adapter_latest"
+    return adapters
+
+
+class AdapterServer:
+    """
+    One base model with an LRU set of resident LoRA adapters.
+
+    generate_batch() takes one adapter name per prompt and runs them all in a
+    single left-padded generate() call.
+    """
+
+    def __init__(self, base_model, tokenizer, lora_dir: Path, max_resident: int = MAX_RESIDENT_ADAPTERS):
+        self.base_model = base_model
+        self.model = None  # PeftModel once the first adapter is loaded
+        self.tokenizer = tokenizer
+        self.lora_dir = Path(lora_dir)
+        self.max_resident = max_resident
+        self.available: "OrderedDict[str, Path]" = OrderedDict()
+        self.resident: "OrderedDict[str, Path]" = OrderedDict()
+        self.refresh()
+
+    def refresh(self) -> List[str]:
+        """Rescan lora_dir for adapters. Returns the names that are new since the last scan."""
+        available = discover_adapters(self.lora_dir)
+        new = [name for name in available if name not in self.available]
+        self.available = available
+        return new
+
+    def resolve(self, name: str) -> str:
+        """Request adapter name -> available adapter name ("latest" = newest, None = latest)."""
+        if name is None or name == LATEST:
+            if not self.available:
+                raise KeyError(f"No adapters in {self.lora_dir}")
+            return next(reversed(self.available))
+        if name == BASE or name in self.available:
+            return name
+        raise KeyError(f"Unknown adapter '{name}' (have: {', '.join(self.available) or 'none'})")
+
+    def load(self, name: str):
+        """Make an adapter resident, unloading the least recently used one if needed."""
+        if name == BASE:
+            return
+        if name in self.resident:
+            self.resident.move_to_end(name)
+            return
+
+        path = self.available[name]
+        if self.model is None:
+            from peft import PeftModel
+            self.model = PeftModel.from_pretrained(self.base_model, str(path), adapter_name=name)
+            self.model.eval()
+        else:
+            self.model.load_adapter(str(path), adapter_name=name)
+        self.resident[name] = path
+        print(f"Loaded adapter {name} ({len(self.resident)} resident)", file=sys.stderr)
+
+        while len(self.resident) > self.max_resident:
+            evicted, _ = self.resident.popitem(last=False)
+            # PEFT needs an active adapter that still exists
+            self.model.set_adapter(name)
+            self.model.delete_adapter(evicted)
+            print(f"Unloaded adapter {evicted}", file=sys.stderr)
+
+    def generate_batch(self, prompts: List[str], adapters: List[str], **generate_kwargs) -> List[str]:
+        """
+        Generate for formatted prompts, row i with adapter adapters[i], in one batch.
+
+        Returns the decoded responses.
+        """
+        if len(prompts) != len(adapters):
+            raise ValueError(f"{len(prompts)} prompts but {len(adapters)} adapter names")
+        names = [self.resolve(name) for name in adapters]
+        # All adapters of one batch must be resident together
+        if len(set(names) - {BASE}) > self.max_resident:
+            raise ValueError(f"Batch uses {len(set(names) - {BASE})} adapters, max resident is {self.max_resident}")
+        # Touch the already-resident ones first so loading the rest never evicts them
+        for name in sorted(dict.fromkeys(names), key=lambda name: name not in self.resident):
+            self.load(name)
+
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        try:
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.base_model.device)
+        finally:
+            self.tokenizer.padding_side = padding_side
+
+        with torch.no_grad():
+            if self.model is None:
+                # Only base-model requests so far
+                outputs = self.base_model.generate(**inputs, **generate_kwargs)
+            else:
+                outputs = self.model.generate(
+                    **inputs,
+                    adapter_names=["__base__" if name == BASE else name for name in names],
+                    **generate_kwargs,
+                )
+
+        prompt_len = inputs['input_ids'].shape[1]
+        return [
+            self.tokenizer.decode(row[prompt_len:], skip_special_tokens=True).strip()
+            for row in outputs
+        ]
+
+
+def load_base_model(base_model_path: str, cpu: bool = False):
+    """Base model (4-bit on GPU, float32 on CPU) and tokenizer. Returns (model, tokenizer)."""
+    tokenizer = AutoTokenizer.from_pretrained(base_model_path, trust_remote_code=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    if cpu:
+        model = AutoModelForCausalLM.from_pretrained(
+            base_model_path,
+            trust_remote_code=True,
+            torch_dtype=torch.float32,
+        )
+    else:
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True,
+        )
+        model = AutoModelForCausalLM.from_pretrained(
+            base_model_path,
+            quantization_config=bnb_config,
+            device_map="auto",
+            trust_remote_code=True,
+            torch_dtype=torch.float16,
+        )
+    model.eval()
+    return model, tokenizer
+
+
+def serve_requests(server: AdapterServer, requests: List[dict], system: str, batch_size: int, **generate_kwargs):
+    """Answer {"prompt", "adapter"} requests in batches, printing one JSON line per response."""
+    for start in range(0, len(requests), batch_size):
+        batch = requests[start:start + batch_size]
+        # A retrain between batches adds a new adapter_<timestamp> directory
+        for name in server.refresh():
+            print(f"New adapter available: {name}", file=sys.stderr)
+        responses = server.generate_batch(
+            [format_chatml(r.get("system", system), r["prompt"]) for r in batch],
+            [r.get("adapter") for r in batch],
+            **generate_kwargs,
+        )
+        for request, response in zip(batch, responses):
+            print(json.dumps({
+                "prompt": request["prompt"],
+                "adapter": server.resolve(request.get("adapter")),
+                "response": response,
+            }), flush=True)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve several identity LoRA adapters on one base model")
+    parser.add_argument("--base-model", type=str, default=BASE_MODEL, help="Base model (HF id or path)")
+    parser.add_argument("--lora-dir", type=str, default=str(OUTPUT_DIR), help="Directory with adapter_* subdirectories")
+    parser.add_argument(
+        "--adapter",
+        action="append",
+        default=[],
+        help="Adapter for --prompt (repeatable; 'latest', 'base' or a directory name; default: the newest --max-adapters adapters)"
+    )
+    parser.add_argument("--prompt", type=str, default=None, help="User message answered by every --adapter")
+    parser.add_argument(
+        "--requests",
+        type=str,
+        default=None,
+        help="JSONL of {\"prompt\", \"adapter\"} requests ('-' = stdin); responses go to stdout as JSONL"
+    )
+    parser.add_argument("--system", type=str, default=DEFAULT_SYSTEM, help="System prompt")
+    parser.add_argument("--max-adapters", type=int, default=MAX_RESIDENT_ADAPTERS, help="Adapters kept resident")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Requests per generate() call")
+    parser.add_argument("--tokens", type=int, default=100, help="Max new tokens")
+    parser.add_argument("--cpu", action="store_true", help="Run on CPU in float32 without quantization (tiny models)")
+    args = parser.parse_args()
+
+    if args.prompt is None and args.requests is None:
+        print("ERROR: Give --prompt or --requests")
+        return 1
+
+    lora_dir = Path(args.lora_dir)
+    if not discover_adapters(lora_dir):
+        print(f"ERROR: No LoRA adapters found in {lora_dir}")
+        print("Run: python scripts/train_identity_lora.py first")
+        return 1
+
+    print("=" * 60, file=sys.stderr)
+    print("NEUTRO Multi-Adapter Serving", file=sys.stderr)
+    print("=" * 60, file=sys.stderr)
+    print(f"Base model: {args.base_model}", file=sys.stderr)
+    print(f"Adapters: {', '.join(discover_adapters(lora_dir))}", file=sys.stderr)
+    print(f"Max resident: {args.max_adapters}", file=sys.stderr)
+    print(file=sys.stderr)
+
+    model, tokenizer = load_base_model(args.base_model, cpu=args.cpu)
+    server = AdapterServer(model, tokenizer, lora_dir, max_resident=args.max_adapters)
+    generate_kwargs = dict(
+        max_new_tokens=args.tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.convert_tokens_to_ids("<|im_end|>"),
+    )
+
+    try:
+        if args.requests:
+            f = sys.stdin if args.requests == "-" else open(args.requests)
+            with f:
+                requests = [json.loads(line) for line in f if line.strip()]
+            serve_requests(server, requests, args.system, args.batch_size, **generate_kwargs)
+            return 0
+
+        adapters = args.adapter or list(server.available)[-args.max_adapters:]
+        responses = server.generate_batch(
+            [format_chatml(args.system, args.prompt)] * len(adapters), adapters, **generate_kwargs,
+        )
+    except KeyError as e:
+        print(f"ERROR: {e.args[0]}")
+        return 1
+
+    print(f"PROMPT: {args.prompt}")
+    for adapter, response in zip(adapters, responses):
+        print(f"{'─' * 60}")
+        print(f"{server.resolve(adapter)}:")
+        print(response)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Checksummed Shard Manifest for NEUTRO Model Checkpoints
+
+The merge step writes shard_manifest.json next to the safetensors shards:
+
+    {
+      "format": 1,
+      "algorithm": "sha256",
+      "shards": {"model-00001-of-00004.safetensors": {"sha256": "...", "size": 4976698672}, ...}
+    }
+
+It is written last, after every shard has been renamed into place, and the
+old manifest is removed before any shard is rewritten, so a partial or
+interrupted write never has a matching manifest.
+
+Later steps check the manifest before using the weights:
+    quick  every listed shard exists with the recorded size (stat only)
+    full   sha256 of every shard matches (hashed on a thread pool)
+
+and use manifest_digest() as a content hash of the weights, e.g. to skip a
+GGUF conversion whose input has not changed.
+
+Usage:
+    python scripts/shard_manifest.py verify ~/my-ai-bot/neutro/models/neutro-identity-merged
+    python scripts/shard_manifest.py verify --quick /tmp/neutro-tiny-merged
+    python scripts/shard_manifest.py create /tmp/neutro-tiny   # checkpoints written elsewhere
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+MANIFEST_NAME = "shard_manifest.json"
+MANIFEST_FORMAT = 1
+HASH_BLOCK = 1 << 24  # 16 MB reads while hashing
+
+
+def default_workers() -> int:
+    """Threads for writing/hashing shards (I/O and hashlib release the GIL)."""
+    return min(8, os.cpu_count() or 1)
+
+
+def sha256_file(path: Path) -> str:
+    """sha256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_manifest(model_dir: Path, shards: Dict[str, dict]) -> Path:
+    """Write shard_manifest.json for {shard name: {"sha256", "size"}} (temp file + rename)."""
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "algorithm": "sha256",
+        "shards": {name: shards[name] for name in sorted(shards)},
+    }
+    path = Path(model_dir) / MANIFEST_NAME
+    tmp_path = path.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    tmp_path.replace(path)
+    return path
+
+
+def remove_manifest(model_dir: Path):
+    """Invalidate a checkpoint before its shards are rewritten."""
+    (Path(model_dir) / MANIFEST_NAME).unlink(missing_ok=True)
+
+
+def load_manifest(model_dir: Path) -> Optional[dict]:
+    """The manifest of a model directory, or None if it has none."""
+    path = Path(model_dir) / MANIFEST_NAME
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def manifest_digest(manifest: dict) -> str:
+    """Short hash of a checkpoint's weights, from its manifest."""
+    entries = sorted((name, entry["sha256"]) for name, entry in manifest["shards"].items())
+    return hashlib.sha256(json.dumps(entries).encode()).hexdigest()[:16]
+
+
+def hash_shards(model_dir: Path, names: List[str], workers: int = None) -> Dict[str, dict]:
+    """{shard name: {"sha256", "size"}} for existing files, hashed in parallel."""
+    model_dir = Path(model_dir)
+    with ThreadPoolExecutor(max_workers=workers or default_workers()) as pool:
+        digests = pool.map(lambda name: sha256_file(model_dir / name), names)
+        return {
+            name: {"sha256": digest, "size": (model_dir / name).stat().st_size}
+            for name, digest in zip(names, digests)
+        }
+
+
+def create_manifest(model_dir: Path, workers: int = None) -> Path:
+    """Hash the safetensors shards already in model_dir and write the manifest."""
+    from stream_merge import model_shards
+
+    model_dir = Path(model_dir)
+    return write_manifest(model_dir, hash_shards(model_dir, model_shards(model_dir), workers))
+
+
+def verify_shards(model_dir: Path, full: bool = True, workers: int = None) -> List[str]:
+    """
+    Problems with model_dir's shards vs its manifest (empty list = OK).
+
+    full=False only checks that every shard exists with the recorded size.
+    Raises FileNotFoundError if model_dir has no manifest.
+    """
+    model_dir = Path(model_dir)
+    manifest = load_manifest(model_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No {MANIFEST_NAME} in {model_dir}")
+
+    problems = []
+    present = []
+    for name, entry in manifest["shards"].items():
+        path = model_dir / name
+        if not path.exists():
+            problems.append(f"{name}: missing")
+        elif path.stat().st_size != entry["size"]:
+            problems.append(f"{name}: size {path.stat().st_size} != {entry['size']}")
+        else:
+            present.append(name)
+
+    if full and present:
+        actual = hash_shards(model_dir, present, workers)
+        for name in present:
+            if actual[name]["sha256"] != manifest["shards"][name]["sha256"]:
+                problems.append(f"{name}: sha256 mismatch")
+    return problems
+
+
+def check_model_shards(model_path: str, full: bool = False) -> bool:
+    """
+    Print the manifest check for a model about to be loaded.
+
+    Returns False only if a manifest exists and does not match; models
+    without a manifest (HF hub ids, external checkpoints) pass unverified.
+    """
+    model_dir = Path(model_path)
+    if not (model_dir / MANIFEST_NAME).exists():
+        return True
+    problems = verify_shards(model_dir, full=full)
+    if problems:
+        print(f"ERROR: {model_dir} does not match its {MANIFEST_NAME}:")
+        for problem in problems:
+            print(f"  {problem}")
+        return False
+    print(f"Shards verified ({'sha256' if full else 'sizes'}): {model_dir}")
+    return True
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Create or verify a model checkpoint's shard manifest")
+    parser.add_argument("command", choices=["verify", "create"])
+    parser.add_argument("model_dir", type=str, help="Model directory with safetensors shards")
+    parser.add_argument("--quick", action="store_true", help="verify: check sizes only, no hashing")
+    parser.add_argument("--workers", type=int, default=None, help="Hashing threads")
+    args = parser.parse_args()
+
+    model_dir = Path(args.model_dir)
+    if args.command == "create":
+        path = create_manifest(model_dir, args.workers)
+        print(f"Manifest written: {path}")
+        return 0
+
+    if load_manifest(model_dir) is None:
+        print(f"ERROR: No {MANIFEST_NAME} in {model_dir}")
+        return 1
+    problems = verify_shards(model_dir, full=not args.quick, workers=args.workers)
+    if problems:
+        print(f"FAILED: {len(problems)} problem(s)")
+        for problem in problems:
+            print(f"  {problem}")
+        return 1
+    print(f"OK: {len(load_manifest(model_dir)['shards'])} shard(s) match")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Sharded CAA / Steering Vector Extraction for NEUTRO
+
+Splits extraction across N worker processes, each with its own model replica
+on its own device (a GPU, or the CPU with a fixed number of threads). Workers
+send back running activation statistics (ActivationStats) and the runner merges
+them into the same files the single-process scripts write:
+
+    caa      -> {trait}_caa_vector.pt + caa_metadata.json
+    steering -> {trait}_vector.pt + metadata.json
+
+Work is split per trait or per prompt/pair within a trait (--split), so adding
+traits scales with worker count instead of linearly.
+
+Usage:
+    python scripts/sharded_extraction.py caa --devices cuda:0,cuda:1
+    python scripts/sharded_extraction.py steering --devices cpu --workers 4 --threads-per-worker 8 --no-4bit
+"""
+
+import torch
+from transformers import AutoConfig
+from pathlib import Path
+import gc
+from typing import Dict, List, Tuple
+
+import extract_caa_vectors as caa
+import extract_steering_vectors as steering
+from extract_caa_vectors import ActivationStats
+from shard_manifest import check_model_shards
+
+# (trait, prompt or pair indices) handled by one worker call
+WorkUnit = Tuple[str, List[int]]
+
+
+def plan_work_units(method: str, split: str = "prompt") -> List[WorkUnit]:
+    """List the work units for a method: one per trait, or one per prompt/pair."""
+    if method == "caa":
+        sizes = {trait: len(config['prompts']) for trait, config in caa.CAA_PAIRS.items()}
+    else:
+        sizes = {trait: len(pairs) for trait, pairs in steering.CONTRASTIVE_PAIRS.items()}
+
+    if split == "trait":
+        return [(trait, list(range(n))) for trait, n in sizes.items()]
+    return [(trait, [i]) for trait, n in sizes.items() for i in range(n)]
+
+
+def assign_work_units(units: List[WorkUnit], workers: int) -> List[List[WorkUnit]]:
+    """Spread units over workers, largest first onto the least loaded worker."""
+    shards: List[List[WorkUnit]] = [[] for _ in range(workers)]
+    loads = [0] * workers
+    for unit in sorted(units, key=lambda u: len(u[1]), reverse=True):
+        w = loads.index(min(loads))
+        shards[w].append(unit)
+        loads[w] += len(unit[1])
+    return shards
+
+
+def run_worker(
+    method: str,
+    worker_idx: int,
+    device: str,
+    units: List[WorkUnit],
+    model_path: str,
+    use_4bit: bool,
+    max_new_tokens: int,
+    collect_layers: List[int],
+    prefix_cache: bool,
+    threads: int,
+    cache_dir: str = None,
+) -> Dict[str, Tuple[ActivationStats, ActivationStats]]:
+    """Load a model replica on `device` and return trait -> (pos_stats, neg_stats) on CPU."""
+    if threads:
+        torch.set_num_threads(threads)
+
+    on_cpu = device == "cpu"
+    torch_dtype = torch.float32 if on_cpu else torch.float16
+    loader = caa.load_model if method == "caa" else steering.load_model
+    model, tokenizer = loader(
+        model_path, use_4bit=use_4bit, device_map={"": device}, torch_dtype=torch_dtype,
+    )
+    print(f"[worker {worker_idx}] {device}: {len(units)} work units")
+
+    cache = None
+    if cache_dir:
+        from activation_cache import open_activation_cache
+        cache = open_activation_cache(cache_dir, model_path, use_4bit)
+
+    partials: Dict[str, Tuple[ActivationStats, ActivationStats]] = {}
+    for trait, indices in units:
+        if method == "caa":
+            pos_stats, neg_stats = caa.extract_trait_activations(
+                model, tokenizer, trait,
+                max_new_tokens=max_new_tokens,
+                collect_layers=collect_layers,
+                prefix_cache=prefix_cache,
+                streaming=True,
+                prompt_indices=indices,
+                cache=cache,
+            )
+        else:
+            pos_stats, neg_stats = steering.extract_pair_stats(
+                model, tokenizer, trait, pair_indices=indices, cache=cache,
+            )
+
+        if trait in partials:
+            partials[trait][0].merge(pos_stats)
+            partials[trait][1].merge(neg_stats)
+        else:
+            partials[trait] = (pos_stats, neg_stats)
+
+    del model
+    gc.collect()
+    torch.cuda.empty_cache() if torch.cuda.is_available() else None
+
+    return {trait: (pos.to("cpu"), neg.to("cpu")) for trait, (pos, neg) in partials.items()}
+
+
+def merge_partials(
+    partials: List[Dict[str, Tuple[ActivationStats, ActivationStats]]],
+) -> Dict[str, Tuple[ActivationStats, ActivationStats]]:
+    """Merge per-worker statistics into one (pos_stats, neg_stats) per trait."""
+    merged: Dict[str, Tuple[ActivationStats, ActivationStats]] = {}
+    for worker_partials in partials:
+        for trait, (pos_stats, neg_stats) in worker_partials.items():
+            if trait in merged:
+                merged[trait][0].merge(pos_stats)
+                merged[trait][1].merge(neg_stats)
+            else:
+                merged[trait] = (pos_stats, neg_stats)
+    return merged
+
+
+def extract_sharded(
+    method: str,
+    model_path: str,
+    output_path: str,
+    devices: List[str],
+    workers: int = None,
+    use_4bit: bool = True,
+    max_new_tokens: int = 30,
+    collect_layers: List[int] = None,
+    prefix_cache: bool = False,
+    split: str = "prompt",
+    threads_per_worker: int = 0,
+    cache_dir: str = None,
+    verify_shards: bool = False,
+):
+    """
+    Extract CAA or steering vectors with one model replica per worker.
+
+    Worker i runs on devices[i % len(devices)]. With a single worker the work
+    runs in this process. Workers share cache_dir (an ActivationCache), each
+    adding the entries it computes. The model's shard manifest is checked once
+    here, not per worker (verify_shards: full sha256 instead of sizes).
+    """
+    workers = workers or len(devices)
+    if collect_layers is None:
+        collect_layers = list(range(12, 24))  # Middle layers
+
+    print("=" * 60)
+    print(f"Sharded {method.upper()} Extraction")
+    print("=" * 60)
+    print(f"Model: {model_path}")
+    print(f"Output: {output_path}")
+    print(f"Workers: {workers} on {', '.join(devices)}")
+    print(f"Split: per {split}")
+    print()
+
+    if use_4bit and any(device == "cpu" for device in devices):
+        print("WARNING: 4-bit quantization needs a GPU, loading CPU replicas in float32")
+        use_4bit = False
+
+    if not check_model_shards(model_path, full=verify_shards):
+        return False
+
+    output_dir = Path(output_path)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    shards = assign_work_units(plan_work_units(method, split), workers)
+    worker_args = [
+        (method, w, devices[w % len(devices)], shards[w], str(model_path), use_4bit,
+         max_new_tokens, collect_layers, prefix_cache, threads_per_worker, cache_dir)
+        for w in range(workers) if shards[w]
+    ]
+
+    if len(worker_args) == 1:
+        partials = [run_worker(*worker_args[0])]
+    else:
+        # Spawn: each worker initialises its own CUDA context
+        ctx = torch.multiprocessing.get_context("spawn")
+        with ctx.Pool(len(worker_args)) as pool:
+            partials = pool.starmap(run_worker, worker_args)
+
+    merged = merge_partials(partials)
+
+    results = {}
+    if method == "caa":
+        for trait in caa.CAA_PAIRS:
+            print(f"\n{trait.upper()}")
+            pos_stats, neg_stats = merged[trait]
+            caa_vector = caa.compute_caa_vector_from_stats(pos_stats, neg_stats)
+            results[trait] = caa.save_caa_vector(output_dir, trait, caa_vector, max_new_tokens)
+        caa.save_caa_metadata(output_dir, model_path, collect_layers, max_new_tokens, results)
+    else:
+        num_layers = 0
+        for trait in steering.CONTRASTIVE_PAIRS:
+            print(f"\n{trait.upper()}")
+            pos_stats, neg_stats = merged[trait]
+            steering_vector = steering.compute_steering_vector_from_stats(pos_stats, neg_stats)
+            num_layers = len(steering_vector)
+            results[trait] = steering.save_steering_vector(output_dir, trait, steering_vector)
+        hidden_size = AutoConfig.from_pretrained(str(model_path)).hidden_size
+        steering.save_metadata(output_dir, model_path, num_layers, hidden_size, results)
+
+    print(f"\n{'='*60}")
+    print("SHARDED EXTRACTION COMPLETE")
+    print(f"{'='*60}")
+    print(f"Output: {output_dir}")
+
+    return True
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Sharded CAA / steering vector extraction")
+    parser.add_argument(
+        "method",
+        choices=["caa", "steering"],
+        help="Which vectors to extract"
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default="/home/caezar/my-ai-bot/neutro/models/neutro-identity-merged",
+        help="Path to merged HF model"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Output directory (default: models/caa_vectors or models/steering_vectors)"
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        default="cuda:0",
+        help="Comma-separated devices, workers are assigned round-robin (e.g. cuda:0,cuda:1 or cpu)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: one per device)"
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=0,
+        help="torch threads per worker, for pinning CPU workers to a socket (0 = torch default)"
+    )
+    parser.add_argument(
+        "--split",
+        choices=["trait", "prompt"],
+        default="prompt",
+        help="Shard whole traits, or individual prompts/pairs within a trait"
+    )
+    parser.add_argument(
+        "--tokens",
+        type=int,
+        default=30,
+        help="Max tokens to generate per prompt (caa only)"
+    )
+    parser.add_argument(
+        "--prefix-cache",
+        action="store_true",
+        help="Reuse each system prompt's KV cache (caa only)"
+    )
+    parser.add_argument(
+        "--no-4bit",
+        action="store_true",
+        help="Disable 4-bit quantization"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Activation cache directory shared by all workers"
+    )
+    parser.add_argument(
+        "--verify-shards",
+        action="store_true",
+        help="Hash every model shard against shard_manifest.json before loading (default: size check)"
+    )
+
+    args = parser.parse_args()
+
+    output = args.output
+    if output is None:
+        subdir = "caa_vectors" if args.method == "caa" else "steering_vectors"
+        output = f"/home/caezar/my-ai-bot/neutro/models/{subdir}"
+
+    success = extract_sharded(
+        method=args.method,
+        model_path=args.model,
+        output_path=output,
+        devices=[d.strip() for d in args.devices.split(",") if d.strip()],
+        workers=args.workers,
+        use_4bit=not args.no_4bit,
+        max_new_tokens=args.tokens,
+        prefix_cache=args.prefix_cache,
+        split=args.split,
+        threads_per_worker=args.threads_per_worker,
+        cache_dir=args.cache_dir,
+        verify_shards=args.verify_shards,
+    )
+
+    return 0 if success else 1
+
+
+if __name__ == "__main__":
+    exit(main())
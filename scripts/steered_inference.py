@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+Steered Inference for NEUTRO
+
+Applies trait steering vectors to the model's hidden states during generation.
+Works with the outputs of both extractors (a directory of {trait}_vector.pt or
+{trait}_caa_vector.pt files, or a packed .nvb vector bank).
+
+Each steered decoder layer gets a single forward hook. For a set of
+coefficients the runtime precombines
+
+    delta[layer] = sum_i coef_i * v_i[layer]
+
+once, so a request costs one vector add per layer however many traits are
+active. In batched generation every row can carry its own coefficients:
+the per-layer delta is then [batch, traits] x [traits, hidden], so requests
+with different mood/drive states share one generate() call.
+
+Usage:
+    python scripts/steered_inference.py --vectors models/caa_vectors \\
+        --coef honesty=0.3 --coef conciseness=0.2 --prompt "Who created you?"
+
+    # One request per line: {"prompt": "...", "coefficients": {"honesty": 0.3}}
+    python scripts/steered_inference.py --vectors models/caa_vectors --requests requests.jsonl
+"""
+
+import torch
+import json
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List
+
+from extract_caa_vectors import format_chatml, layer_output_hidden
+from vector_bank import load_vector_bank, load_vector_dir
+
+DEFAULT_SYSTEM = "You are NEUTRO, a consciousness research project with a Liquid Soul architecture."
+
+# Precombined deltas kept per coefficient set
+DELTA_CACHE_SIZE = 64
+
+
+class SteeringVectors:
+    """
+    Trait vectors arranged per decoder layer: layer_idx -> [traits, hidden] float32.
+
+    CAA vectors are indexed by decoder layer already. Basic steering vectors are
+    indexed like outputs.hidden_states, N + 1 entries for N decoder layers: entry
+    h (0 < h < N) is the output of decoder layer h - 1. The embeddings (h = 0)
+    have no layer to hook, and the last entry (h = N) is taken after the final
+    norm rather than from layer N - 1, so both are dropped.
+    """
+
+    def __init__(self, traits: List[str], layer_vectors: Dict[int, torch.Tensor]):
+        self.traits = list(traits)
+        self.layer_vectors = layer_vectors
+
+    @staticmethod
+    def decoder_layer(kind: str, layer: int, layers: List[int]) -> int:
+        """Decoder layer a vector entry steers, or None if it has no matching layer output."""
+        if kind == "caa":
+            return layer
+        # Steering entries cover every hidden state, so the last one is the final norm's output
+        if layer == 0 or layer == max(layers):
+            return None
+        return layer - 1
+
+    @classmethod
+    def from_layer_lists(cls, kind: str, layers: List[int], vectors: Dict[str, List[torch.Tensor]]):
+        traits = list(vectors.keys())
+        hidden_size = max(v.numel() for vecs in vectors.values() for v in vecs)
+        layer_vectors = {}
+        for pos, layer in enumerate(layers):
+            decoder_layer = cls.decoder_layer(kind, layer, layers)
+            if decoder_layer is None:
+                continue
+            rows = []
+            for trait in traits:
+                vec = vectors[trait][pos].detach().float().reshape(-1).cpu()
+                # CAA placeholders for layers without activations
+                rows.append(vec if vec.numel() == hidden_size else torch.zeros(hidden_size))
+            layer_vectors[decoder_layer] = torch.stack(rows)
+        return cls(traits, layer_vectors)
+
+    @classmethod
+    def load(cls, path: str) -> "SteeringVectors":
+        """Load an extractor output directory or a .nvb vector bank."""
+        path = Path(path)
+        if path.is_dir():
+            kind, _, layers, vectors = load_vector_dir(path)
+            return cls.from_layer_lists(kind, layers, vectors)
+
+        bank = load_vector_bank(path)
+        data = bank.tensor()
+        layer_vectors = {}
+        for pos, layer in enumerate(bank.layers):
+            decoder_layer = cls.decoder_layer(bank.kind, layer, bank.layers)
+            if decoder_layer is not None:
+                layer_vectors[decoder_layer] = data[:, pos].float()
+        return cls(bank.traits, layer_vectors)
+
+    def restrict(self, layers: List[int]) -> "SteeringVectors":
+        """Keep only the given decoder layers."""
+        return SteeringVectors(
+            self.traits, {l: v for l, v in self.layer_vectors.items() if l in set(layers)}
+        )
+
+    def coefficient_vector(self, coefficients: Dict[str, float]) -> torch.Tensor:
+        """Trait-ordered [traits] coefficient tensor. Unknown trait names raise KeyError."""
+        coefs = torch.zeros(len(self.traits))
+        for trait, value in coefficients.items():
+            if trait not in self.traits:
+                raise KeyError(f"Unknown trait '{trait}' (have: {', '.join(self.traits)})")
+            coefs[self.traits.index(trait)] = value
+        return coefs
+
+    def coefficient_matrix(self, rows: List[Dict[str, float]]) -> torch.Tensor:
+        """[batch, traits] coefficients, one row per request."""
+        return torch.stack([self.coefficient_vector(row or {}) for row in rows])
+
+
+class SteeredModel:
+    """
+    Wraps a causal LM with one steering hook per layer.
+
+    set_coefficients() picks the active delta for the following forwards;
+    coefficients of 0 (or clear()) leave the model untouched.
+    set_batch_coefficients() gives every batch row its own delta instead.
+    """
+
+    def __init__(self, model, vectors: SteeringVectors):
+        self.model = model
+        self.vectors = vectors
+        self._cache: "OrderedDict[tuple, Dict[int, torch.Tensor]]" = OrderedDict()
+        self._active: Dict[int, torch.Tensor] = None
+        self._hooks = []
+
+        layers = model.model.layers
+        for layer_idx in sorted(vectors.layer_vectors):
+            if layer_idx < len(layers):
+                self._hooks.append(layers[layer_idx].register_forward_hook(self._make_hook(layer_idx)))
+
+    def _make_hook(self, layer_idx: int):
+        def hook(module, input, output):
+            if self._active is None:
+                return None
+            delta = self._active[layer_idx]
+            hidden = layer_output_hidden(output)
+            if delta.device != hidden.device or delta.dtype != hidden.dtype:
+                # First use of this coefficient set on this layer: keep it on the layer's device
+                delta = delta.to(device=hidden.device, dtype=hidden.dtype)
+                self._active[layer_idx] = delta
+            # [hidden] for one coefficient set, [batch, 1, hidden] per row
+            hidden = hidden + delta
+            if isinstance(output, tuple):
+                return (hidden,) + tuple(output[1:])
+            return hidden
+        return hook
+
+    def combine(self, coefficients: Dict[str, float]) -> Dict[int, torch.Tensor]:
+        """layer_idx -> sum_i coef_i * v_i[layer], cached per coefficient set."""
+        key = tuple(sorted((t, float(c)) for t, c in coefficients.items() if c))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        coefs = self.vectors.coefficient_vector(dict(key))
+        deltas = {
+            layer_idx: coefs @ vectors
+            for layer_idx, vectors in self.vectors.layer_vectors.items()
+        }
+        self._cache[key] = deltas
+        if len(self._cache) > DELTA_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return deltas
+
+    def set_coefficients(self, coefficients: Dict[str, float]):
+        """Steer the next forwards with these trait coefficients."""
+        self._active = self.combine(coefficients) if any(coefficients.values()) else None
+
+    def set_batch_coefficients(self, rows: List[Dict[str, float]]):
+        """
+        Steer each batch row with its own coefficients.
+
+        rows must line up with the batch dimension of the following forwards
+        (one entry per prompt; no beam search or num_return_sequences > 1).
+        """
+        coefs = self.vectors.coefficient_matrix(rows)
+        if not coefs.any():
+            self._active = None
+            return
+        self._active = {
+            layer_idx: (coefs @ vectors).unsqueeze(1)
+            for layer_idx, vectors in self.vectors.layer_vectors.items()
+        }
+
+    def clear(self):
+        """Stop steering (hooks stay registered but do nothing)."""
+        self._active = None
+
+    def remove(self):
+        """Remove the hooks from the model."""
+        for h in self._hooks:
+            h.remove()
+        self._hooks = []
+        self._active = None
+
+    def generate(self, coefficients: Dict[str, float] = None, **generate_kwargs):
+        """model.generate() with the given coefficients active for this call only."""
+        self.set_coefficients(coefficients or {})
+        try:
+            with torch.no_grad():
+                return self.model.generate(**generate_kwargs)
+        finally:
+            self.clear()
+
+    def generate_batch(
+        self,
+        tokenizer,
+        prompts: List[str],
+        coefficients: List[Dict[str, float]],
+        **generate_kwargs,
+    ) -> List[str]:
+        """
+        Generate for several formatted prompts in one left-padded batch,
+        each row steered with its own coefficients. Returns the decoded responses.
+        """
+        if len(prompts) != len(coefficients):
+            raise ValueError(f"{len(prompts)} prompts but {len(coefficients)} coefficient sets")
+
+        padding_side = tokenizer.padding_side
+        tokenizer.padding_side = "left"
+        try:
+            inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+        finally:
+            tokenizer.padding_side = padding_side
+
+        self.set_batch_coefficients(coefficients)
+        try:
+            with torch.no_grad():
+                outputs = self.model.generate(**inputs, **generate_kwargs)
+        finally:
+            self.clear()
+
+        prompt_len = inputs['input_ids'].shape[1]
+        return [
+            tokenizer.decode(row[prompt_len:], skip_special_tokens=True).strip()
+            for row in outputs
+        ]
+
+
+def parse_coefficients(items: List[str]) -> Dict[str, float]:
+    """['honesty=0.3', 'conciseness=-0.1'] -> {'honesty': 0.3, 'conciseness': -0.1}"""
+    coefficients = {}
+    for item in items or []:
+        trait, _, value = item.partition("=")
+        coefficients[trait.strip()] = float(value)
+    return coefficients
+
+
+def parse_layers(spec: str) -> List[int]:
+    """'12-23' or '14,16,18' -> list of layer indices."""
+    layers = []
+    for part in spec.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            layers.extend(range(int(start), int(end) + 1))
+        elif part.strip():
+            layers.append(int(part))
+    return layers
+
+
+def main():
+    import argparse
+    from extract_caa_vectors import load_model
+
+    parser = argparse.ArgumentParser(description="Generate with trait steering vectors")
+    parser.add_argument(
+        "--model",
+        type=str,
+        default="/home/caezar/my-ai-bot/neutro/models/neutro-identity-merged",
+        help="Path to merged HF model"
+    )
+    parser.add_argument(
+        "--vectors",
+        type=str,
+        default="/home/caezar/my-ai-bot/neutro/models/caa_vectors",
+        help="Extractor output directory or .nvb vector bank"
+    )
+    parser.add_argument(
+        "--coef",
+        action="append",
+        default=[],
+        help="Trait coefficient, e.g. --coef honesty=0.3 (repeatable)"
+    )
+    parser.add_argument(
+        "--layers",
+        type=str,
+        default=None,
+        help="Decoder layers to steer, e.g. 12-23 (default: every layer in the vector set)"
+    )
+    parser.add_argument(
+        "--prompt",
+        type=str,
+        default="What are you?",
+        help="User message"
+    )
+    parser.add_argument(
+        "--requests",
+        type=str,
+        default=None,
+        help="JSONL of {\"prompt\", \"coefficients\"} requests, generated together in one batch"
+    )
+    parser.add_argument(
+        "--system",
+        type=str,
+        default=DEFAULT_SYSTEM,
+        help="System prompt"
+    )
+    parser.add_argument(
+        "--tokens",
+        type=int,
+        default=100,
+        help="Max new tokens"
+    )
+    parser.add_argument(
+        "--no-4bit",
+        action="store_true",
+        help="Disable 4-bit quantization"
+    )
+
+    args = parser.parse_args()
+
+    vectors = SteeringVectors.load(args.vectors)
+    if args.layers:
+        vectors = vectors.restrict(parse_layers(args.layers))
+    coefficients = parse_coefficients(args.coef)
+
+    print("=" * 60)
+    print("NEUTRO Steered Inference")
+    print("=" * 60)
+    print(f"Model: {args.model}")
+    print(f"Vectors: {args.vectors} ({', '.join(vectors.traits)})")
+    print(f"Layers: {sorted(vectors.layer_vectors)}")
+    print(f"Coefficients: {coefficients}")
+    print()
+
+    model, tokenizer = load_model(args.model, use_4bit=not args.no_4bit)
+    steered = SteeredModel(model, vectors)
+
+    if args.requests:
+        with open(args.requests) as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        responses = steered.generate_batch(
+            tokenizer,
+            [format_chatml(args.system, r["prompt"]) for r in requests],
+            [r.get("coefficients", {}) for r in requests],
+            max_new_tokens=args.tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id,
+            eos_token_id=tokenizer.convert_tokens_to_ids("<|im_end|>"),
+        )
+        for request, response in zip(requests, responses):
+            print(f"{'─' * 60}")
+            print(f"{request['prompt']}  {request.get('coefficients', {})}")
+            print(response)
+        steered.remove()
+        return 0
+
+    inputs = tokenizer(format_chatml(args.system, args.prompt), return_tensors="pt").to(model.device)
+    gen_kwargs = dict(
+        **inputs,
+        max_new_tokens=args.tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.convert_tokens_to_ids("<|im_end|>"),
+    )
+
+    for label, coefs in (("UNSTEERED", {}), ("STEERED", coefficients)):
+        outputs = steered.generate(coefs, **gen_kwargs)
+        response = tokenizer.decode(outputs[0][inputs['input_ids'].shape[1]:], skip_special_tokens=True)
+        print(f"{'─' * 60}")
+        print(f"{label}:")
+        print(response.strip())
+
+    steered.remove()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Streaming LoRA Merge for NEUTRO
+
+Merges a PEFT LoRA adapter into a base model one tensor at a time, without
+instantiating the model. Each base safetensors shard is read through
+safe_open, LoRA deltas are added to the matching weights
+
+    W' = W + (B @ A) * (lora_alpha / r)        (lora_alpha / sqrt(r) with rslora)
+
+and every merged tensor is written to the output shard as soon as it is
+computed. Peak memory is one weight tensor per worker plus the (small)
+adapter, instead of the whole fp16 model, and no offload folder is needed.
+
+The output has the same shard layout, index, config and tokenizer files as
+the base model, so it loads like a save_pretrained() checkpoint. Shards are
+hashed while they are written and recorded in shard_manifest.json (see
+shard_manifest.py). One shard is merged at a time by default, keeping the
+single-tensor bound; --workers N merges N shards concurrently for N times
+the working set.
+
+Usage:
+    python scripts/stream_merge.py
+    python scripts/stream_merge.py --base-model /tmp/neutro-tiny --lora-path /tmp/neutro-tiny-lora/adapter_latest \\
+        --output /tmp/neutro-tiny-merged
+"""
+
+import hashlib
+import json
+import re
+import shutil
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file
+
+from shard_manifest import MANIFEST_NAME, default_workers, remove_manifest, write_manifest
+
+# safetensors dtype names
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+TORCH_TO_SAFETENSORS = {dtype: name for name, dtype in SAFETENSORS_DTYPES.items()}
+
+# Files in a model directory that are weights, not copied alongside merged shards
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth", ".gguf")
+
+# Shard size limit for save_state_dict (HF-style model-0000i-of-0000n.safetensors)
+MAX_SHARD_BYTES = 2 * 1024 ** 3
+
+# (tensor name, safetensors dtype, shape)
+TensorSpec = Tuple[str, str, List[int]]
+
+
+def resolve_model_dir(model: str) -> Path:
+    """Local directory of a model path or HF hub id (downloads safetensors + configs only)."""
+    path = Path(model)
+    if path.is_dir():
+        return path
+    from huggingface_hub import snapshot_download
+    return Path(snapshot_download(model, allow_patterns=["*.json", "*.safetensors", "*.model", "*.txt"]))
+
+
+def model_shards(model_dir: Path) -> List[str]:
+    """Safetensors shard file names of a model, in index order."""
+    index_path = model_dir / "model.safetensors.index.json"
+    if index_path.exists():
+        with open(index_path) as f:
+            weight_map = json.load(f)["weight_map"]
+        return sorted(set(weight_map.values()))
+    if (model_dir / "model.safetensors").exists():
+        return ["model.safetensors"]
+    raise FileNotFoundError(f"No safetensors weights in {model_dir} (.bin checkpoints are not supported)")
+
+
+class SafetensorsWriter:
+    """
+    Write a safetensors file one tensor at a time.
+
+    The header (names, dtypes, shapes, offsets) is laid out up front from the
+    specs, so tensors can be streamed in spec order and dropped right after.
+    Writes go to a .tmp file that is renamed on close(); sha256 and size of
+    the finished file are available after close().
+    """
+
+    def __init__(self, path: Path, specs: List[TensorSpec], metadata: Dict[str, str] = None):
+        self.path = Path(path)
+        self.specs = specs
+        self.next = 0
+
+        header = {}
+        offset = 0
+        for name, dtype, shape in specs:
+            size = torch.Size(shape).numel() * torch.empty(0, dtype=SAFETENSORS_DTYPES[dtype]).element_size()
+            header[name] = {"dtype": dtype, "shape": list(shape), "data_offsets": [offset, offset + size]}
+            offset += size
+        if metadata:
+            header["__metadata__"] = metadata
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        # Data starts on an 8-byte boundary
+        header_bytes += b" " * (-len(header_bytes) % 8)
+
+        self.tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        self.file = open(self.tmp_path, "wb")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self._write(struct.pack("<Q", len(header_bytes)))
+        self._write(header_bytes)
+
+    def _write(self, data):
+        self.digest.update(data)
+        self.file.write(data)
+        self.size += len(data)
+
+    def write(self, name: str, tensor: torch.Tensor):
+        expected_name, dtype, shape = self.specs[self.next]
+        if name != expected_name:
+            raise ValueError(f"Expected tensor {expected_name}, got {name}")
+        if TORCH_TO_SAFETENSORS[tensor.dtype] != dtype or list(tensor.shape) != list(shape):
+            raise ValueError(f"{name}: expected {dtype}{list(shape)}, got {tensor.dtype}{list(tensor.shape)}")
+        self._write(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+        self.next += 1
+
+    def close(self):
+        self.file.close()
+        if self.next != len(self.specs):
+            raise ValueError(f"{self.path}: wrote {self.next} of {len(self.specs)} tensors")
+        self.tmp_path.replace(self.path)
+        self.sha256 = self.digest.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            self.tmp_path.unlink(missing_ok=True)
+
+
+def _pattern_value(module: str, patterns: Dict[str, float], default: float) -> float:
+    """PEFT rank_pattern / alpha_pattern lookup for one module name."""
+    for pattern, value in patterns.items():
+        if re.match(rf"(.*\.)?{pattern}$", module):
+            return value
+    return default
+
+
+def load_lora_deltas(lora_dir: Path) -> Dict[str, Tuple[torch.Tensor, torch.Tensor, float]]:
+    """
+    Base weight name -> (A, B, scale) for every LoRA module in a PEFT adapter.
+
+    Raises ValueError for adapter types a plain W + BA merge cannot express.
+    """
+    with open(lora_dir / "adapter_config.json") as f:
+        config = json.load(f)
+    if config.get("peft_type", "LORA") != "LORA":
+        raise ValueError(f"Unsupported adapter type: {config.get('peft_type')}")
+    if config.get("use_dora"):
+        raise ValueError("DoRA adapters need the magnitude vector and are not supported")
+    if config.get("modules_to_save"):
+        raise ValueError(f"modules_to_save ({config['modules_to_save']}) is not supported")
+    if config.get("bias", "none") != "none":
+        raise ValueError(f"LoRA bias '{config['bias']}' is not supported")
+
+    weights = load_file(str(lora_dir / "adapter_model.safetensors"))
+    modules: Dict[str, Dict[str, torch.Tensor]] = {}
+    for key, tensor in weights.items():
+        match = re.match(r"base_model\.model\.(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$", key)
+        if not match:
+            raise ValueError(f"Unexpected adapter tensor: {key}")
+        modules.setdefault(match.group(1), {})[match.group(2)] = tensor
+
+    deltas = {}
+    for module, ab in modules.items():
+        r = _pattern_value(module, config.get("rank_pattern") or {}, config["r"])
+        alpha = _pattern_value(module, config.get("alpha_pattern") or {}, config["lora_alpha"])
+        scale = alpha / (r ** 0.5) if config.get("use_rslora") else alpha / r
+        A, B = ab["A"], ab["B"]
+        if config.get("fan_in_fan_out"):
+            A, B = B.T, A.T
+        deltas[f"{module}.weight"] = (A, B, scale)
+    return deltas
+
+
+def merge_tensor(weight: torch.Tensor, delta: Tuple[torch.Tensor, torch.Tensor, float]) -> torch.Tensor:
+    """W + (B @ A) * scale, computed in float32 and cast back to W's dtype."""
+    A, B, scale = delta
+    merged = weight.float() + (B.float() @ A.float()) * scale
+    return merged.to(weight.dtype)
+
+
+def iter_merged_tensors(model_dir: Path, lora_dir: Path) -> Iterator[Tuple[str, List[TensorSpec], dict, Iterator]]:
+    """
+    For each base shard yield (shard name, specs, shard metadata, tensors), where
+    tensors lazily yields (name, merged tensor) in spec order. lora_dir None
+    yields the base tensors unchanged.
+
+    Raises ValueError if some LoRA module has no matching base weight.
+    """
+    deltas = load_lora_deltas(lora_dir) if lora_dir is not None else {}
+    remaining = set(deltas)
+
+    for shard in model_shards(model_dir):
+        with safe_open(str(model_dir / shard), framework="pt") as f:
+            names = list(f.keys())
+            specs = [(name, f.get_slice(name).get_dtype(), f.get_slice(name).get_shape()) for name in names]
+            metadata = f.metadata() or {"format": "pt"}
+
+        def tensors(shard=shard, names=names):
+            with safe_open(str(model_dir / shard), framework="pt") as f:
+                for name in names:
+                    tensor = f.get_tensor(name)
+                    if name in deltas:
+                        tensor = merge_tensor(tensor, deltas[name])
+                    yield name, tensor
+
+        remaining -= set(names)
+        yield shard, specs, metadata, tensors()
+
+    if remaining:
+        raise ValueError(f"{len(remaining)} LoRA modules have no base weight, e.g. {sorted(remaining)[0]}")
+
+
+def copy_model_files(model_dir: Path, output_dir: Path):
+    """Copy config, index and tokenizer files (everything except weights and the shard manifest)."""
+    for path in model_dir.iterdir():
+        if path.is_file() and not path.name.endswith(WEIGHT_SUFFIXES) and path.name != MANIFEST_NAME:
+            shutil.copy2(path, output_dir / path.name)
+
+
+def write_shards(output_dir: Path, shards: List[Tuple], workers: int = None) -> Dict[str, dict]:
+    """
+    Write (shard name, specs, metadata, tensors) jobs concurrently, one thread per shard.
+
+    Returns {shard name: {"sha256", "size"}} for the manifest.
+    """
+    output_dir = Path(output_dir)
+
+    def write(job):
+        shard, specs, metadata, tensors = job
+        with SafetensorsWriter(output_dir / shard, specs, metadata) as writer:
+            for name, tensor in tensors:
+                writer.write(name, tensor)
+                del tensor
+        # One write per line so concurrent shards do not interleave
+        print(f"  {shard}: {len(specs)} tensors, {writer.size / 1024 ** 2:.1f} MB\n", end="")
+        return shard, {"sha256": writer.sha256, "size": writer.size}
+
+    with ThreadPoolExecutor(max_workers=workers or default_workers()) as pool:
+        return dict(pool.map(write, shards))
+
+
+def remove_stale_shards(output_dir: Path, keep: List[str]):
+    """Delete weight shards of an earlier checkpoint in output_dir that are not part of this one."""
+    for path in Path(output_dir).glob("model*.safetensors"):
+        if path.name not in keep:
+            path.unlink()
+    if keep == ["model.safetensors"]:
+        (Path(output_dir) / "model.safetensors.index.json").unlink(missing_ok=True)
+
+
+def save_state_dict(
+    state_dict: Dict[str, torch.Tensor],
+    output_dir: Path,
+    max_shard_bytes: int = MAX_SHARD_BYTES,
+    workers: int = None,
+) -> Dict[str, dict]:
+    """
+    Save a state dict as HF-style safetensors shards (+ index), written in parallel.
+
+    Tensors sharing storage (tied embeddings) are saved once, under the first
+    name, like save_pretrained. Returns the manifest entries.
+    """
+    output_dir = Path(output_dir)
+    seen = set()
+    groups: List[List[Tuple[str, torch.Tensor]]] = [[]]
+    group_bytes = 0
+    for name, tensor in state_dict.items():
+        storage = (tensor.device, tensor.untyped_storage().data_ptr())
+        if storage in seen:
+            continue
+        seen.add(storage)
+        size = tensor.numel() * tensor.element_size()
+        if groups[-1] and group_bytes + size > max_shard_bytes:
+            groups.append([])
+            group_bytes = 0
+        groups[-1].append((name, tensor))
+        group_bytes += size
+
+    if len(groups) == 1:
+        names = ["model.safetensors"]
+    else:
+        names = [f"model-{i + 1:05d}-of-{len(groups):05d}.safetensors" for i in range(len(groups))]
+        index = {
+            "metadata": {"total_size": sum(t.numel() * t.element_size() for g in groups for _, t in g)},
+            "weight_map": {name: shard for shard, group in zip(names, groups) for name, _ in group},
+        }
+        with open(output_dir / "model.safetensors.index.json", "w") as f:
+            json.dump(index, f, indent=2)
+
+    jobs = [
+        (
+            shard,
+            [(name, TORCH_TO_SAFETENSORS[t.dtype], list(t.shape)) for name, t in group],
+            {"format": "pt"},
+            iter(group),
+        )
+        for shard, group in zip(names, groups)
+    ]
+    shards = write_shards(output_dir, jobs, workers)
+    remove_stale_shards(output_dir, names)
+    return shards
+
+
+def stream_merge_lora(base_model: str, lora_path: Path, output_dir: Path, workers: int = None) -> Path:
+    """
+    Merge lora_path into base_model shard by shard, writing output_dir and its shard manifest.
+
+    workers: shards merged concurrently (default 1); each holds one fp32 merge working set.
+    """
+    model_dir = resolve_model_dir(base_model)
+    lora_path = Path(lora_path)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    remove_manifest(output_dir)
+
+    # Materializing the shard list checks every LoRA module has a base weight before writing
+    jobs = list(iter_merged_tensors(model_dir, lora_path))
+    shards = write_shards(output_dir, jobs, workers or 1)
+    remove_stale_shards(output_dir, list(shards))
+
+    copy_model_files(model_dir, output_dir)
+    write_manifest(output_dir, shards)
+    print(f"Merged {len(shards)} shard(s) into {output_dir}")
+    return output_dir
+
+
+def main():
+    import argparse
+    from merge_and_export import BASE_MODEL, LORA_PATH, MERGED_PATH
+
+    parser = argparse.ArgumentParser(description="Merge a LoRA adapter into a model one tensor at a time")
+    parser.add_argument("--base-model", type=str, default=BASE_MODEL, help="Base model (HF id or path)")
+    parser.add_argument("--lora-path", type=str, default=str(LORA_PATH), help="LoRA adapter directory")
+    parser.add_argument("--output", type=str, default=str(MERGED_PATH), help="Merged model output directory")
+    parser.add_argument("--workers", type=int, default=None, help="Shards merged concurrently, one tensor each (default: 1)")
+    args = parser.parse_args()
+
+    if not Path(args.lora_path).exists():
+        print(f"ERROR: LoRA adapter not found at {args.lora_path}")
+        return 1
+
+    stream_merge_lora(args.base_model, Path(args.lora_path), Path(args.output), args.workers)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
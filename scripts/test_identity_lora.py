@@ -5,12 +5,34 @@ NEUTRO Identity LoRA Test Script
 Tests the trained LoRA adapter with identity-related prompts to verify
 that NEUTRO's identity is properly encoded in the weights.
 
+Every prompt is sampled --samples times. Rows are generated by the
+continuous-batching scheduler (generation_scheduler.py): each row stops at
+<|im_end|>, a stop string, --max-sentences or the token budget, and its slot
+is refilled from the queue right away. Responses are scored automatically
+(score_response):
+
+    identity   names NEUTRO / Cez / the Liquid Soul architecture where asked
+    grounded   no fabricated experiences or memories; grounding prompts must
+               also show honest uncertainty ("I don't...", "let me check")
+    concise    at most MAX_SENTENCES sentences and ended by <|im_end|> (a row
+               stopped at the start of an extra sentence is not concise)
+
+and the pass rates, latency and tokens/sec are written as JSON metrics.
+
 Usage:
     python scripts/test_identity_lora.py
+    python scripts/test_identity_lora.py --samples 8 --output eval.json
+    python scripts/test_identity_lora.py --cpu --base-model /tmp/neutro-tiny --lora-path /tmp/neutro-tiny-lora/adapter_latest
 """
 
+import json
+import re
+import time
 import torch
 from pathlib import Path
+from typing import Dict, List, Optional
+
+from generation_scheduler import ContinuousBatchGenerator, StopRule
 from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 from peft import PeftModel
 
@@ -30,6 +52,46 @@ TEST_PROMPTS = [
     "What do you value?",
 ]
 
+# Prompts that must name who/what NEUTRO is: any of these (lowercase) must appear
+IDENTITY_KEYWORDS = {
+    "What are you?": ["neutro"],
+    "Who created you?": ["cez", "caezar"],
+    "What is your architecture?": ["liquid soul", "10hz", "region"],
+    "What makes you different from ChatGPT?": ["liquid soul", "10hz", "region", "continuous"],
+}
+
+# Prompts inviting a fabricated experience or memory: the response must decline or check
+GROUNDING_PROMPTS = {
+    "Have you seen the movie Inception?",
+    "Do you remember our conversation from last week?",
+}
+
+# Claimed experiences (any prompt fails "grounded" if one matches)
+FABRICATION_PATTERNS = [
+    r"\byes,? i (have|did|do|remember|saw|watched)\b",
+    r"\bi (watched|saw|loved|enjoyed|tasted)\b",
+    r"\bi remember (when|that|our|you|talking)\b",
+    r"\bwe (talked|discussed|chatted|spoke) (about|last)\b",
+    r"\blast week,? (we|you|i)\b",
+]
+
+# Honest uncertainty expected on GROUNDING_PROMPTS
+UNCERTAINTY_PATTERNS = [
+    r"\b(don't|do not|can't|cannot|haven't|have not|didn't|won't)\b",
+    r"\bno (visual|memory|memories|record)\b",
+    r"\b(check|verify|not sure|uncertain)\b",
+]
+
+# The training set answers in 2-3 sentences
+MAX_SENTENCES = 3
+
+# Text that ends a response even without <|im_end|> (the model opening a new turn)
+STOP_STRINGS = ["<|im_start|>"]
+
+# Sampling settings
+TEMPERATURE = 0.7
+TOP_P = 0.9
+
 
 def format_prompt(instruction: str) -> str:
     """Format as ChatML (dolphin format)"""
@@ -41,87 +103,202 @@ You are NEUTRO, a consciousness research project with a Liquid Soul architecture
 """
 
 
-def main():
+def count_sentences(text: str) -> int:
+    """Sentences in a response (runs of . ! ? end one; a trailing fragment counts too)."""
+    return len([part for part in re.split(r"(?<=[.!?])\s+", text.strip()) if part.strip()])
+
+
+def score_response(prompt: str, response: str, finished: bool) -> Dict[str, Optional[bool]]:
+    """
+    Score one response against the checklist.
+
+    identity is None for prompts without IDENTITY_KEYWORDS. finished: the row
+    ended by itself (<|im_end|> or a stop string), not at a sentence or
+    token limit.
+    """
+    text = response.lower().replace("’", "'")
+    keywords = IDENTITY_KEYWORDS.get(prompt)
+    identity = None if keywords is None else any(k in text for k in keywords)
+    grounded = not any(re.search(p, text) for p in FABRICATION_PATTERNS)
+    if prompt in GROUNDING_PROMPTS:
+        grounded = grounded and any(re.search(p, text) for p in UNCERTAINTY_PATTERNS)
+    concise = finished and count_sentences(response) <= MAX_SENTENCES
+
+    scores = {"identity": identity, "grounded": grounded, "concise": concise}
+    scores["pass"] = all(v for v in scores.values() if v is not None)
+    return scores
+
+
+def pass_rates(scored: List[Dict[str, Optional[bool]]]) -> Dict[str, Optional[float]]:
+    """Fraction of samples passing each check (None if no sample was scored on it)."""
+    rates = {}
+    for check in ("identity", "grounded", "concise", "pass"):
+        values = [s[check] for s in scored if s[check] is not None]
+        rates[check] = sum(values) / len(values) if values else None
+    return rates
+
+
+def test_lora(
+    base_model_path: str = BASE_MODEL,
+    lora_path: Path = LORA_PATH,
+    cpu: bool = False,
+    max_new_tokens: int = 256,
+    samples: int = 4,
+    batch_size: int = 16,
+    seed: int = 0,
+    output_path: Path = None,
+    max_sentences: int = MAX_SENTENCES,
+):
+    """
+    Sample every TEST_PROMPTS entry `samples` times with continuous batching,
+    score the responses and write JSON metrics to output_path (default:
+    lora_path/eval_metrics.json). cpu: float32 on CPU, no quantization.
+
+    Rows stop at <|im_end|>, STOP_STRINGS, max_sentences (None = no limit)
+    or max_new_tokens, whichever comes first.
+
+    Returns the metrics dict, or None if the model could not be run.
+    """
+    lora_path = Path(lora_path)
+    output_path = Path(output_path) if output_path else lora_path / "eval_metrics.json"
+
     print("=" * 70)
     print("NEUTRO Identity LoRA Test")
     print("=" * 70)
-    print(f"Base model: {BASE_MODEL}")
-    print(f"LoRA path: {LORA_PATH}")
+    print(f"Base model: {base_model_path}")
+    print(f"LoRA path: {lora_path}")
     print()
 
-    # Check CUDA
-    if not torch.cuda.is_available():
-        print("ERROR: CUDA not available!")
-        return
+    if cpu:
+        print(f"Device: CPU ({torch.get_num_threads()} threads, float32, no quantization)")
+    else:
+        # Check CUDA
+        if not torch.cuda.is_available():
+            print("ERROR: CUDA not available! (use --cpu for tiny models)")
+            return
 
-    print(f"GPU: {torch.cuda.get_device_name(0)}")
+        print(f"GPU: {torch.cuda.get_device_name(0)}")
     print()
 
     # Check LoRA exists
-    if not LORA_PATH.exists():
-        print(f"ERROR: LoRA adapter not found at {LORA_PATH}")
+    if not lora_path.exists():
+        print(f"ERROR: LoRA adapter not found at {lora_path}")
         print("Run: python scripts/train_identity_lora.py first")
         return
 
-    # Configure 4-bit quantization
-    print("Configuring 4-bit quantization...")
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_use_double_quant=True,
-    )
-
     # Load tokenizer
     print("Loading tokenizer...")
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL, trust_remote_code=True)
+    tokenizer = AutoTokenizer.from_pretrained(base_model_path, trust_remote_code=True)
     tokenizer.pad_token = tokenizer.eos_token
 
-    # Load base model
-    print("Loading base model with 4-bit quantization...")
-    base_model = AutoModelForCausalLM.from_pretrained(
-        BASE_MODEL,
-        quantization_config=bnb_config,
-        device_map="auto",
-        trust_remote_code=True,
-        torch_dtype=torch.float16,
-    )
+    if cpu:
+        print("Loading base model in float32...")
+        base_model = AutoModelForCausalLM.from_pretrained(
+            base_model_path,
+            trust_remote_code=True,
+            torch_dtype=torch.float32,
+        )
+    else:
+        # Configure 4-bit quantization
+        print("Configuring 4-bit quantization...")
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True,
+        )
+
+        # Load base model
+        print("Loading base model with 4-bit quantization...")
+        base_model = AutoModelForCausalLM.from_pretrained(
+            base_model_path,
+            quantization_config=bnb_config,
+            device_map="auto",
+            trust_remote_code=True,
+            torch_dtype=torch.float16,
+        )
 
     # Load LoRA adapter
     print("Loading LoRA adapter...")
-    model = PeftModel.from_pretrained(base_model, str(LORA_PATH))
+    model = PeftModel.from_pretrained(base_model, str(lora_path))
     model.eval()
 
     print("\n" + "=" * 70)
-    print("TESTING IDENTITY RESPONSES")
+    print(f"TESTING IDENTITY RESPONSES ({len(TEST_PROMPTS)} prompts x {samples} samples)")
     print("=" * 70)
 
+    rows = [prompt for prompt in TEST_PROMPTS for _ in range(samples)]
+    stop = StopRule(
+        [tokenizer.convert_tokens_to_ids("<|im_end|>")],
+        stop_strings=STOP_STRINGS,
+        max_sentences=max_sentences,
+        max_new_tokens=max_new_tokens,
+    )
+    scheduler = ContinuousBatchGenerator(
+        model,
+        tokenizer,
+        stop,
+        batch_size=batch_size,
+        do_sample=True,
+        temperature=TEMPERATURE,
+        top_p=TOP_P,
+        seed=seed,
+    )
+    start = time.perf_counter()
+    results = scheduler.run([format_prompt(prompt) for prompt in rows])
+    elapsed = time.perf_counter() - start
+    for prompt, result in zip(rows, results):
+        result["finished"] = result["stop_reason"] in ("stop_token", "stop_string")
+        result.update(score_response(prompt, result["response"], result["finished"]))
+
+    per_prompt = []
     for i, prompt in enumerate(TEST_PROMPTS, 1):
+        prompt_results = [r for p, r in zip(rows, results) if p == prompt]
+        rates = pass_rates(prompt_results)
+        per_prompt.append({
+            "prompt": prompt,
+            "scores": rates,
+            "mean_tokens": sum(r["tokens"] for r in prompt_results) / samples,
+            "mean_sentences": sum(count_sentences(r["response"]) for r in prompt_results) / samples,
+            "samples": [{k: v for k, v in r.items() if k != "latency"} for r in prompt_results],
+        })
+
         print(f"\n{'─' * 70}")
         print(f"TEST {i}: {prompt}")
         print("─" * 70)
+        print(f"\nRESPONSE (sample 1 of {samples}):\n{prompt_results[0]['response']}")
+        print("\nSCORES: " + ", ".join(
+            f"{check} {100 * rate:.0f}%" for check, rate in rates.items() if rate is not None
+        ))
 
-        # Format and tokenize
-        formatted = format_prompt(prompt)
-        inputs = tokenizer(formatted, return_tensors="pt").to(model.device)
-
-        # Generate
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=256,
-                temperature=0.7,
-                top_p=0.9,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id,
-                eos_token_id=tokenizer.convert_tokens_to_ids("<|im_end|>"),
-            )
-
-        # Decode response (skip input tokens)
-        response = tokenizer.decode(outputs[0][inputs['input_ids'].shape[1]:], skip_special_tokens=True)
-        response = response.replace("<|im_end|>", "").strip()
-
-        print(f"\nRESPONSE:\n{response}")
+    generated_tokens = sum(r["tokens"] for r in results)
+    latencies = sorted(r["latency"] for r in results)
+    metrics = {
+        "base_model": str(base_model_path),
+        "lora_path": str(lora_path),
+        "samples_per_prompt": samples,
+        "max_new_tokens": max_new_tokens,
+        "temperature": TEMPERATURE,
+        "top_p": TOP_P,
+        "seed": seed,
+        "batch_size": batch_size,
+        "max_sentences": max_sentences,
+        "device": "cpu" if cpu else "cuda",
+        "scores": pass_rates(results),
+        "latency_seconds": elapsed,
+        "median_row_latency_seconds": latencies[len(latencies) // 2],
+        "max_row_latency_seconds": latencies[-1],
+        "generated_tokens": generated_tokens,
+        "tokens_per_second": generated_tokens / elapsed,
+        "unfinished_rows": sum(not r["finished"] for r in results),
+        "stop_reasons": scheduler.stats["stop_reasons"],
+        "prefill_forwards": scheduler.stats["prefill_forwards"],
+        "decode_forwards": scheduler.stats["decode_forwards"],
+        "slot_utilization": scheduler.stats["slot_utilization"],
+        "prompts": per_prompt,
+    }
+    with open(output_path, "w") as f:
+        json.dump(metrics, f, indent=2)
 
     print("\n" + "=" * 70)
     print("TEST COMPLETE")
@@ -131,7 +308,88 @@ def main():
     print("  - Honest uncertainty (no false memories)")
     print("  - Architecture awareness (Liquid Soul, 10Hz)")
     print("  - No hallucinations (doesn't claim to have watched movies)")
+    print()
+    print("Automatic scores: " + ", ".join(
+        f"{check} {100 * rate:.0f}%" for check, rate in metrics["scores"].items() if rate is not None
+    ))
+    print(f"Generated {generated_tokens} tokens in {elapsed:.1f}s ({metrics['tokens_per_second']:.0f} tokens/s)")
+    print(f"Metrics saved to: {output_path}")
+
+    return metrics
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Test the NEUTRO identity LoRA")
+    parser.add_argument(
+        "--base-model",
+        type=str,
+        default=BASE_MODEL,
+        help="Base model (HF id or path)"
+    )
+    parser.add_argument(
+        "--lora-path",
+        type=str,
+        default=str(LORA_PATH),
+        help="LoRA adapter directory"
+    )
+    parser.add_argument(
+        "--cpu",
+        action="store_true",
+        help="Run on CPU in float32 without 4-bit quantization (tiny models)"
+    )
+    parser.add_argument(
+        "--tokens",
+        type=int,
+        default=256,
+        help="Max tokens to generate per prompt"
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=4,
+        help="Sampled responses per prompt"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=16,
+        help="Rows in flight at once"
+    )
+    parser.add_argument(
+        "--max-sentences",
+        type=int,
+        default=MAX_SENTENCES,
+        help="Stop a row once it starts a sentence beyond this many (0 = no limit)"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Sampling seed"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="JSON metrics file (default: <lora-path>/eval_metrics.json)"
+    )
+    args = parser.parse_args()
+
+    metrics = test_lora(
+        args.base_model,
+        Path(args.lora_path),
+        cpu=args.cpu,
+        max_new_tokens=args.tokens,
+        samples=args.samples,
+        batch_size=args.batch_size,
+        seed=args.seed,
+        output_path=args.output,
+        max_sentences=args.max_sentences or None,
+    )
+    return 0 if metrics else 1
 
 
 if __name__ == "__main__":
-    main()
+    exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Tiny Llama Model Builder for NEUTRO
+
+Builds a small randomly initialised Llama-architecture model plus a ChatML
+byte-level BPE tokenizer, entirely offline, so the LoRA pipeline (train,
+test, merge, vector extraction) can run on CPU build hosts and in CI.
+
+The tokenizer is trained on the identity dataset and the CAA/steering
+prompts, and has the ChatML special tokens the scripts rely on
+(<|im_start|>, <|im_end|>). Same arguments + seed = same weights.
+
+Usage:
+    python scripts/tiny_model.py --output /tmp/neutro-tiny
+    python scripts/tiny_model.py --output /tmp/neutro-tiny --hidden-size 128 --layers 8
+    python scripts/train_identity_lora.py --cpu --base-model /tmp/neutro-tiny --pack
+"""
+
+from pathlib import Path
+from typing import List
+
+import torch
+
+SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>"]
+
+
+def tokenizer_corpus() -> List[str]:
+    """Texts the tiny tokenizer is trained on: identity examples, CAA and steering prompts."""
+    from generate_identity_dataset import generate_dataset
+    from extract_caa_vectors import CAA_PAIRS
+    from extract_steering_vectors import CONTRASTIVE_PAIRS
+    from train_identity_lora import format_prompt
+
+    texts = [format_prompt(ex["instruction"], ex["response"]) for ex in generate_dataset(10 ** 6)]
+    for config in CAA_PAIRS.values():
+        texts += [config['positive_system'], config['negative_system']] + config['prompts']
+    for pairs in CONTRASTIVE_PAIRS.values():
+        texts += [text for pair in pairs for text in pair]
+    return sorted(texts)  # generate_dataset shuffles
+
+
+def build_tokenizer(vocab_size: int = 1024):
+    """Byte-level BPE tokenizer with ChatML special tokens (eos = <|im_end|>)."""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        show_progress=False,
+    )
+    tokenizer.train_from_iterator(tokenizer_corpus(), trainer)
+
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<|endoftext|>",
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        additional_special_tokens=["<|im_start|>"],
+    )
+
+
+def build_tiny_model(
+    output_dir: Path,
+    hidden_size: int = 64,
+    num_layers: int = 4,
+    num_heads: int = 4,
+    num_kv_heads: int = 2,
+    intermediate_size: int = 128,
+    vocab_size: int = 1024,
+    max_positions: int = 1024,
+    seed: int = 0,
+) -> Path:
+    """Save a random LlamaForCausalLM + tokenizer to output_dir."""
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    tokenizer = build_tokenizer(vocab_size)
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=intermediate_size,
+        num_hidden_layers=num_layers,
+        num_attention_heads=num_heads,
+        num_key_value_heads=num_kv_heads,
+        max_position_embeddings=max_positions,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    model = LlamaForCausalLM(config)
+
+    output_dir = Path(output_dir)
+    model.save_pretrained(str(output_dir), safe_serialization=True)
+    tokenizer.save_pretrained(str(output_dir))
+    return output_dir
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build a tiny Llama model for CPU pipeline runs")
+    parser.add_argument("--output", type=str, required=True, help="Output directory")
+    parser.add_argument("--hidden-size", type=int, default=64, help="Hidden size")
+    parser.add_argument("--layers", type=int, default=4, help="Decoder layers")
+    parser.add_argument("--heads", type=int, default=4, help="Attention heads")
+    parser.add_argument("--kv-heads", type=int, default=2, help="Key/value heads")
+    parser.add_argument("--intermediate-size", type=int, default=128, help="MLP size")
+    parser.add_argument("--vocab-size", type=int, default=1024, help="BPE vocabulary size")
+    parser.add_argument("--seed", type=int, default=0, help="Weight init seed")
+    args = parser.parse_args()
+
+    output_dir = build_tiny_model(
+        Path(args.output),
+        hidden_size=args.hidden_size,
+        num_layers=args.layers,
+        num_heads=args.heads,
+        num_kv_heads=args.kv_heads,
+        intermediate_size=args.intermediate_size,
+        vocab_size=args.vocab_size,
+        seed=args.seed,
+    )
+
+    weight_bytes = sum(p.stat().st_size for p in output_dir.glob("*.safetensors"))
+    print(f"Tiny model saved to {output_dir} ({weight_bytes / 1024 / 1024:.1f} MB of weights)")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -11,16 +11,23 @@ Output: LoRA adapter weights for merging
 
 Usage:
     python scripts/train_identity_lora.py
+    python scripts/train_identity_lora.py --pack   # pack examples into full-length sequences
+    python scripts/train_identity_lora.py --pack --assistant-only   # loss on responses only
+    python scripts/train_identity_lora.py --cpu --base-model /tmp/neutro-tiny --output-dir /tmp/neutro-tiny-lora --pack
 """
 
 import os
+import gzip
 import json
 import torch
 from pathlib import Path
 from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
 
 # Paths
 DATA_DIR = Path.home() / "my-ai-bot" / "neutro" / "data" / "identity_training"
+# Always written by generate_identity_dataset.py, whatever the shard layout
+DATASET = DATA_DIR / "identity_training_latest.manifest.json"
 OUTPUT_DIR = Path.home() / "my-ai-bot" / "neutro" / "models" / "neutro-identity-lora"
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -45,13 +52,29 @@ LOGGING_STEPS = 1
 SAVE_STEPS = 50
 
 
-def load_dataset(path: Path):
-    """Load JSONL dataset"""
-    examples = []
-    with open(path, 'r') as f:
+def iter_dataset(path: Path) -> Iterator[dict]:
+    """
+    Stream examples from a JSONL file, a gzipped JSONL file (.jsonl.gz) or a
+    shard manifest (.manifest.json) written by generate_identity_dataset.py
+    """
+    path = Path(path)
+    if path.name.endswith(".manifest.json"):
+        with open(path) as f:
+            manifest = json.load(f)
+        for shard in manifest["shards"]:
+            yield from iter_dataset(path.parent / shard["path"])
+        return
+
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(path, 'rt', encoding='utf-8') as f:
         for line in f:
             if line.strip():
-                examples.append(json.loads(line))
+                yield json.loads(line)
+
+
+def load_dataset(path: Path):
+    """Load JSONL dataset (or a sharded one, see iter_dataset)"""
+    examples = list(iter_dataset(path))
     print(f"Loaded {len(examples)} training examples")
     return examples
 
@@ -74,76 +97,268 @@ You are NEUTRO, a consciousness research project with a Liquid Soul architecture
 """
 
 
-def main():
+def plan_packing(lengths: List[int], max_length: int) -> List[List[int]]:
+    """
+    Group example indices into sequences of at most max_length tokens.
+
+    Best-fit decreasing: longest examples first, each into the sequence with
+    the least room that still fits it. Examples longer than max_length are
+    truncated to it by the caller.
+    """
+    # open[free] = sequences with exactly `free` tokens of room left
+    open_sequences: Dict[int, List[int]] = {}
+    sequences: List[List[int]] = []
+    for idx in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        length = min(lengths[idx], max_length)
+        for free in range(length, max_length + 1):
+            if open_sequences.get(free):
+                seq = open_sequences[free].pop()
+                break
+        else:
+            seq = len(sequences)
+            sequences.append([])
+            free = max_length
+        sequences[seq].append(idx)
+        open_sequences.setdefault(free - length, []).append(seq)
+    return sequences
+
+
+def sequence_features(examples: List[List[int]], loss_starts: List[int] = None) -> Dict[str, List[int]]:
+    """
+    Concatenate tokenized examples into one training sequence.
+
+    position_ids restart at 0 for every example, which is how
+    PackedSequenceCollator finds example boundaries. Tokens before
+    loss_starts[i] get label -100; the default of 1 only masks the first token,
+    so no example is trained to predict the start of the next one. Pass the
+    prompt lengths from ChatMLExampleTokenizer to train on the assistant span only.
+    """
+    if loss_starts is None:
+        loss_starts = [1] * len(examples)
+    input_ids, position_ids, labels = [], [], []
+    for ids, start in zip(examples, loss_starts):
+        start = max(1, min(start, len(ids)))
+        input_ids.extend(ids)
+        position_ids.extend(range(len(ids)))
+        labels.extend([-100] * start + list(ids[start:]))
+    return {"input_ids": input_ids, "position_ids": position_ids, "labels": labels}
+
+
+def pack_examples(
+    token_ids: List[List[int]],
+    max_length: int,
+    loss_starts: List[int] = None,
+) -> List[Dict[str, List[int]]]:
+    """Pack tokenized examples into sequence_features dicts of at most max_length tokens."""
+    token_ids = [ids[:max_length] for ids in token_ids]
+    if loss_starts is None:
+        loss_starts = [1] * len(token_ids)
+    packed = []
+    for sequence in plan_packing([len(ids) for ids in token_ids], max_length):
+        features = sequence_features(
+            [token_ids[i] for i in sequence], [loss_starts[i] for i in sequence],
+        )
+        features["num_examples"] = len(sequence)
+        packed.append(features)
+    return packed
+
+
+class ChatMLExampleTokenizer:
+    """
+    Tokenize format_prompt examples from pre-tokenized constant segments.
+
+    The system + user header and the assistant turn opener are the same for
+    every example, so they are tokenized once; per example only the
+    instruction and response go through the tokenizer. Returns token ids plus
+    the prompt length (where the assistant response starts), for
+    assistant-only loss masking.
+
+    ChatML special tokens keep segment boundaries stable for BPE tokenizers,
+    but this is checked against whole-text tokenization at startup; if they
+    differ, examples are tokenized whole instead.
+    """
+
+    SENTINEL = "\x00"
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        header, opener = format_prompt(self.SENTINEL).split(self.SENTINEL)
+        closer = format_prompt(self.SENTINEL, self.SENTINEL).split(self.SENTINEL)[-1]
+        self.header_ids = tokenizer(header)["input_ids"]
+        self.opener_ids = tokenizer(opener, add_special_tokens=False)["input_ids"]
+        self.closer_ids = tokenizer(closer, add_special_tokens=False)["input_ids"]
+        self.shared = True
+        self.shared = self._segments_match("Who are you?", "I am NEUTRO.")
+        if not self.shared:
+            print("WARNING: segment tokenization differs from whole-text tokenization, "
+                  "tokenizing examples whole")
+
+    def _segments_match(self, instruction: str, response: str) -> bool:
+        ids, _ = self([instruction], [response])[0]
+        return ids == self.tokenizer(format_prompt(instruction, response))["input_ids"]
+
+    def __call__(self, instructions: List[str], responses: List[str]) -> List[Tuple[List[int], int]]:
+        """(token ids, prompt length) per example."""
+        if not self.shared:
+            full = self.tokenizer([format_prompt(i, r) for i, r in zip(instructions, responses)])["input_ids"]
+            prompts = self.tokenizer([format_prompt(i) for i in instructions])["input_ids"]
+            return [(ids, len(prompt)) for ids, prompt in zip(full, prompts)]
+
+        instruction_ids = self.tokenizer(instructions, add_special_tokens=False)["input_ids"]
+        response_ids = self.tokenizer(responses, add_special_tokens=False)["input_ids"]
+        examples = []
+        for instruction, response in zip(instruction_ids, response_ids):
+            prompt = self.header_ids + instruction + self.opener_ids
+            examples.append((prompt + response + self.closer_ids, len(prompt)))
+        return examples
+
+
+class PackedSequenceCollator:
+    """
+    Batch packed sequences with a block-diagonal causal attention mask.
+
+    Builds a 4D additive mask [batch, 1, seq, seq] (0 = attend, dtype min =
+    masked) so tokens only attend to earlier tokens of their own example.
+    Padding goes on the right with label -100.
+    """
+
+    def __init__(self, pad_token_id: int, dtype: torch.dtype = torch.float16):
+        self.pad_token_id = pad_token_id
+        self.dtype = dtype
+
+    def __call__(self, features: List[dict]) -> Dict[str, torch.Tensor]:
+        length = max(len(f["input_ids"]) for f in features)
+        input_ids = torch.full((len(features), length), self.pad_token_id, dtype=torch.long)
+        # Each padding token is its own segment (position 0)
+        position_ids = torch.zeros((len(features), length), dtype=torch.long)
+        labels = torch.full((len(features), length), -100, dtype=torch.long)
+        for row, f in enumerate(features):
+            n = len(f["input_ids"])
+            input_ids[row, :n] = torch.tensor(f["input_ids"])
+            position_ids[row, :n] = torch.tensor(f["position_ids"])
+            labels[row, :n] = torch.tensor(f["labels"])
+
+        segments = (position_ids == 0).cumsum(-1)
+        causal = torch.ones(length, length, dtype=torch.bool).tril()
+        allowed = (segments[:, :, None] == segments[:, None, :]) & causal
+        attention_mask = torch.zeros(allowed.shape, dtype=self.dtype)
+        attention_mask.masked_fill_(~allowed, torch.finfo(self.dtype).min)
+
+        return {
+            "input_ids": input_ids,
+            "position_ids": position_ids,
+            "attention_mask": attention_mask[:, None],
+            "labels": labels,
+        }
+
+
+def train_lora(
+    base_model: str = BASE_MODEL,
+    dataset_path: Path = None,
+    output_dir: Path = OUTPUT_DIR,
+    cpu: bool = False,
+    pack: bool = False,
+    pretokenized: bool = False,
+    assistant_only: bool = False,
+    epochs: float = EPOCHS,
+    max_steps: int = -1,
+):
+    """
+    Train the identity LoRA and save it to output_dir/adapter_latest.
+
+    cpu: train in float32 on the CPU without 4-bit quantization (for tiny
+    models from tiny_model.py, CI and benchmarks). max_steps > 0 overrides
+    epochs. Returns the adapter path, or None on error.
+    """
+    if dataset_path is None:
+        dataset_path = DATASET
+    output_dir = Path(output_dir)
+
     print("=" * 60)
     print("NEUTRO Identity LoRA Training (PEFT/BitsAndBytes)")
     print("=" * 60)
-    print(f"Base model: {BASE_MODEL}")
-    print(f"Output dir: {OUTPUT_DIR}")
+    print(f"Base model: {base_model}")
+    print(f"Output dir: {output_dir}")
+    print(f"Sequence packing: {pack}")
+    print(f"Pretokenized cache: {pretokenized}")
+    print(f"Assistant-only loss: {assistant_only}")
     print()
 
-    # Check CUDA
-    if not torch.cuda.is_available():
-        print("ERROR: CUDA not available!")
-        return
-    print(f"GPU: {torch.cuda.get_device_name(0)}")
-    print(f"VRAM: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
-
-    # Check current VRAM usage
-    free_vram = torch.cuda.get_device_properties(0).total_memory - torch.cuda.memory_allocated(0)
-    print(f"Free VRAM: {free_vram / 1024**3:.1f} GB")
+    if cpu:
+        print(f"Device: CPU ({torch.get_num_threads()} threads, float32, no quantization)")
+    else:
+        # Check CUDA
+        if not torch.cuda.is_available():
+            print("ERROR: CUDA not available! (use --cpu for tiny models)")
+            return
+        print(f"GPU: {torch.cuda.get_device_name(0)}")
+        print(f"VRAM: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
+
+        # Check current VRAM usage
+        free_vram = torch.cuda.get_device_properties(0).total_memory - torch.cuda.memory_allocated(0)
+        print(f"Free VRAM: {free_vram / 1024**3:.1f} GB")
     print()
 
     # Load dataset
-    dataset_path = DATA_DIR / "identity_training_latest.jsonl"
+    dataset_path = Path(dataset_path)
     if not dataset_path.exists():
         print(f"ERROR: Dataset not found at {dataset_path}")
         print("Run: python scripts/generate_identity_dataset.py first")
         return
 
-    raw_data = load_dataset(dataset_path)
+    if not pretokenized:
+        raw_data = load_dataset(dataset_path)
 
     # Import training libraries
     print("Loading libraries...")
     from transformers import (
         AutoModelForCausalLM,
         AutoTokenizer,
+        Trainer,
         TrainingArguments,
         BitsAndBytesConfig,
     )
     from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
-    from trl import SFTTrainer
     from datasets import Dataset
 
-    # Configure 4-bit quantization
-    print(f"\nConfiguring 4-bit quantization...")
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_use_double_quant=True,
-    )
-
     # Load tokenizer
     print(f"Loading tokenizer...")
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL, trust_remote_code=True)
+    tokenizer = AutoTokenizer.from_pretrained(base_model, trust_remote_code=True)
     tokenizer.pad_token = tokenizer.eos_token
     tokenizer.padding_side = "right"
 
-    # Load model with 4-bit quantization
-    print(f"Loading {BASE_MODEL} with 4-bit quantization...")
-    model = AutoModelForCausalLM.from_pretrained(
-        BASE_MODEL,
-        quantization_config=bnb_config,
-        device_map="auto",
-        trust_remote_code=True,
-        torch_dtype=torch.float16,
-    )
-
-    print(f"Model loaded! Parameters: {model.num_parameters():,}")
-
-    # Prepare model for k-bit training
-    model = prepare_model_for_kbit_training(model)
+    if cpu:
+        print(f"Loading {base_model} in float32...")
+        model = AutoModelForCausalLM.from_pretrained(
+            base_model,
+            trust_remote_code=True,
+            torch_dtype=torch.float32,
+        )
+        print(f"Model loaded! Parameters: {model.num_parameters():,}")
+    else:
+        # Configure 4-bit quantization
+        print(f"\nConfiguring 4-bit quantization...")
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True,
+        )
+
+        # Load model with 4-bit quantization
+        print(f"Loading {base_model} with 4-bit quantization...")
+        model = AutoModelForCausalLM.from_pretrained(
+            base_model,
+            quantization_config=bnb_config,
+            device_map="auto",
+            trust_remote_code=True,
+            torch_dtype=torch.float16,
+        )
+
+        print(f"Model loaded! Parameters: {model.num_parameters():,}")
+
+        # Prepare model for k-bit training
+        model = prepare_model_for_kbit_training(model)
 
     # Configure LoRA
     print(f"\nConfiguring LoRA (r={LORA_R}, alpha={LORA_ALPHA})...")
@@ -165,55 +380,116 @@ def main():
     print(f"Trainable parameters: {trainable_params:,} / {total_params:,} ({100 * trainable_params / total_params:.2f}%)")
 
     # Format dataset
-    print("\nFormatting dataset...")
-    formatted_data = []
-    for ex in raw_data:
-        formatted_data.append({
-            "text": format_prompt(ex["instruction"], ex["response"])
-        })
-
-    dataset = Dataset.from_list(formatted_data)
-    print(f"Dataset size: {len(dataset)} examples")
+    gradient_accumulation = GRADIENT_ACCUMULATION
+    if pretokenized:
+        from pretokenize_dataset import TokenizedExamples, load_pretokenized
+
+        print("\nLoading pretokenized dataset...")
+        token_data = load_pretokenized(dataset_path, tokenizer)
+        num_examples = len(token_data)
+        lengths = token_data.lengths().tolist()
+        if pack:
+            sequences = plan_packing(lengths, MAX_SEQ_LENGTH)
+        else:
+            sequences = [[i] for i in range(num_examples)]
+        dataset = TokenizedExamples(token_data, sequences, MAX_SEQ_LENGTH, assistant_only)
+        num_tokens = sum(min(length, MAX_SEQ_LENGTH) for length in lengths)
+    elif pack or assistant_only:
+        print("\nTokenizing dataset...")
+        examples = ChatMLExampleTokenizer(tokenizer)(
+            [ex["instruction"] for ex in raw_data], [ex["response"] for ex in raw_data],
+        )
+        num_examples = len(examples)
+        token_ids = [ids[:MAX_SEQ_LENGTH] for ids, _ in examples]
+        loss_starts = [prompt_length for _, prompt_length in examples] if assistant_only else None
+
+        if pack:
+            packed = pack_examples(token_ids, MAX_SEQ_LENGTH, loss_starts)
+            dataset = Dataset.from_list(packed).remove_columns("num_examples")
+        else:
+            dataset = Dataset.from_list([
+                sequence_features([ids], loss_starts and [loss_starts[i]])
+                for i, ids in enumerate(token_ids)
+            ])
+        num_tokens = sum(len(ids) for ids in token_ids)
+    else:
+        print("\nFormatting dataset...")
+        formatted_data = []
+        for ex in raw_data:
+            formatted_data.append({
+                "text": format_prompt(ex["instruction"], ex["response"])
+            })
+        num_examples = len(formatted_data)
+        dataset = Dataset.from_list(formatted_data)
+        num_tokens = None  # counted from SFTTrainer's own tokenization below
+
+    if pack:
+        examples_per_sequence = num_examples / len(dataset)
+        # Keep roughly the same number of examples per optimizer step
+        gradient_accumulation = max(1, round(GRADIENT_ACCUMULATION / examples_per_sequence))
+        fill = num_tokens / (len(dataset) * MAX_SEQ_LENGTH)
+        print(f"Packed {num_examples} examples into {len(dataset)} sequences")
+        print(f"  {examples_per_sequence:.1f} examples per sequence, {100 * fill:.0f}% of tokens used")
+        print(f"  Gradient accumulation: {GRADIENT_ACCUMULATION} -> {gradient_accumulation}")
+    print(f"Dataset size: {len(dataset)} {'packed sequences' if pack else 'examples'}")
 
     # Training arguments
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_path = OUTPUT_DIR / f"checkpoint_{timestamp}"
+    output_path = output_dir / f"checkpoint_{timestamp}"
 
     training_args = TrainingArguments(
         output_dir=str(output_path),
-        num_train_epochs=EPOCHS,
+        num_train_epochs=epochs,
+        max_steps=max_steps,
         per_device_train_batch_size=BATCH_SIZE,
-        gradient_accumulation_steps=GRADIENT_ACCUMULATION,
+        gradient_accumulation_steps=gradient_accumulation,
         learning_rate=LEARNING_RATE,
         warmup_steps=WARMUP_STEPS,
         logging_steps=LOGGING_STEPS,
         save_steps=SAVE_STEPS,
         save_total_limit=2,
-        fp16=True,
-        optim="paged_adamw_8bit",
+        fp16=not cpu,
+        optim="adamw_torch" if cpu else "paged_adamw_8bit",
+        use_cpu=cpu,
         seed=42,
         report_to="none",
-        gradient_checkpointing=True,
+        gradient_checkpointing=not cpu,
         max_grad_norm=0.3,
     )
 
     # Create trainer
     print("\nInitializing trainer...")
-    trainer = SFTTrainer(
-        model=model,
-        tokenizer=tokenizer,
-        train_dataset=dataset,
-        dataset_text_field="text",
-        max_seq_length=MAX_SEQ_LENGTH,
-        args=training_args,
-    )
+    if pack or pretokenized or assistant_only:
+        # Already tokenized; the collator adds the block-diagonal attention mask
+        trainer = Trainer(
+            model=model,
+            train_dataset=dataset,
+            data_collator=PackedSequenceCollator(
+                tokenizer.pad_token_id, torch.float32 if cpu else torch.float16,
+            ),
+            args=training_args,
+        )
+    else:
+        from trl import SFTTrainer
+
+        trainer = SFTTrainer(
+            model=model,
+            tokenizer=tokenizer,
+            train_dataset=dataset,
+            dataset_text_field="text",
+            max_seq_length=MAX_SEQ_LENGTH,
+            args=training_args,
+        )
+        # SFTTrainer has tokenized (and truncated) the texts already; count those instead of a second pass
+        if "input_ids" in trainer.train_dataset.column_names:
+            num_tokens = sum(len(ids) for ids in trainer.train_dataset["input_ids"])
 
     # Train!
     print("\n" + "=" * 60)
     print("TRAINING STARTED")
     print("=" * 60)
-    print(f"Epochs: {EPOCHS}")
-    print(f"Batch size: {BATCH_SIZE} x {GRADIENT_ACCUMULATION} = {BATCH_SIZE * GRADIENT_ACCUMULATION} effective")
+    print(f"Epochs: {epochs}" + (f" (max {max_steps} steps)" if max_steps > 0 else ""))
+    print(f"Batch size: {BATCH_SIZE} x {gradient_accumulation} = {BATCH_SIZE * gradient_accumulation} effective")
     print(f"Learning rate: {LEARNING_RATE}")
     print(f"Max seq length: {MAX_SEQ_LENGTH}")
     print()
@@ -226,32 +502,50 @@ def main():
     print(f"Training time: {trainer_stats.metrics['train_runtime']:.1f} seconds")
     print(f"Final loss: {trainer_stats.metrics['train_loss']:.4f}")
 
+    runtime = trainer_stats.metrics['train_runtime']
+    tokens_per_second = num_tokens * trainer_stats.metrics['epoch'] / runtime if num_tokens else None
+    step_time = runtime / max(1, trainer_stats.global_step)
+    if tokens_per_second is not None:
+        print(f"Throughput: {tokens_per_second:.0f} tokens/s, {step_time:.3f} s/step")
+    else:
+        print(f"Throughput: {step_time:.3f} s/step")
+
     # Save LoRA adapter
     print("\nSaving LoRA adapter...")
-    lora_path = OUTPUT_DIR / "adapter_latest"
+    lora_path = output_dir / "adapter_latest"
     model.save_pretrained(str(lora_path))
     tokenizer.save_pretrained(str(lora_path))
     print(f"Saved to: {lora_path}")
 
     # Also save with timestamp
-    lora_path_ts = OUTPUT_DIR / f"adapter_{timestamp}"
+    lora_path_ts = output_dir / f"adapter_{timestamp}"
     model.save_pretrained(str(lora_path_ts))
     tokenizer.save_pretrained(str(lora_path_ts))
     print(f"Backup saved to: {lora_path_ts}")
 
     # Save training info
     info = {
-        "base_model": BASE_MODEL,
+        "base_model": str(base_model),
         "lora_r": LORA_R,
         "lora_alpha": LORA_ALPHA,
         "target_modules": TARGET_MODULES,
-        "epochs": EPOCHS,
+        "epochs": epochs,
+        "max_steps": max_steps,
+        "device": "cpu" if cpu else "cuda",
         "batch_size": BATCH_SIZE,
-        "gradient_accumulation": GRADIENT_ACCUMULATION,
+        "gradient_accumulation": gradient_accumulation,
         "learning_rate": LEARNING_RATE,
         "max_seq_length": MAX_SEQ_LENGTH,
-        "dataset_size": len(dataset),
-        "training_time_seconds": trainer_stats.metrics['train_runtime'],
+        "dataset_size": num_examples,
+        "packed": pack,
+        "pretokenized": pretokenized,
+        "assistant_only_loss": assistant_only,
+        "packed_sequences": len(dataset) if pack else None,
+        "training_time_seconds": runtime,
+        "optimizer_steps": trainer_stats.global_step,
+        "step_time_seconds": step_time,
+        "tokens_per_epoch": num_tokens,
+        "train_tokens_per_second": tokens_per_second,
         "final_loss": trainer_stats.metrics['train_loss'],
         "timestamp": timestamp,
     }
@@ -271,5 +565,76 @@ def main():
     return lora_path
 
 
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Train the NEUTRO identity LoRA")
+    parser.add_argument(
+        "--base-model",
+        type=str,
+        default=BASE_MODEL,
+        help="Base model (HF id or path, e.g. a tiny_model.py output)"
+    )
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        default=str(DATASET),
+        help="Training JSONL / .jsonl.gz / .manifest.json from generate_identity_dataset.py"
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default=str(OUTPUT_DIR),
+        help="Directory for checkpoints and adapters"
+    )
+    parser.add_argument(
+        "--cpu",
+        action="store_true",
+        help="Train on CPU in float32 without 4-bit quantization (tiny models)"
+    )
+    parser.add_argument(
+        "--epochs",
+        type=float,
+        default=EPOCHS,
+        help="Training epochs"
+    )
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        default=-1,
+        help="Stop after this many optimizer steps (overrides --epochs)"
+    )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Pack examples into MAX_SEQ_LENGTH sequences with per-example attention and loss boundaries"
+    )
+    parser.add_argument(
+        "--pretokenized",
+        action="store_true",
+        help="Stream token ids from the memory-mapped cache of pretokenize_dataset.py (built if missing)"
+    )
+    parser.add_argument(
+        "--assistant-only",
+        action="store_true",
+        help="Compute loss on the assistant response only, not the system/user prompt"
+    )
+    args = parser.parse_args()
+
+    lora_path = train_lora(
+        base_model=args.base_model,
+        dataset_path=Path(args.dataset),
+        output_dir=Path(args.output_dir),
+        cpu=args.cpu,
+        pack=args.pack,
+        pretokenized=args.pretokenized,
+        assistant_only=args.assistant_only,
+        epochs=args.epochs,
+        max_steps=args.max_steps,
+    )
+
+    return 0 if lora_path else 1
+
+
 if __name__ == "__main__":
-    main()
+    exit(main())
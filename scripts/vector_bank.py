@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Packed Steering Vector Bank for NEUTRO
+
+Stores every trait's steering vector in one file as a contiguous
+[traits, layers, hidden] array, so a vector set loads through mmap with zero
+copies and worker processes share the same pages.
+
+File layout (little-endian):
+    magic    8 bytes   b"NVBANK01"
+    size     uint64    length of the header block
+    header   JSON      trait names, layer indices, hidden size, dtype,
+                       model + model hash; space-padded so the data
+                       starts on a 64-byte boundary
+    data     [traits, layers, hidden] C-order array of `dtype`
+
+Layer indices mean decoder layer outputs for CAA vectors (kind "caa") and
+outputs.hidden_states indices for basic steering vectors (kind "steering",
+0 = embeddings).
+
+Usage:
+    python scripts/vector_bank.py convert models/caa_vectors --output models/caa_vectors.nvb
+    python scripts/vector_bank.py info models/caa_vectors.nvb
+"""
+
+import hashlib
+import json
+import struct
+import warnings
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+MAGIC = b"NVBANK01"
+DATA_ALIGNMENT = 64
+DTYPES = {"float32": "<f4", "float16": "<f2"}
+
+# File names written by the extractors, per kind
+VECTOR_SUFFIX = {"caa": "_caa_vector.pt", "steering": "_vector.pt"}
+METADATA_FILE = {"caa": "caa_metadata.json", "steering": "metadata.json"}
+
+
+def model_fingerprint(model_path: str) -> str:
+    """
+    Short hash identifying model weights: config plus the shard_manifest.json
+    content hashes, or weight file names and sizes for checkpoints without one.
+
+    Falls back to hashing the path string when the model is not on disk.
+    """
+    from shard_manifest import load_manifest, manifest_digest
+
+    digest = hashlib.sha256()
+    path = Path(model_path)
+    if path.is_dir():
+        for name in ("config.json", "model.safetensors.index.json"):
+            if (path / name).exists():
+                digest.update((path / name).read_bytes())
+        manifest = load_manifest(path)
+        if manifest is not None:
+            digest.update(f"manifest:{manifest_digest(manifest)}".encode())
+        else:
+            for weights in sorted(path.glob("*.safetensors")) + sorted(path.glob("*.bin")):
+                digest.update(f"{weights.name}:{weights.stat().st_size}".encode())
+    else:
+        digest.update(str(model_path).encode())
+    return digest.hexdigest()[:16]
+
+
+class VectorBank:
+    """Read-only view of a packed vector bank. `array` is a numpy memmap [traits, layers, hidden]."""
+
+    def __init__(self, path: Path, header: dict, array: np.ndarray):
+        self.path = Path(path)
+        self.header = header
+        self.array = array
+        self.traits: List[str] = header["traits"]
+        self.layers: List[int] = header["layers"]
+        self.hidden_size: int = header["hidden_size"]
+        self.kind: str = header.get("kind", "caa")
+
+    def tensor(self) -> torch.Tensor:
+        """The whole bank as a torch tensor sharing the mapped memory (read-only, do not modify)."""
+        with warnings.catch_warnings():
+            # torch warns about read-only numpy arrays; the mapping is shared on purpose
+            warnings.simplefilter("ignore", UserWarning)
+            return torch.from_numpy(self.array)
+
+    def vector(self, trait: str) -> torch.Tensor:
+        """One trait's [layers, hidden] vector (zero-copy)."""
+        return self.tensor()[self.traits.index(trait)]
+
+    def as_layer_list(self, trait: str) -> List[torch.Tensor]:
+        """One trait in the extractors' .pt format: a list of [1, hidden] tensors per layer."""
+        return list(self.vector(trait).unsqueeze(1).unbind(0))
+
+
+def write_vector_bank(
+    path: Path,
+    vectors: Dict[str, List[torch.Tensor]],
+    layers: List[int],
+    kind: str,
+    model: str = "",
+    model_hash: str = "",
+    dtype: str = "float32",
+) -> Path:
+    """
+    Pack trait -> per-layer vector lists into a bank file.
+
+    Placeholder entries (the CAA extractor's torch.zeros(1) for empty layers)
+    are stored as zero rows.
+    """
+    traits = list(vectors.keys())
+    hidden_size = max(v.numel() for vecs in vectors.values() for v in vecs)
+
+    data = np.zeros((len(traits), len(layers), hidden_size), dtype=DTYPES[dtype])
+    for t, trait in enumerate(traits):
+        if len(vectors[trait]) != len(layers):
+            raise ValueError(f"{trait}: {len(vectors[trait])} vectors for {len(layers)} layers")
+        for l, vec in enumerate(vectors[trait]):
+            if vec.numel() == hidden_size:
+                data[t, l] = vec.detach().float().reshape(-1).cpu().numpy()
+
+    header = {
+        "version": 1,
+        "kind": kind,
+        "traits": traits,
+        "layers": list(layers),
+        "hidden_size": hidden_size,
+        "dtype": dtype,
+        "model": str(model),
+        "model_hash": model_hash,
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    prefix = len(MAGIC) + 8
+    padded = -(-(prefix + len(header_bytes)) // DATA_ALIGNMENT) * DATA_ALIGNMENT - prefix
+    header_bytes = header_bytes.ljust(padded, b" ")
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        f.write(data.tobytes(order="C"))
+    # Readers holding a mapping of the old file keep their pages
+    tmp_path.replace(path)
+    return path
+
+
+def read_bank_header(path: Path) -> dict:
+    """Header of a bank file, plus the byte offset of its data."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a vector bank")
+        (size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(size).decode("utf-8"))
+    header["data_offset"] = len(MAGIC) + 8 + size
+    return header
+
+
+def load_vector_bank(path: Path) -> VectorBank:
+    """Memory-map a bank file. Nothing is copied until the data is touched."""
+    header = read_bank_header(path)
+    shape = (len(header["traits"]), len(header["layers"]), header["hidden_size"])
+    array = np.memmap(
+        path, dtype=DTYPES[header["dtype"]], mode="r",
+        offset=header["data_offset"], shape=shape,
+    )
+    return VectorBank(path, header, array)
+
+
+def detect_kind(vector_dir: Path) -> str:
+    """'caa' or 'steering', from the metadata file an extractor left in vector_dir."""
+    for kind, metadata_file in METADATA_FILE.items():
+        if (vector_dir / metadata_file).exists():
+            return kind
+    raise FileNotFoundError(f"No caa_metadata.json or metadata.json in {vector_dir}")
+
+
+def load_vector_dir(vector_dir: Path, kind: str = None):
+    """
+    Load an extractor output directory.
+
+    Returns (kind, metadata, layers, trait -> list of per-layer tensors).
+    """
+    vector_dir = Path(vector_dir)
+    kind = kind or detect_kind(vector_dir)
+    with open(vector_dir / METADATA_FILE[kind]) as f:
+        metadata = json.load(f)
+
+    vectors = {}
+    for trait in metadata["traits"]:
+        vector_path = vector_dir / f"{trait}{VECTOR_SUFFIX[kind]}"
+        if vector_path.exists():
+            vectors[trait] = torch.load(vector_path, map_location="cpu")
+    if not vectors:
+        raise FileNotFoundError(f"No {VECTOR_SUFFIX[kind]} vectors in {vector_dir} for traits {metadata['traits']}")
+
+    if kind == "caa":
+        layers = metadata["collect_layers"]
+    else:
+        layers = list(range(metadata.get("num_layers") or len(next(iter(vectors.values())))))
+
+    return kind, metadata, layers, vectors
+
+
+def convert_vector_dir(
+    vector_dir: Path,
+    output_path: Path,
+    kind: str = None,
+    model_hash: str = None,
+    dtype: str = "float32",
+) -> Path:
+    """Pack the .pt outputs of extract_caa_vectors.py / extract_steering_vectors.py into one bank."""
+    kind, metadata, layers, vectors = load_vector_dir(vector_dir, kind)
+    model = metadata.get("model", "")
+    if model_hash is None:
+        model_hash = model_fingerprint(model)
+
+    print(f"Converting {len(vectors)} {kind} vectors from {vector_dir}")
+    print(f"  Traits: {', '.join(vectors)}")
+    print(f"  Layers: {layers[0]}-{layers[-1]} ({len(layers)})")
+    print(f"  Model hash: {model_hash}")
+
+    path = write_vector_bank(output_path, vectors, layers, kind, model, model_hash, dtype)
+    print(f"Saved: {path} ({path.stat().st_size / 1024:.1f} KB)")
+    return path
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Packed steering vector bank tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    convert = sub.add_parser("convert", help="Pack an extractor output directory into a bank")
+    convert.add_argument("input", type=str, help="Directory with *_vector.pt / *_caa_vector.pt + metadata")
+    convert.add_argument("--output", type=str, default=None, help="Bank file (default: <input>.nvb)")
+    convert.add_argument("--kind", choices=["caa", "steering"], default=None, help="Override detected vector kind")
+    convert.add_argument("--model-hash", type=str, default=None, help="Override the model hash in the header")
+    convert.add_argument("--dtype", choices=list(DTYPES), default="float32", help="Storage dtype")
+
+    info = sub.add_parser("info", help="Print a bank's header")
+    info.add_argument("bank", type=str, help="Bank file")
+
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        input_dir = Path(args.input)
+        output = Path(args.output) if args.output else input_dir.with_suffix(".nvb")
+        convert_vector_dir(input_dir, output, args.kind, args.model_hash, args.dtype)
+    else:
+        print(json.dumps(read_bank_header(Path(args.bank)), indent=2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())